@@ -0,0 +1,38 @@
+import os
+from django.core.management.base import BaseCommand
+from SSAPP.models import PDFFile, PDFPage
+from SSAPP.utils.content_hash import file_sha256
+
+
+# To store the content hashes of PDF files and pages uploaded before they were recorded, run:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py backfill_content_hashes
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = "Compute the SHA-256 content hashes of stored PDF files and pages that have none"
+
+    def handle(self, *args, **options):
+        files = self.backfill(PDFFile.objects.filter(sha256=""))
+        pages = self.backfill(PDFPage.objects.filter(sha256="").exclude(file=""))
+        self.stdout.write(self.style.SUCCESS(f"Hashed {files} PDF files and {pages} pages"))
+
+    def backfill(self, queryset):
+        """
+        Hashes the files of a queryset's objects in ID-ordered batches, skipping missing files.
+        """
+        last_id = 0
+        hashed = 0
+        while True:
+            objects = list(queryset.filter(id__gt=last_id).order_by("id").only("id", "file")[:BATCH_SIZE])
+            if not objects:
+                break
+            last_id = objects[-1].id
+            for obj in objects:
+                if not os.path.isfile(obj.file.path):
+                    self.stderr.write(f"Skipping {obj._meta.model_name} {obj.id}: {obj.file.path} does not exist")
+                    continue
+                queryset.model.objects.filter(id=obj.id).update(sha256=file_sha256(obj.file.path))
+                hashed += 1
+        return hashed
@@ -0,0 +1,88 @@
+import json
+import time
+import fitz  # PyMuPDF
+from django.core.management.base import BaseCommand
+from SSAPP.models import PDFFile, PDFPage, Token
+from SSAPP.utils.documentAI import process_tokens, token_info_to_dict
+from SSAPP.utils.fake_apis import fake_document
+
+
+# To measure token ingestion speed on a dense synthetic page, run the following management command:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py benchmark_tokens --tokens 3000
+
+
+def dense_document(token_count: int):
+    """
+    Builds a Document AI document for a synthetic page holding about `token_count` words.
+    """
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    words_per_line = 12
+    lines = (token_count + words_per_line - 1) // words_per_line
+    font_size = min(8.0, 700.0 / max(lines, 1))
+    for line in range(lines):
+        words = min(words_per_line, token_count - line * words_per_line)
+        text = " ".join(f"w{line}x{word}" for word in range(words))
+        page.insert_text((20, 40 + line * font_size * 1.0), text, fontsize=font_size)
+    content = doc.tobytes()
+    doc.close()
+    return fake_document(content)
+
+
+def ingest_row_by_row(pdf_page, document, page_width, page_height):
+    """
+    The previous ingestion: one create and one save per token, each in its own transaction.
+    """
+    for page_number, page in enumerate(document.pages, start=1):
+        for token_number, token in enumerate(page.tokens, start=1):
+            vertices = token.layout.bounding_poly.normalized_vertices
+            x1 = vertices[0].x * page_width
+            y1 = page_height - vertices[0].y * page_height
+            x2 = vertices[2].x * page_width
+            y2 = page_height - vertices[2].y * page_height
+            token_instance = Token.objects.create(
+                page=pdf_page,
+                token_id=f"page{page_number}_token{token_number}",
+                x1=x1,
+                y1=y1,
+                x2=x2,
+                y2=y2,
+                token_confidence=token.layout.confidence,
+            )
+            token_instance.token_info = json.dumps(token_info_to_dict(token, document.text))
+            token_instance.save()
+
+
+class Command(BaseCommand):
+    help = "Measure tokens per second of row-by-row and bulk token ingestion"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tokens", type=int, default=3000, help="Tokens on the synthetic page")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per method; the best is reported")
+
+    def handle(self, *args, **options):
+        document = dense_document(options["tokens"])
+        token_count = sum(len(page.tokens) for page in document.pages)
+        self.stdout.write(f"Synthetic page with {token_count} tokens")
+
+        pdf_file = PDFFile.objects.create(name="benchmark.pdf", file="pdfs/benchmark.pdf")
+        pdf_page = PDFPage.objects.create(pdf_file=pdf_file, page_number=1, file="pdf_pages/benchmark.pdf")
+        try:
+            methods = [
+                ("row by row", ingest_row_by_row),
+                ("bulk", process_tokens),
+            ]
+            for name, method in methods:
+                best = None
+                for _ in range(options["repeat"]):
+                    Token.objects.filter(page=pdf_page).delete()
+                    start = time.perf_counter()
+                    method(pdf_page, document, 612, 792)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                self.stdout.write(f"{name}: {best:.3f}s, {token_count / best:,.0f} tokens/sec")
+        finally:
+            # Delete through the querysets, since the model delete methods remove files
+            Token.objects.filter(page=pdf_page).delete()
+            PDFPage.objects.filter(id=pdf_page.id).delete()
+            PDFFile.objects.filter(id=pdf_file.id).delete()
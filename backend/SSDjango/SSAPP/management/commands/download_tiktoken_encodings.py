@@ -0,0 +1,44 @@
+import os
+from pathlib import Path
+import tiktoken
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand, CommandError
+from SSAPP.models import Settings
+
+
+# To bundle the tiktoken BPE files for workers without network access, run the following
+# management command on a machine with network access and ship the TIKTOKEN_CACHE_DIR directory:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py download_tiktoken_encodings
+
+
+class Command(BaseCommand):
+    help = "Download the tiktoken encodings used for token counting into TIKTOKEN_CACHE_DIR"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model", action="append", dest="models",
+            help="Model to download the encoding for (repeatable). Defaults to the configured GPT model.",
+        )
+        parser.add_argument("--cache-dir", default=None, help="Defaults to the TIKTOKEN_CACHE_DIR setting")
+
+    def handle(self, *args, **options):
+        cache_dir = Path(options["cache_dir"] or django_settings.TIKTOKEN_CACHE_DIR)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # tiktoken writes every file it fetches into this directory
+        os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)
+
+        models = options["models"]
+        if not models:
+            settings_obj = Settings.objects.first()
+            models = [settings_obj.gpt_model if settings_obj else Settings._meta.get_field("gpt_model").default]
+
+        for model in models:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                raise CommandError(f"tiktoken has no encoding for model {model}")
+            except Exception as e:
+                raise CommandError(f"Failed to download the encoding for model {model}: {e}")
+            self.stdout.write(f"{model}: {encoding.name}")
+
+        self.stdout.write(self.style.SUCCESS(f"Encodings saved to {cache_dir}"))
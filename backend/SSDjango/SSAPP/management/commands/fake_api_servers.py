@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from SSAPP.utils.fake_apis import FakeDocumentAIServer, FakeOpenAIServer
+
+
+# To run the scanner offline, start the fake servers with the following management command
+# and set the printed environment variables for the backend:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py fake_api_servers
+
+
+class Command(BaseCommand):
+    help = "Run local fake OpenAI and Document AI servers for offline development"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--openai-port", type=int, default=8081)
+        parser.add_argument("--documentai-port", type=int, default=8082)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds each fake call takes")
+
+    def handle(self, *args, **options):
+        openai_server = FakeOpenAIServer(options["openai_port"], options["latency"]).start()
+        documentai_server = FakeDocumentAIServer(options["documentai_port"], options["latency"]).start()
+
+        self.stdout.write(self.style.SUCCESS("Fake API servers running, set:"))
+        self.stdout.write(f"OPENAI_API_BASE={openai_server.api_base}")
+        self.stdout.write(f"DOCUMENTAI_API_ENDPOINT={documentai_server.api_endpoint}")
+        self.stdout.write("DOCUMENTAI_INSECURE_CHANNEL=true")
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            openai_server.stop()
+            documentai_server.stop()
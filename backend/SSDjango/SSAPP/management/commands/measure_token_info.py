@@ -0,0 +1,72 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from SSAPP.models import Token
+from SSAPP.utils.token_codec import decode_token_info, decode_token_info_field, encode_token_info, msgpack
+
+
+# To compare the storage size and decode time of the token info codecs on the stored tokens,
+# and optionally re-encode the stored tokens with the TOKEN_INFO_CODEC setting, run:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py measure_token_info --limit 20000
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py measure_token_info --rewrite
+
+REWRITE_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Measure token info size and decode time per codec, and optionally re-encode stored tokens"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=20000, help="Number of stored tokens to measure")
+        parser.add_argument("--rewrite", action="store_true", help="Re-encode every stored token with the configured codec")
+
+    def handle(self, *args, **options):
+        if options["rewrite"]:
+            self.rewrite()
+            return
+
+        values = list(Token.objects.order_by("id").values_list("token_info", flat=True)[:options["limit"]])
+        if not values:
+            raise CommandError("There are no stored tokens to measure")
+        token_infos = [decode_token_info(value) for value in values]
+        self.stdout.write(f"{len(token_infos)} tokens")
+
+        codecs = ["json", "zlib"] + (["msgpack-zstd"] if msgpack is not None else [])
+        for codec in codecs:
+            start = time.perf_counter()
+            encoded = [encode_token_info(token_info, codec) for token_info in token_infos]
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for value in encoded:
+                decode_token_info(value)
+            decode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for value in encoded:
+                decode_token_info_field(value, "style_info", "font_size")
+            field_time = time.perf_counter() - start
+
+            size = sum(len(value.encode()) for value in encoded)
+            count = len(encoded)
+            self.stdout.write(
+                f"{codec:>13}: {size / count:7.1f} bytes/token, {size / 1024 / 1024:8.2f} MB total, "
+                f"encode {encode_time / count * 1e6:6.1f} us, decode {decode_time / count * 1e6:6.1f} us, "
+                f"one field {field_time / count * 1e6:6.1f} us per token"
+            )
+
+    def rewrite(self):
+        """
+        Re-encodes every stored token in ID-ordered batches.
+        """
+        last_id = 0
+        rewritten = 0
+        while True:
+            tokens = list(Token.objects.filter(id__gt=last_id).order_by("id").only("id", "token_info")[:REWRITE_BATCH_SIZE])
+            if not tokens:
+                break
+            last_id = tokens[-1].id
+            for token in tokens:
+                token.token_info = encode_token_info(decode_token_info(token.token_info))
+            Token.objects.bulk_update(tokens, ["token_info"])
+            rewritten += len(tokens)
+        self.stdout.write(self.style.SUCCESS(f"Re-encoded {rewritten} tokens"))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from SSAPP.models import PDFPage
+from SSAPP.utils.documentAI import replay_page
+
+
+# To rebuild the tokens of pages from their stored Document AI results, without calling
+# Document AI, run the following management command:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py replay_documentai --all
+
+
+class Command(BaseCommand):
+    help = "Rebuild page tokens from stored Document AI results"
+
+    def add_arguments(self, parser):
+        parser.add_argument("page_ids", nargs="*", type=int, help="IDs of the pages to replay")
+        parser.add_argument("--file", type=int, dest="file_id", help="Replay every page of this PDF file")
+        parser.add_argument("--all", action="store_true", help="Replay every page")
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            page_ids = list(PDFPage.objects.order_by("id").values_list("id", flat=True))
+        elif options["file_id"]:
+            page_ids = list(
+                PDFPage.objects.filter(pdf_file_id=options["file_id"]).order_by("page_number").values_list("id", flat=True)
+            )
+        else:
+            page_ids = options["page_ids"]
+        if not page_ids:
+            raise CommandError("Give page IDs, --file or --all")
+
+        replayed = missing = 0
+        for page_id in page_ids:
+            try:
+                token_count = replay_page(page_id)
+            except LookupError as e:
+                missing += 1
+                self.stdout.write(self.style.WARNING(str(e)))
+                continue
+            except Exception as e:
+                raise CommandError(f"Failed to replay page {page_id}: {e}")
+            replayed += 1
+            self.stdout.write(f"Page {page_id}: {token_count} tokens")
+
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} pages, {missing} without a stored result"))
@@ -0,0 +1,65 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from SSAPP.utils.gpt_cache import gpt_cache_status
+from SSAPP.utils.http_session import retry_stats
+from SSAPP.utils.scan_queue import (
+    claim_jobs,
+    default_worker_id,
+    recover_stale_leases,
+    run_jobs,
+    scan_batch_size,
+)
+
+
+# To start a worker, run the following management command:
+# docker-compose exec web python /code/documentai-backend/SSDjango/manage.py scan_worker
+# The worker service in docker-compose.yml runs one alongside the backend. Any number of
+# workers can run against the same database, on one or several machines.
+
+
+class Command(BaseCommand):
+    help = "Process queued scan jobs until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--worker-id", default=None, help="Identifier recorded as the lease owner")
+        parser.add_argument("--lease-seconds", type=int, default=300, help="Lease duration before a job is considered stale")
+        parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per job before it is marked failed")
+        parser.add_argument(
+            "--batch-size", type=int, default=None,
+            help="Jobs claimed at once; defaults to enough to keep the configured scan concurrency busy",
+        )
+        parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        worker_id = options["worker_id"] or default_worker_id()
+        lease_seconds = options["lease_seconds"]
+        max_attempts = options["max_attempts"]
+
+        self.stdout.write(f"Scan worker {worker_id} started")
+        try:
+            while True:
+                close_old_connections()
+                recover_stale_leases(max_attempts)
+
+                batch_size = options["batch_size"] or scan_batch_size()
+                jobs = claim_jobs(worker_id, lease_seconds, batch_size)
+                if not jobs:
+                    if options["burst"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                retries_before = retry_stats.retries
+                results = run_jobs(jobs, worker_id, lease_seconds, max_attempts)
+                for page_id, result in results.items():
+                    self.stdout.write(f"Page {page_id}: {result}")
+                if retry_stats.retries != retries_before:
+                    self.stdout.write(f"OpenAI retry stats: {retry_stats.as_dict()}")
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted, unfinished jobs will be recovered once their lease expires")
+
+        self.stdout.write(f"OpenAI retry stats: {retry_stats.as_dict()}")
+        self.stdout.write(f"GPT cache: {gpt_cache_status()}")
+        self.stdout.write(self.style.SUCCESS(f"Scan worker {worker_id} stopped"))
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0008_settings_gpt_max_tokens_settings_gpt_messages_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='scan_workers',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0009_settings_scan_workers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('ocr', 'Document AI'), ('filter', 'Token filtering'), ('gpt', 'GPT processing'), ('done', 'Done')], default='ocr', max_length=16)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('lease_owner', models.CharField(blank=True, max_length=255, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('page', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scan_jobs', to='SSAPP.pdfpage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'lease_expires_at'], name='SSAPP_scanj_state_0e5d14_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0010_scanjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='filter_workers',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='gpt_workers',
+            field=models.IntegerField(default=4),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='ocr_workers',
+            field=models.IntegerField(default=2),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='pipeline_queue_size',
+            field=models.IntegerField(default=8),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='scan_pipeline',
+            field=models.BooleanField(default=False),
+        ),
+    ]
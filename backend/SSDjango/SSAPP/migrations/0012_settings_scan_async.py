@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0011_settings_scan_pipeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='async_concurrency',
+            field=models.IntegerField(default=32),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='scan_async',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0012_settings_scan_async'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='documentai_batch_pages',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0014_configversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appkeys',
+            name='extra_openai_api_keys',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='gpt_requests_per_minute',
+            field=models.IntegerField(default=500),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='gpt_tokens_per_minute',
+            field=models.IntegerField(default=30000),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0015_openai_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='gpt_cache_enabled',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='gpt_cache_max_mb',
+            field=models.IntegerField(default=256),
+        ),
+        migrations.CreateModel(
+            name='GPTCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(max_length=64)),
+                ('response', models.TextField()),
+                ('input_tokens', models.IntegerField()),
+                ('output_tokens', models.IntegerField()),
+                ('size', models.IntegerField()),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='SSAPP_gptca_last_us_fae032_idx')],
+            },
+        ),
+    ]
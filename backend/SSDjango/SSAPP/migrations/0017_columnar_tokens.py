@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0016_gptcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfpage',
+            name='token_blob',
+            field=models.FileField(blank=True, null=True, upload_to='token_blobs/'),
+        ),
+        migrations.AddField(
+            model_name='settings',
+            name='token_storage',
+            field=models.CharField(choices=[('rows', 'Token rows'), ('columnar', 'Columnar token blob')], default='rows', max_length=16),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:38
+
+import json
+from django.db import migrations, models
+
+BACKFILL_BATCH_SIZE = 2000
+
+
+def backfill_token_columns(apps, schema_editor):
+    """
+    Copies the queried token_info fields of existing tokens into the new columns.
+    """
+    Token = apps.get_model("SSAPP", "Token")
+    fields = ["text", "token_confidence", "color_red", "color_green", "color_blue", "font_size", "handwritten"]
+    # Batches are read by ID rather than with iterator(), since SQLite does not isolate a
+    # running query from updates to the same table
+    last_id = 0
+    while True:
+        tokens = list(Token.objects.filter(id__gt=last_id).order_by("id").only("id", "token_info")[:BACKFILL_BATCH_SIZE])
+        if not tokens:
+            break
+        last_id = tokens[-1].id
+
+        batch = []
+        for token in tokens:
+            try:
+                data = json.loads(token.token_info)
+                style_info = data["style_info"]
+                token.text = data["text"]
+                token.token_confidence = data["layout"]["confidence"]
+                token.color_red = style_info["text_color"]["red"]
+                token.color_green = style_info["text_color"]["green"]
+                token.color_blue = style_info["text_color"]["blue"]
+                token.font_size = style_info["font_size"]
+                token.handwritten = style_info["handwritten"]
+            except (ValueError, KeyError, TypeError):
+                # Leave tokens with incomplete info at the column defaults
+                continue
+            batch.append(token)
+        Token.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0017_columnar_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='token',
+            name='color_blue',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='color_green',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='color_red',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='font_size',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='handwritten',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(backfill_token_columns, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['page', 'filtered'], name='SSAPP_token_page_id_3afd8b_idx'),
+        ),
+    ]
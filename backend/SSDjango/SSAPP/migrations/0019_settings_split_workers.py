@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0018_token_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='split_workers',
+            field=models.IntegerField(default=4),
+        ),
+    ]
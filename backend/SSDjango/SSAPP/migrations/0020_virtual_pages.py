@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0019_settings_split_workers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settings',
+            name='virtual_pages',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='pdfpage',
+            name='file',
+            field=models.FileField(blank=True, upload_to='pdf_pages/'),
+        ),
+    ]
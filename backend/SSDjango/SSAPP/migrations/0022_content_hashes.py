@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0021_chunked_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdffile',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='pdfpage',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
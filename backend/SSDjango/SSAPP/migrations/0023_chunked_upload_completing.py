@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SSAPP', '0022_content_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='completing',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,7 +1,11 @@
+from django.conf import settings as django_settings
 from django.db import models
 from django.contrib.auth.hashers import make_password, check_password
 import os
 import json
+import uuid
+from .utils.page_files import delete_page_caches
+from .utils.token_codec import encode_token_info, decode_token_info, decode_token_info_field
 
 # To delete all objects in all models, run the following management command:
 # docker-compose exec web python /code/documentai-backend/SSDjango/manage.py delete_all
@@ -14,10 +18,13 @@ import json
 class PDFFile(models.Model):
     name = models.CharField(max_length=255)
     file = models.FileField(upload_to="pdfs/")
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)  # Content hash, to recognise re-uploads
 
     def delete(self, *args, **kwargs):
-        for page in self.pages.all():
-            page.delete()
+        pages = list(self.pages.all())
+        delete_page_caches(pages)
+        for page in pages:
+            page.delete_files()
         if os.path.isfile(self.file.path):
             os.remove(self.file.path)
         super().delete(*args, **kwargs)
@@ -34,9 +41,11 @@ class PDFPage(models.Model):
     scan_start_time = models.DateTimeField(null=True, blank=True)
     scan_end_time = models.DateTimeField(null=True, blank=True)
     page_number = models.IntegerField()
-    file = models.FileField(upload_to="pdf_pages/")
+    file = models.FileField(upload_to="pdf_pages/", blank=True)  # Empty for virtual pages
     thumbnail = models.ImageField(upload_to="thumbnails/", null=True, blank=True)
     high_res_image = models.ImageField(upload_to='high_res_images/', null=True, blank=True)
+    token_blob = models.FileField(upload_to="token_blobs/", null=True, blank=True)  # Columnar tokens, see utils/token_store.py
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)  # Hash of the page's PDF file; set on first extraction for virtual pages
     
     cost = models.FloatField(default=0.0)
 
@@ -46,11 +55,20 @@ class PDFPage(models.Model):
             return round((self.scan_end_time - self.scan_start_time).total_seconds())
         return None
         
-    def delete(self, *args, **kwargs):
-        if os.path.isfile(self.file.path):
+    def delete_files(self):
+        """
+        Removes the page's own files. Its cached files are removed by `delete_page_caches`.
+        """
+        if self.file and os.path.isfile(self.file.path):
             os.remove(self.file.path)
         if self.thumbnail and os.path.isfile(self.thumbnail.path):
             os.remove(self.thumbnail.path)
+        if self.token_blob and os.path.isfile(self.token_blob.path):
+            os.remove(self.token_blob.path)
+
+    def delete(self, *args, **kwargs):
+        delete_page_caches([self])
+        self.delete_files()
         super().delete(*args, **kwargs)
 
     def __str__(self):
@@ -68,11 +86,34 @@ class Token(models.Model):
     filtered = models.BooleanField(default=False)
     token_confidence = models.FloatField(default=0.0)
 
+    # Copies of the token_info fields read by filtering and text generation, so they can be
+    # queried without parsing the JSON
+    text = models.TextField(default="", blank=True)
+    color_red = models.FloatField(default=0.0)
+    color_green = models.FloatField(default=0.0)
+    color_blue = models.FloatField(default=0.0)
+    font_size = models.FloatField(default=0.0)
+    handwritten = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [models.Index(fields=["page", "filtered"])]
+
     def set_token_info(self, data):
-        self.token_info = json.dumps(data)
+        self.token_info = encode_token_info(data)
+        style_info = data["style_info"]
+        self.text = data["text"]
+        self.token_confidence = data["layout"]["confidence"]
+        self.color_red = style_info["text_color"]["red"]
+        self.color_green = style_info["text_color"]["green"]
+        self.color_blue = style_info["text_color"]["blue"]
+        self.font_size = style_info["font_size"]
+        self.handwritten = style_info["handwritten"]
 
     def get_token_info(self):
-        return json.loads(self.token_info)
+        return decode_token_info(self.token_info)
+
+    def get_token_info_field(self, *path):
+        return decode_token_info_field(self.token_info, *path)
     
 
 class GPTResponse(models.Model):
@@ -92,6 +133,7 @@ class GPTResponse(models.Model):
 class AppKeys(models.Model):
     openai_api_key = models.CharField(max_length=128)
     cred_file = models.FileField(upload_to='creds/')  # JSON credential file
+    extra_openai_api_keys = models.JSONField(default=list, blank=True)  # Further keys to spread GPT calls over
 
 
 class Settings(models.Model):
@@ -108,6 +150,10 @@ class Settings(models.Model):
     processor_id = models.CharField(max_length=64)
     processor_version = models.CharField(max_length=64)
     mime_type = models.CharField(max_length=64)
+    documentai_batch_pages = models.IntegerField(default=1)
+    token_storage = models.CharField(
+        max_length=16, choices=[("rows", "Token rows"), ("columnar", "Columnar token blob")], default="rows"
+    )
 
     # Token filtering settings
     color_filter = models.BooleanField(default=True)
@@ -121,3 +167,119 @@ class Settings(models.Model):
     gpt_max_tokens = models.IntegerField(default=2048)
     gpt_model = models.CharField(max_length=64, default='gpt-3.5-turbo')
     gpt_messages = models.JSONField(default=list)
+    gpt_requests_per_minute = models.IntegerField(default=500)  # Used until the API reports its limits
+    gpt_tokens_per_minute = models.IntegerField(default=30000)
+    gpt_cache_enabled = models.BooleanField(default=True)
+    gpt_cache_max_mb = models.IntegerField(default=256)
+
+    # Upload settings
+    split_workers = models.IntegerField(default=4)  # Processes splitting an uploaded PDF into pages
+    virtual_pages = models.BooleanField(default=False)  # Cut page PDFs from the upload only when needed
+
+    # Scan processing settings
+    scan_workers = models.IntegerField(default=1)
+    scan_pipeline = models.BooleanField(default=False)
+    ocr_workers = models.IntegerField(default=2)
+    filter_workers = models.IntegerField(default=1)
+    gpt_workers = models.IntegerField(default=4)
+    pipeline_queue_size = models.IntegerField(default=8)
+    scan_async = models.BooleanField(default=False)
+    async_concurrency = models.IntegerField(default=32)
+
+
+class ScanJob(models.Model):
+    # Stages a page moves through, in order
+    STAGE_OCR = "ocr"
+    STAGE_FILTER = "filter"
+    STAGE_GPT = "gpt"
+    STAGE_DONE = "done"
+    STAGE_CHOICES = [
+        (STAGE_OCR, "Document AI"),
+        (STAGE_FILTER, "Token filtering"),
+        (STAGE_GPT, "GPT processing"),
+        (STAGE_DONE, "Done"),
+    ]
+
+    STATE_PENDING = "pending"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+    STATE_FAILED = "failed"
+    STATE_CANCELLED = "cancelled"
+    STATE_CHOICES = [
+        (STATE_PENDING, "Pending"),
+        (STATE_RUNNING, "Running"),
+        (STATE_DONE, "Done"),
+        (STATE_FAILED, "Failed"),
+        (STATE_CANCELLED, "Cancelled"),
+    ]
+
+    page = models.ForeignKey(PDFPage, on_delete=models.CASCADE, related_name="scan_jobs")
+    stage = models.CharField(max_length=16, choices=STAGE_CHOICES, default=STAGE_OCR)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=STATE_PENDING)
+    attempts = models.IntegerField(default=0)
+    lease_owner = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["state", "lease_expires_at"]),
+        ]
+
+    def __str__(self):
+        return f"Scan job for page {self.page_id} ({self.state}, {self.stage})"
+
+
+class ConfigVersion(models.Model):
+    # A single row whose version is bumped on every change to Settings or AppKeys, so that
+    # every process can tell when its cached configuration is out of date
+    version = models.BigIntegerField(default=0)
+
+
+class GPTCacheEntry(models.Model):
+    # A GPT response, keyed by a hash of everything that determines it, so that the same
+    # request is only paid for once
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=64)
+    response = models.TextField()
+    input_tokens = models.IntegerField()
+    output_tokens = models.IntegerField()
+    size = models.IntegerField()
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["last_used_at"]),
+        ]
+
+    def __str__(self):
+        return f"GPT cache entry {self.key[:12]} ({self.model})"
+
+
+class ChunkedUpload(models.Model):
+    # A PDF being uploaded in chunks. The chunks are written to `part_path` as they arrive, and
+    # `received` is the number of leading bytes stored, where an interrupted upload resumes
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)  # Hex digest of the whole file, checked on completion
+    received = models.BigIntegerField(default=0)
+    completing = models.BooleanField(default=False)  # Claimed by a completion request, see complete_upload
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def part_path(self):
+        return os.path.join(django_settings.MEDIA_ROOT, "uploads", f"{self.id}.part")
+
+    def delete(self, *args, **kwargs):
+        if os.path.isfile(self.part_path):
+            os.remove(self.part_path)
+        super().delete(*args, **kwargs)
+
+    def __str__(self):
+        return f"Upload of {self.name} ({self.received}/{self.size} bytes)"
@@ -1,8 +1,44 @@
 from rest_framework import serializers
 from .models import PDFFile, PDFPage, AppKeys, Settings, GPTResponse
 from django.core.files import File
+from django.db.models import Prefetch
+from django.urls import reverse
 import os
 
+def page_file_url(page, request=None):
+    """
+    Returns the URL of a page's PDF: its file, or the download endpoint for a virtual page.
+    """
+    url = page.file.url if page.file else reverse("pdfpage-download", args=[page.id])
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def page_thumbnail_url(page, request=None):
+    """
+    Returns the URL of a page's thumbnail: a stored one, or the endpoint rendering it on demand.
+    """
+    url = page.thumbnail.url if page.thumbnail else reverse("pdfpage-thumbnail", args=[page.id])
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def with_gpt_responses(pages):
+    """
+    Prefetches the GPT responses of a page queryset in one query, for `PDFPageSerializer`.
+    """
+    return pages.prefetch_related(
+        Prefetch("gpt_responses", queryset=GPTResponse.objects.order_by("id"), to_attr="prefetched_gpt_responses")
+    )
+
+
+def first_gpt_response(page):
+    """
+    Returns the first GPT response of a page, from the prefetched ones if there are any.
+    """
+    if hasattr(page, "prefetched_gpt_responses"):
+        return page.prefetched_gpt_responses[0] if page.prefetched_gpt_responses else None
+    return GPTResponse.objects.filter(page_id=page.id).first()
+
+
 class PDFPageSerializer(serializers.ModelSerializer):
     json_output = serializers.SerializerMethodField()
     gpt_cost = serializers.SerializerMethodField()
@@ -13,16 +49,24 @@ class PDFPageSerializer(serializers.ModelSerializer):
         model = PDFPage
         fields = ["id", "page_number", "file", "thumbnail", 'high_res_image', 'scanned', 'cost', 'processing_time', 'json_output', 'gpt_cost', 'documentAI_cost']
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Virtual pages have no file and new pages no stored thumbnail, so link the endpoints
+        # producing them instead
+        data["file"] = page_file_url(instance, self.context.get("request"))
+        data["thumbnail"] = page_thumbnail_url(instance, self.context.get("request"))
+        return data
+
     def get_json_output(self, obj):
-        gpt_response = GPTResponse.objects.filter(page_id=obj.id).first()
+        gpt_response = first_gpt_response(obj)
         if gpt_response:
             return gpt_response.json_response
         else:
             return None
 
     def get_gpt_cost(self, obj):
-        gpt_response = GPTResponse.objects.filter(page_id=obj.id).first()
-        return gpt_response.cost if obj.scanned else None
+        gpt_response = first_gpt_response(obj)
+        return gpt_response.cost if obj.scanned and gpt_response else None
 
     def get_documentAI_cost(self, obj):
         return obj.cost if obj.scanned else None
@@ -46,10 +90,11 @@ class PDFFileSerializer(serializers.ModelSerializer):
 class AppKeysSerializer(serializers.ModelSerializer):
     openai_api_key = serializers.CharField()
     cred_file = serializers.FileField()
+    extra_openai_api_keys = serializers.ListField(child=serializers.CharField(), required=False)
     
     class Meta:
         model = AppKeys
-        fields = ['openai_api_key', 'cred_file']
+        fields = ['openai_api_key', 'cred_file', 'extra_openai_api_keys']
 
 class SettingsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,28 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import AppKeys, Settings
+from .utils.config import bump_config_version
+
+
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+@receiver(post_save, sender=AppKeys)
+@receiver(post_delete, sender=AppKeys)
+def configuration_changed(sender, **kwargs):
+    """
+    Bumps the configuration version when the settings or keys change, so every process
+    reloads its configuration snapshot.
+    """
+    bump_config_version()
+
+
+@receiver(connection_created)
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """
+    Switches SQLite to write-ahead logging, so the scan threads and workers can read while
+    another connection writes.
+    """
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
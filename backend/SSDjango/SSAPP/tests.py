@@ -1,3 +1,1260 @@
-from django.test import TestCase
+import base64
+import dataclasses
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from unittest import mock
+import fitz  # PyMuPDF
+import numpy as np
+import requests
+import tiktoken
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from google.cloud import documentai
+from .models import PDFFile, PDFPage, Token, GPTResponse, GPTCacheEntry, AppKeys, Settings, ChunkedUpload, ScanJob, ConfigVersion
+from .utils import scan_queue
+from .utils.fake_apis import FakeDocumentAIServer, FakeOpenAIServer
+from .utils.async_pipeline import process_pages_util_async
+from .utils.chunked_upload import UploadError, complete_upload, start_upload, write_chunk
+from .utils.config import current_version, get_config
+from .utils.documentAI import DOCUMENTAI_PAGE_COST, convert_coordinates, group_page_ranges, initialize_configuration
+from .utils.documentai_store import split_document
+from .utils.filter_tokens import token_filter
+from .utils.gpt import count_tokens, release_unused_tokens
+from .utils.gpt_cache import evict, store_response
+from .utils.http_session import post_with_retries, retry_delay, retry_stats
+from .utils.rate_limit import RateLimiter, TokenBucket, choose_api_key, get_rate_limiter, _header_number
+from .utils.utils import process_pages_util, render_pdf_to_images, split_pdf
+from .utils.pdf_split import shard_pages
+from .utils.pipeline import PipelineStage, StagedPipeline
+from .utils.page_files import read_page_file, render_cache, render_page_image, thumbnail_cache, tile_cache
+from .utils.token_store import load_page_tokens
+from .utils.token_codec import encode_token_info, decode_token_info, decode_token_info_field
 
-# Create your tests here.
+
+def make_pdf(*page_texts):
+    """
+    Returns the bytes of a PDF with one page per text.
+    """
+    doc = fitz.open()
+    for text in page_texts:
+        page = doc.new_page()
+        page.insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def count_words(text, model):
+    """
+    Stands in for tiktoken token counting, which needs the BPE files.
+    """
+    return len(text.split())
+
+
+class TemporaryMediaMixin:
+    """
+    Keeps the files a test creates in a temporary MEDIA_ROOT.
+    """
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def create_pdf_pages(self, page_count=5):
+        """
+        Creates a PDF file with a stored single-page PDF for each of its pages.
+        """
+        texts = [f"Page {page_number} text" for page_number in range(1, page_count + 1)]
+        self.pdf_file = PDFFile(name="test.pdf")
+        self.pdf_file.file.save("test.pdf", ContentFile(make_pdf(*texts)))
+        self.page_ids = []
+        for page_number, text in enumerate(texts, start=1):
+            pdf_page = PDFPage(pdf_file=self.pdf_file, page_number=page_number)
+            pdf_page.file.save(f"test_page_{page_number}.pdf", ContentFile(make_pdf(text)))
+            self.page_ids.append(pdf_page.id)
+
+
+class FakeApiTestCase(TemporaryMediaMixin, TransactionTestCase):
+    """
+    Runs against the fake Document AI and OpenAI servers, with scan settings and five pages.
+    """
+    def setUp(self):
+        super().setUp()
+        self.openai_server = FakeOpenAIServer().start()
+        self.addCleanup(self.openai_server.stop)
+        self.documentai_server = FakeDocumentAIServer().start()
+        self.addCleanup(self.documentai_server.stop)
+
+        overrides = override_settings(
+            OPENAI_API_BASE=self.openai_server.api_base,
+            DOCUMENTAI_API_ENDPOINT=self.documentai_server.api_endpoint,
+            DOCUMENTAI_INSECURE_CHANNEL=True,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        Settings.objects.create(
+            project_id="project",
+            processor_id="processor",
+            processor_version="rc",
+            mime_type="application/pdf",
+            gpt_messages=["Fix the OCR text.", "Return the text as JSON."],
+        )
+        AppKeys.objects.create(openai_api_key="test-key", cred_file="creds/test.json")
+        self.create_pdf_pages()
+
+    def process_pages(self, page_ids):
+        with mock.patch("SSAPP.utils.async_pipeline.count_tokens", count_words), \
+                mock.patch("SSAPP.utils.async_pipeline.count_instruction_tokens", count_words):
+            return process_pages_util_async(page_ids, concurrency=3)
+
+
+class AsyncPipelineTests(FakeApiTestCase):
+    def test_processes_pages_against_fake_servers(self):
+        results = self.process_pages(self.page_ids)
+
+        self.assertEqual(results, {page_id: "Success" for page_id in self.page_ids})
+        self.assertEqual(len(self.documentai_server.requests), 5)
+        self.assertEqual(len(self.openai_server.requests), 10)
+
+        gpt_response = GPTResponse.objects.get(page_id=self.page_ids[1])
+        self.assertEqual(gpt_response.json_response["content"], "Page 2 text")
+        self.assertTrue(PDFPage.objects.get(id=self.page_ids[1]).tokens.exists())
+
+    def test_records_errors_per_page(self):
+        PDFPage.objects.filter(id=self.page_ids[0]).update(file="pdf_pages/missing.pdf")
+
+        results = self.process_pages(self.page_ids)
+
+        self.assertIn("Failed to process page", results[self.page_ids[0]])
+        for page_id in self.page_ids[1:]:
+            self.assertEqual(results[page_id], "Success")
+
+    def test_rescan_uses_stored_results(self):
+        self.process_pages(self.page_ids)
+        # Reset the pages like a re-scan from the queue does
+        Token.objects.all().delete()
+        GPTResponse.objects.all().delete()
+        results = self.process_pages(self.page_ids)
+
+        self.assertEqual(results, {page_id: "Success" for page_id in self.page_ids})
+        self.assertEqual(len(self.documentai_server.requests), 5)
+        self.assertEqual(len(self.openai_server.requests), 10)
+        self.assertEqual(GPTCacheEntry.objects.count(), 10)
+        self.assertEqual(GPTResponse.objects.get(page_id=self.page_ids[2]).cost, 0.0)
+
+    def test_processes_virtual_pages(self):
+        pdf_file = PDFFile(name="virtual.pdf")
+        pdf_file.file.save("virtual.pdf", ContentFile(make_pdf("First", "Second", "Third")))
+        page_ids = split_pdf(pdf_file, workers=1, virtual=True)
+
+        results = self.process_pages(page_ids)
+
+        self.assertEqual(results, {page_id: "Success" for page_id in page_ids})
+        self.assertEqual(GPTResponse.objects.get(page_id=page_ids[2]).json_response["content"], "Third")
+
+
+class ColumnarTokenStoreTests(FakeApiTestCase):
+    def test_columnar_token_storage(self):
+        settings_obj = Settings.objects.get()
+        settings_obj.token_storage = "columnar"
+        settings_obj.save()
+
+        results = self.process_pages(self.page_ids)
+
+        self.assertEqual(results, {page_id: "Success" for page_id in self.page_ids})
+        self.assertFalse(Token.objects.exists())
+        pdf_page = PDFPage.objects.get(id=self.page_ids[1])
+        self.assertEqual(load_page_tokens(pdf_page).texts(), ["Page ", "2 ", "text\n"])
+        self.assertEqual(GPTResponse.objects.get(page_id=pdf_page.id).json_response["content"], "Page 2 text")
+
+
+class DocumentAIBatchTests(FakeApiTestCase):
+    def test_batch_is_split_back_into_pages(self):
+        Settings.objects.update(documentai_batch_pages=3)
+        Settings.objects.get().save()
+
+        with mock.patch("SSAPP.utils.gpt.count_tokens", count_words), \
+                mock.patch("SSAPP.utils.gpt.count_instruction_tokens", count_words):
+            results = process_pages_util(self.page_ids)
+
+        self.assertEqual(results, {page_id: "Success" for page_id in self.page_ids})
+        # Pages 1-3 and 4-5 go in one request each
+        self.assertEqual(len(self.documentai_server.requests), 2)
+        for page_number, page_id in enumerate(self.page_ids, start=1):
+            pdf_page = PDFPage.objects.get(id=page_id)
+            self.assertEqual("".join(pdf_page.tokens.order_by("id").values_list("text", flat=True)), f"Page {page_number} text\n")
+            self.assertEqual(GPTResponse.objects.get(page=pdf_page).json_response["content"], f"Page {page_number} text")
+
+    def test_virtual_pages_are_not_extracted(self):
+        Settings.objects.update(documentai_batch_pages=3)
+        Settings.objects.get().save()
+        pdf_file = PDFFile(name="virtual.pdf")
+        pdf_file.file.save("virtual.pdf", ContentFile(make_pdf("First", "Second", "Third")))
+        page_ids = split_pdf(pdf_file, workers=1, virtual=True)
+
+        with mock.patch("SSAPP.utils.gpt.count_tokens", count_words), \
+                mock.patch("SSAPP.utils.gpt.count_instruction_tokens", count_words), \
+                mock.patch("SSAPP.utils.page_files.extract_page") as extract_page:
+            self.assertEqual(process_pages_util(page_ids), {page_id: "Success" for page_id in page_ids})
+            # A re-scan finds the stored result by the hashes it was stored under
+            Token.objects.all().delete()
+            self.assertEqual(process_pages_util(page_ids), {page_id: "Success" for page_id in page_ids})
+
+        extract_page.assert_not_called()
+        self.assertEqual(len(self.documentai_server.requests), 1)
+        self.assertEqual(PDFPage.objects.get(id=page_ids[2]).tokens.get().text, "Third\n")
+
+
+class SplitDocumentTests(SimpleTestCase):
+    def test_pages_keep_only_their_own_text(self):
+        def anchor(start, end):
+            return {"text_segments": [{"start_index": start, "end_index": end}]}
+
+        document = documentai.Document(
+            text="One two\nThree\n",
+            mime_type="application/pdf",
+            pages=[
+                {"layout": {"text_anchor": anchor(0, 8)}, "tokens": [
+                    {"layout": {"text_anchor": anchor(0, 4)}}, {"layout": {"text_anchor": anchor(4, 8)}},
+                ]},
+                {"layout": {"text_anchor": anchor(8, 14)}, "lines": [{"layout": {"text_anchor": anchor(8, 14)}}], "tokens": [
+                    {"layout": {"text_anchor": anchor(8, 14)}},
+                ]},
+            ],
+        )
+
+        first, second = split_document(document, 0), split_document(document, 1)
+
+        self.assertEqual((first.text, second.text), ("One two\n", "Three\n"))
+        segment = second.pages[0].tokens[0].layout.text_anchor.text_segments[0]
+        self.assertEqual(second.text[segment.start_index:segment.end_index], "Three\n")
+        self.assertEqual(second.pages[0].lines[0].layout.text_anchor.text_segments[0].end_index, 6)
+        segment = first.pages[0].tokens[1].layout.text_anchor.text_segments[0]
+        self.assertEqual(first.text[segment.start_index:segment.end_index], "two\n")
+        # The source document is left as it was
+        self.assertEqual(document.pages[1].tokens[0].layout.text_anchor.text_segments[0].start_index, 8)
+
+
+class ConvertCoordinatesTests(SimpleTestCase):
+    def test_matches_the_per_token_conversion(self):
+        rng = np.random.default_rng(0)
+        page_width, page_height = 612, 792.5
+        tokens = [
+            [documentai.NormalizedVertex(x=x, y=y) for x, y in rng.random((4, 2))]
+            for _ in range(50)
+        ]
+        # The conversion as it was done for one token at a time
+        expected = [
+            (
+                vertices[0].x * page_width, page_height - vertices[0].y * page_height,
+                vertices[2].x * page_width, page_height - vertices[2].y * page_height,
+            )
+            for vertices in tokens
+        ]
+
+        corners = [(vertices[0].x, vertices[0].y, vertices[2].x, vertices[2].y) for vertices in tokens]
+        converted = convert_coordinates(corners, str(page_width), page_height)
+
+        self.assertEqual(converted.shape, (50, 4))
+        np.testing.assert_allclose(converted, expected, rtol=0, atol=1e-9)
+
+    def test_rejects_invalid_input(self):
+        with self.assertRaises(ValueError):
+            convert_coordinates([(0.1, 0.2, 0.3)], 612, 792)
+        with self.assertRaises(TypeError):
+            convert_coordinates([(0.1, 0.2, 0.3, 0.4)], "wide", 792)
+
+
+class GroupPageRangesTests(TestCase):
+    def test_groups_runs_of_consecutive_pages(self):
+        first = PDFFile.objects.create(name="first.pdf", file="pdfs/first.pdf")
+        second = PDFFile.objects.create(name="second.pdf", file="pdfs/second.pdf")
+        pages = {
+            (pdf_file.name, page_number): PDFPage.objects.create(pdf_file=pdf_file, page_number=page_number).id
+            for pdf_file, page_numbers in [(first, [1, 2, 3, 4, 6]), (second, [1, 2])]
+            for page_number in page_numbers
+        }
+
+        groups = group_page_ranges([pages[key] for key in reversed(list(pages))] + [999999], max_pages=3)
+
+        self.assertEqual(groups, [
+            [pages["first.pdf", 1], pages["first.pdf", 2], pages["first.pdf", 3]],
+            [pages["first.pdf", 4]],
+            # A gap starts a new group, and so does another file
+            [pages["first.pdf", 6]],
+            [pages["second.pdf", 1], pages["second.pdf", 2]],
+            # Missing pages are kept so their errors are reported
+            [999999],
+        ])
+        self.assertEqual(group_page_ranges([], max_pages=3), [])
+
+
+class SplitPdfTests(TemporaryMediaMixin, TestCase):
+    def test_shard_pages_edge_cases(self):
+        self.assertEqual(shard_pages(10, 3), [(0, 4), (4, 7), (7, 10)])
+        # More shards than pages give one page per shard
+        self.assertEqual(shard_pages(3, 8), [(0, 1), (1, 2), (2, 3)])
+        # Without pages, the single shard is empty
+        self.assertEqual(shard_pages(0, 4), [(0, 0)])
+        self.assertEqual(shard_pages(5, 0), [(0, 5)])
+
+    def test_workers_give_the_same_pages(self):
+        texts = [f"Page {page_number} text" for page_number in range(1, 13)]
+        pdf_file = PDFFile(name="split.pdf")
+        pdf_file.file.save("split.pdf", ContentFile(make_pdf(*texts)))
+
+        def split_pages(workers):
+            page_ids = split_pdf(pdf_file, workers=workers, virtual=False)
+            pages = []
+            for page_id in page_ids:
+                pdf_page = PDFPage.objects.get(id=page_id)
+                with fitz.open(pdf_page.file.path) as doc:
+                    pages.append((pdf_page.page_number, pdf_page.sha256, doc[0].get_text().strip()))
+            return pages
+
+        serial = split_pages(1)
+        # Let the twelve pages be shared by three processes
+        with mock.patch("SSAPP.utils.utils.SPLIT_MIN_PAGES_PER_WORKER", 1), \
+                mock.patch("SSAPP.utils.utils.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as executor:
+            parallel = split_pages(3)
+        executor.assert_called_once_with(max_workers=3)
+
+        self.assertEqual([page[2] for page in serial], texts)
+        self.assertEqual(parallel, serial)
+
+
+class VirtualPageTests(TemporaryMediaMixin, TestCase):
+    def test_virtual_pages_are_extracted_on_download(self):
+        pdf_file = PDFFile(name="virtual.pdf")
+        pdf_file.file.save("virtual.pdf", ContentFile(make_pdf("First", "Second", "Third")))
+        with mock.patch("SSAPP.utils.utils.split_page_range") as split_page_range:
+            page_ids = split_pdf(pdf_file, workers=1, virtual=True)
+        split_page_range.assert_not_called()
+        self.assertFalse(any(PDFPage.objects.filter(id__in=page_ids).values_list("file", flat=True)))
+        # A virtual page is hashed when it is first extracted
+        self.assertFalse(any(PDFPage.objects.filter(id__in=page_ids).values_list("sha256", flat=True)))
+        content = read_page_file(PDFPage.objects.get(id=page_ids[1]))
+        self.assertEqual(PDFPage.objects.get(id=page_ids[1]).sha256, hashlib.sha256(content).hexdigest())
+
+        response = self.client.get(f"/api/pages/{page_ids[1]}/download/")
+        self.assertEqual(response.status_code, 200)
+        with fitz.open(stream=b"".join(response.streaming_content), filetype="pdf") as doc:
+            self.assertEqual(doc.page_count, 1)
+            self.assertEqual(doc[0].get_text().strip(), "Second")
+
+
+class ThumbnailTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_pdf_pages(1)
+
+    def test_thumbnails_are_rendered_on_demand(self):
+        page_id = self.page_ids[0]
+        self.assertFalse(PDFPage.objects.get(id=page_id).thumbnail)
+
+        response = self.client.get(f"/api/pages/{page_id}/thumbnail/?size=100")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        image = Image.open(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(max(image.size), 128)
+
+        page = self.client.get(f"/api/pages/{page_id}/").json()
+        self.assertTrue(page["thumbnail"].endswith(f"/api/pages/{page_id}/thumbnail/"))
+
+    def test_identical_pages_share_cached_images_until_deleted(self):
+        def cached_files():
+            return {
+                cache.directory: sorted(path.name for path in cache.root.glob("*/*"))
+                for cache in (thumbnail_cache, render_cache, tile_cache)
+            }
+
+        pdf_files = []
+        for name in ["first.pdf", "second.pdf"]:
+            pdf_file = PDFFile(name=name)
+            pdf_file.file.save(name, ContentFile(make_pdf("Same")))
+            split_pdf(pdf_file, workers=1, virtual=False)
+            pdf_files.append(pdf_file)
+        for page in PDFPage.objects.filter(pdf_file__in=pdf_files):
+            self.assertEqual(self.client.get(f"/api/pages/{page.id}/thumbnail/").status_code, 200)
+            self.assertEqual(self.client.get(f"/api/pages/{page.id}/tiles/0/0_0/").status_code, 200)
+            render_pdf_to_images([page.id])
+        self.assertEqual([len(files) for files in cached_files().values()], [1, 1, 1])
+
+        shared = cached_files()
+        pdf_files[0].delete()
+        self.assertEqual(cached_files(), shared)
+        pdf_files[1].delete()
+        self.assertEqual(cached_files(), {cache: [] for cache in shared})
+
+
+class RenderCacheTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_pdf_pages()
+
+    def test_retrieve_reuses_rendered_images(self):
+        with mock.patch("SSAPP.utils.page_files.render_page_image", wraps=render_page_image) as render:
+            first = self.client.get(f"/api/pdfs/{self.pdf_file.id}/").json()
+            second = self.client.get(f"/api/pdfs/{self.pdf_file.id}/").json()
+        self.assertEqual(render.call_count, 5)
+        self.assertEqual(
+            [page["high_res_image"] for page in first["pages"]],
+            [page["high_res_image"] for page in second["pages"]],
+        )
+        self.assertIn("/api/media/render_cache/", first["pages"][0]["high_res_image"])
+
+    def test_delete_high_res_images_empties_the_render_cache(self):
+        self.client.get(f"/api/pdfs/{self.pdf_file.id}/")
+        response = self.client.delete("/api/pdfs/delete_high_res_images/")
+        self.assertEqual(response.status_code, 204)
+        with mock.patch("SSAPP.utils.page_files.render_page_image", wraps=render_page_image) as render:
+            self.client.get(f"/api/pdfs/{self.pdf_file.id}/")
+        self.assertEqual(render.call_count, 5)
+
+
+class TilePyramidTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_pdf_pages(1)
+
+    def test_tile_pyramid(self):
+        page_id = self.page_ids[0]
+        pyramid = self.client.get(f"/api/pages/{page_id}/tiles/").json()
+        # A fitz page is 595x842 points, rendered at 4 pixels per point
+        self.assertEqual((pyramid["width"], pyramid["height"], pyramid["max_level"]), (2380, 3368, 12))
+
+        tile_url = pyramid["tile_url"].format(level=12, col=1, row=1)
+        response = self.client.get(tile_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response["Cache-Control"])
+        tile = Image.open(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(tile.size, (258, 258))
+
+        full = Image.open(io.BytesIO(render_page_image(PDFPage.objects.get(id=page_id), 4, "PNG")))
+        # The tile holds the page text, which starts 72 points from the top left corner
+        expected = full.convert("L").crop((255, 255, 513, 513))
+        self.assertLess(min(expected.getdata()), 128)
+        difference = sum(abs(a - b) for a, b in zip(tile.convert("L").getdata(), expected.getdata()))
+        self.assertLess(difference / (258 * 258), 4)
+
+        self.assertEqual(self.client.get(f"/api/pages/{page_id}/tiles/12/20_0/").status_code, 404)
+
+
+class ChunkedUploadTests(TemporaryMediaMixin, TestCase):
+    def test_chunked_upload(self):
+        data = make_pdf("One", "Two", "Three")
+        upload = self.client.post("/api/pdfs/uploads/", {
+            "name": "chunked.pdf",
+            "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        }).json()
+        upload_url = f"/api/pdfs/uploads/{upload['id']}/"
+
+        def put_chunk(offset, chunk):
+            return self.client.put(f"{upload_url}?offset={offset}", chunk, content_type="application/octet-stream")
+
+        half = len(data) // 2
+        self.assertEqual(put_chunk(0, data[:half]).json()["offset"], half)
+        # A retried chunk is accepted, a chunk past the received bytes is not
+        self.assertEqual(put_chunk(0, data[:half]).json()["offset"], half)
+        response = put_chunk(half + 1, data[half + 1:])
+        self.assertEqual((response.status_code, response.json()["offset"]), (409, half))
+        self.assertEqual(self.client.post(f"{upload_url}complete/").status_code, 409)
+
+        self.assertEqual(self.client.get(upload_url).json()["offset"], half)
+        put_chunk(half, data[half:])
+        response = self.client.post(f"{upload_url}complete/")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.json()["pages"]), 3)
+        with open(PDFFile.objects.get(name="chunked.pdf").file.path, "rb") as file:
+            self.assertEqual(file.read(), data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_concurrent_completions(self):
+        data = make_pdf("One")
+        upload = start_upload("race.pdf", len(data), hashlib.sha256(data).hexdigest())
+        write_chunk(upload, 0, io.BytesIO(data), len(data))
+        # A second request read the upload before the first one claimed it
+        stale = ChunkedUpload.objects.get(id=upload.id)
+
+        ChunkedUpload.objects.filter(id=upload.id).update(completing=True)
+        response = self.client.post(f"/api/pdfs/uploads/{upload.id}/complete/")
+        self.assertEqual(response.status_code, 409)
+        with self.assertRaises(UploadError):
+            write_chunk(ChunkedUpload.objects.get(id=upload.id), 0, io.BytesIO(data), len(data))
+
+        ChunkedUpload.objects.filter(id=upload.id).update(completing=False)
+        pdf_file, created = complete_upload(ChunkedUpload.objects.get(id=upload.id))
+        self.assertTrue(created)
+        # The losing request gets the finished file instead of a missing part file
+        self.assertEqual(complete_upload(stale), (pdf_file, False))
+
+    def test_completion_rechecks_the_name(self):
+        data = make_pdf("One")
+        upload = start_upload("taken.pdf", len(data), hashlib.sha256(data).hexdigest())
+        write_chunk(upload, 0, io.BytesIO(data), len(data))
+        PDFFile.objects.create(name="taken.pdf", file="pdfs/taken.pdf", sha256="0" * 64)
+
+        response = self.client.post(f"/api/pdfs/uploads/{upload.id}/complete/")
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("taken.pdf already exists with different content", response.json()["error"])
+        self.assertEqual(PDFFile.objects.count(), 1)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+
+class ContentHashTests(TemporaryMediaMixin, TestCase):
+    def test_duplicate_uploads_are_linked(self):
+        data = make_pdf("One", "Two")
+        first = self.client.post("/api/pdfs/", {"file": ContentFile(data, name="first.pdf")}).json()[0]
+        page = PDFPage.objects.get(id=first["pages"][1])
+        page.scanned = True
+        page.cost = 0.5
+        page.save()
+        GPTResponse.objects.create(page=page, json_response={"content": "Two"}, cost=0.25)
+
+        # The same content under another name is not stored again
+        renamed = self.client.post("/api/pdfs/", {"file": ContentFile(data, name="renamed.pdf")}).json()[0]
+        self.assertEqual((renamed["duplicate_of"], renamed["pages"]), (first["id"], first["pages"]))
+        self.assertFalse(PDFFile.objects.filter(name="renamed.pdf").exists())
+
+        # A different file sharing a page gets that page's scan results
+        other = self.client.post("/api/pdfs/", {"file": ContentFile(make_pdf("Zero", "Two"), name="other.pdf")}).json()[0]
+        linked = PDFPage.objects.get(id=other["pages"][1])
+        self.assertEqual(linked.sha256, page.sha256)
+        self.assertTrue(linked.scanned)
+        self.assertEqual(linked.cost, 0.0)
+        self.assertEqual(GPTResponse.objects.get(page=linked).json_response, {"content": "Two"})
+        self.assertFalse(PDFPage.objects.get(id=other["pages"][0]).scanned)
+
+    def test_same_name_with_different_content_conflicts(self):
+        self.client.post("/api/pdfs/", {"file": ContentFile(make_pdf("One"), name="first.pdf")})
+        response = self.client.post("/api/pdfs/", {"file": ContentFile(make_pdf("Two"), name="first.pdf")})
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("different content", response.json()[0]["error"])
+
+        # Alongside a stored file the conflict is reported in its own entry
+        response = self.client.post("/api/pdfs/", {"file": [
+            ContentFile(make_pdf("Two"), name="first.pdf"),
+            ContentFile(make_pdf("Three"), name="third.pdf"),
+        ]})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("error", response.json()[0])
+        self.assertEqual(response.json()[1]["name"], "third.pdf")
+        self.assertEqual(PDFFile.objects.count(), 2)
+
+    def test_uploads_are_hashed_when_body_was_parsed_early(self):
+        data = make_pdf("One", "Two")
+        first = self.client.post("/api/pdfs/", {"file": ContentFile(data, name="first.pdf")}).json()[0]
+
+        # As if middleware had read request.FILES before the hashing handler was added
+        with mock.patch("SSAPP.views.Sha256UploadHandler.file_complete", return_value=None):
+            responses = self.client.post("/api/pdfs/", {"file": [
+                ContentFile(data, name="again.pdf"),
+                ContentFile(make_pdf("Three"), name="new.pdf"),
+            ]}).json()
+
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(responses[0]["duplicate_of"], first["id"])
+        new_file = PDFFile.objects.get(name="new.pdf")
+        with open(new_file.file.path, "rb") as file:
+            self.assertEqual(new_file.sha256, hashlib.sha256(file.read()).hexdigest())
+
+
+class ProcessPagesUtilTests(TestCase):
+    def setUp(self):
+        Settings.objects.create(scan_workers=3)
+        pdf_file = PDFFile.objects.create(name="test.pdf", file="pdfs/test.pdf")
+        self.page_ids = [
+            PDFPage.objects.create(pdf_file=pdf_file, page_number=page_number, file=f"pdf_pages/test_{page_number}.pdf").id
+            for page_number in range(1, 7)
+        ]
+
+    def test_pages_run_concurrently_on_the_pool(self):
+        # Every call waits until three run at once, which fails unless the pool runs them together
+        barrier = threading.Barrier(3, timeout=5)
+        threads = set()
+
+        def process_page_group(page_ids, config, on_stage_done=None):
+            threads.add(threading.current_thread().name)
+            barrier.wait()
+            return {page_id: "Success" if page_id != self.page_ids[4] else "Failed" for page_id in page_ids}
+
+        with mock.patch("SSAPP.utils.utils.process_page_group", side_effect=process_page_group):
+            results = process_pages_util(list(reversed(self.page_ids)))
+
+        self.assertEqual(len(threads), 3)
+        # The results follow the requested order
+        self.assertEqual(list(results), list(reversed(self.page_ids)))
+        self.assertEqual(results[self.page_ids[4]], "Failed")
+
+    def test_should_continue_stops_new_pages(self):
+        started = []
+
+        def process_page_group(page_ids, config, on_stage_done=None):
+            started.extend(page_ids)
+            return {page_id: "Success" for page_id in page_ids}
+
+        with mock.patch("SSAPP.utils.utils.process_page_group", side_effect=process_page_group):
+            results = process_pages_util(self.page_ids, max_workers=1, should_continue=lambda: len(started) < 2)
+            self.assertEqual(results, {self.page_ids[0]: "Success", self.page_ids[1]: "Success"})
+
+            self.assertEqual(process_pages_util(self.page_ids, should_continue=lambda: False), {})
+        self.assertEqual(len(started), 2)
+
+
+class StagedPipelineTests(TransactionTestCase):
+    def setUp(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def stage(self, name, fail_on=()):
+        def run(item):
+            with self.lock:
+                self.events.append((name, item))
+            page_ids = item if isinstance(item, list) else [item]
+            if set(page_ids) & set(fail_on):
+                raise RuntimeError(f"{name} failed")
+        return run
+
+    def assert_pipeline_threads_stopped(self):
+        self.assertFalse([thread.name for thread in threading.enumerate() if thread.name.startswith("pipeline-")])
+
+    def test_pages_pass_every_stage_in_order(self):
+        pipeline = StagedPipeline([
+            PipelineStage("ocr", self.stage("ocr"), 2, batched=True),
+            PipelineStage("filter", self.stage("filter"), 1),
+            PipelineStage("gpt", self.stage("gpt"), 3),
+        ], queue_size=1)
+
+        results = pipeline.run([[1, 2], [3], [4, 5, 6]])
+
+        self.assertEqual(results, {page_id: "Success" for page_id in range(1, 7)})
+        for page_id in range(1, 7):
+            stages = [name for name, item in self.events if page_id == item or isinstance(item, list) and page_id in item]
+            self.assertEqual(stages, ["ocr", "filter", "gpt"])
+        self.assert_pipeline_threads_stopped()
+
+    def test_failed_pages_skip_later_stages(self):
+        completed = set()
+
+        def on_stage_done(page_ids, stage):
+            with self.lock:
+                completed.update((page_id, stage) for page_id in page_ids)
+
+        pipeline = StagedPipeline([
+            PipelineStage("ocr", self.stage("ocr", fail_on=[3]), 1, batched=True),
+            PipelineStage("gpt", self.stage("gpt", fail_on=[1]), 2),
+        ], queue_size=2, on_stage_done=on_stage_done)
+
+        results = pipeline.run([[1, 2], [3, 4], [5]])
+
+        self.assertEqual(results[1], "Failed to process page 1: gpt failed")
+        # Every page of a failed batch fails
+        self.assertEqual(results[3], "Failed to process page 3: ocr failed")
+        self.assertEqual(results[4], "Failed to process page 4: ocr failed")
+        self.assertEqual((results[2], results[5]), ("Success", "Success"))
+        self.assertNotIn(("gpt", 3), self.events)
+        # Only the stages a page got through are reported
+        self.assertEqual(completed, {(1, "ocr"), (2, "ocr"), (2, "gpt"), (5, "ocr"), (5, "gpt")})
+        self.assert_pipeline_threads_stopped()
+
+    def test_should_continue_shuts_the_pipeline_down(self):
+        admitted = []
+
+        def should_continue():
+            admitted.append(None)
+            return len(admitted) <= 2
+
+        pipeline = StagedPipeline([
+            PipelineStage("ocr", self.stage("ocr"), 2),
+            PipelineStage("gpt", self.stage("gpt"), 2),
+        ], queue_size=1, should_continue=should_continue)
+
+        results = pipeline.run([1, 2, 3, 4, 5])
+
+        self.assertEqual(results, {1: "Success", 2: "Success"})
+        self.assertEqual(sorted(item for name, item in self.events if name == "gpt"), [1, 2])
+        self.assert_pipeline_threads_stopped()
+
+
+class ScanQueueTests(TestCase):
+    def setUp(self):
+        pdf_file = PDFFile.objects.create(name="test.pdf", file="pdfs/test.pdf")
+        self.pages = [
+            PDFPage.objects.create(pdf_file=pdf_file, page_number=page_number, file=f"pdf_pages/test_{page_number}.pdf")
+            for page_number in range(1, 4)
+        ]
+
+    def test_racing_workers_claim_different_jobs(self):
+        first, second = [ScanJob.objects.create(page=page) for page in self.pages[:2]]
+        try_claim = scan_queue._try_claim
+        raced = []
+
+        def claim_while_b_wins(job_id, worker_id, lease_seconds):
+            if worker_id == "worker-a" and not raced:
+                # Worker B claims the job after A has read it as pending, but before A's update
+                raced.append(job_id)
+                self.assertEqual(scan_queue.claim_job("worker-b", 300).id, job_id)
+            return try_claim(job_id, worker_id, lease_seconds)
+
+        with mock.patch("SSAPP.utils.scan_queue._try_claim", side_effect=claim_while_b_wins):
+            claimed = scan_queue.claim_job("worker-a", 300)
+
+        self.assertEqual(claimed.id, second.id)
+        first.refresh_from_db()
+        self.assertEqual((first.state, first.lease_owner, first.attempts), (ScanJob.STATE_RUNNING, "worker-b", 1))
+        self.assertEqual((claimed.lease_owner, claimed.attempts), ("worker-a", 1))
+        self.assertIsNone(scan_queue.claim_job("worker-c", 300))
+
+    def test_recovers_stale_leases(self):
+        expired = timezone.now() - timedelta(seconds=1)
+        retried = ScanJob.objects.create(page=self.pages[0], state=ScanJob.STATE_RUNNING, attempts=1, lease_owner="gone", lease_expires_at=expired)
+        exhausted = ScanJob.objects.create(page=self.pages[1], state=ScanJob.STATE_RUNNING, attempts=3, lease_owner="gone", lease_expires_at=expired)
+        live = ScanJob.objects.create(
+            page=self.pages[2], state=ScanJob.STATE_RUNNING, attempts=1, lease_owner="alive",
+            lease_expires_at=timezone.now() + timedelta(minutes=5),
+        )
+
+        self.assertEqual(scan_queue.recover_stale_leases(max_attempts=3), 1)
+
+        retried.refresh_from_db()
+        self.assertEqual((retried.state, retried.lease_owner), (ScanJob.STATE_PENDING, None))
+        exhausted.refresh_from_db()
+        self.assertEqual(exhausted.state, ScanJob.STATE_FAILED)
+        self.assertIn("final attempt", exhausted.last_error)
+        live.refresh_from_db()
+        self.assertEqual((live.state, live.lease_owner), (ScanJob.STATE_RUNNING, "alive"))
+
+    def test_retried_job_resumes_at_saved_stage(self):
+        ScanJob.objects.create(page=self.pages[0], stage=ScanJob.STAGE_FILTER, attempts=1)
+        stages = {stage: mock.Mock() for stage, _ in scan_queue.STAGES}
+
+        with mock.patch("SSAPP.utils.scan_queue.STAGES", list(stages.items())):
+            job = scan_queue.claim_job("worker", 300)
+            result = scan_queue.run_job(job, "worker", 300, max_attempts=3)
+
+        self.assertEqual(result, "Success")
+        stages[ScanJob.STAGE_OCR].assert_not_called()
+        stages[ScanJob.STAGE_FILTER].assert_called_once()
+        stages[ScanJob.STAGE_GPT].assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.stage, job.attempts), (ScanJob.STATE_DONE, ScanJob.STAGE_DONE, 2))
+        pdf_page = PDFPage.objects.get(id=self.pages[0].id)
+        self.assertTrue(pdf_page.scanned)
+        self.assertEqual(pdf_page.cost, DOCUMENTAI_PAGE_COST)
+
+    def test_failed_stage_is_retried_until_max_attempts(self):
+        ScanJob.objects.create(page=self.pages[0])
+        stages = [(stage, mock.Mock()) for stage, _ in scan_queue.STAGES]
+        stages[1][1].side_effect = RuntimeError("filter failed")
+
+        with mock.patch("SSAPP.utils.scan_queue.STAGES", stages):
+            for attempt in range(2):
+                job = scan_queue.claim_job("worker", 300)
+                self.assertIn("filter failed", scan_queue.run_job(job, "worker", 300, max_attempts=2))
+
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.stage, job.attempts), (ScanJob.STATE_FAILED, ScanJob.STAGE_FILTER, 2))
+        # The second attempt resumed after Document AI
+        self.assertEqual(stages[0][1].call_count, 1)
+        self.assertFalse(PDFPage.objects.get(id=self.pages[0].id).scanned)
+
+    def test_fresh_jobs_run_as_one_batch(self):
+        fresh = [ScanJob.objects.create(page=page) for page in self.pages[:2]]
+        ScanJob.objects.create(page=self.pages[2], stage=ScanJob.STAGE_GPT)
+        jobs = scan_queue.claim_jobs("worker", 300, limit=10)
+        self.assertEqual(len(jobs), 3)
+
+        batch_results = {fresh[0].page_id: "Success", fresh[1].page_id: "Failed to process page: boom"}
+        with mock.patch("SSAPP.utils.scan_queue.process_pages_util", return_value=batch_results) as process, \
+                mock.patch("SSAPP.utils.scan_queue.run_job", return_value="Success") as run_job:
+            results = scan_queue.run_jobs(jobs, "worker", 300, max_attempts=3)
+
+        self.assertEqual(process.call_args.args[0], [fresh[0].page_id, fresh[1].page_id])
+        self.assertEqual(run_job.call_args.args[0].page_id, self.pages[2].id)
+        self.assertEqual(results, {**batch_results, self.pages[2].id: "Success"})
+        self.assertEqual(
+            list(ScanJob.objects.filter(id__in=[job.id for job in fresh]).order_by("id").values_list("state", flat=True)),
+            [ScanJob.STATE_DONE, ScanJob.STATE_PENDING],
+        )
+        self.assertTrue(PDFPage.objects.get(id=fresh[0].page_id).scanned)
+
+    def test_fresh_jobs_save_their_stage(self):
+        Settings.objects.create(scan_workers=1, documentai_batch_pages=1)
+        fresh = [ScanJob.objects.create(page=page) for page in self.pages[:2]]
+
+        def filter_tokens(page_id, config):
+            if page_id == fresh[1].page_id:
+                raise RuntimeError("filter failed")
+
+        with mock.patch("SSAPP.utils.utils.process_page_range") as process_page_range, \
+                mock.patch("SSAPP.utils.utils.token_filter", side_effect=filter_tokens), \
+                mock.patch("SSAPP.utils.utils.gpt_token_processing"):
+            jobs = scan_queue.claim_jobs("worker", 300, limit=10)
+            results = scan_queue.run_jobs(jobs, "worker", 300, max_attempts=3)
+        self.assertEqual(process_page_range.call_count, 2)
+        self.assertIn("filter failed", results[fresh[1].page_id])
+
+        self.assertEqual(
+            list(ScanJob.objects.filter(id__in=[job.id for job in fresh]).order_by("id").values_list("state", "stage")),
+            [(ScanJob.STATE_DONE, ScanJob.STAGE_DONE), (ScanJob.STATE_PENDING, ScanJob.STAGE_FILTER)],
+        )
+
+        # The retry resumes after Document AI
+        stages = {stage: mock.Mock() for stage, _ in scan_queue.STAGES}
+        with mock.patch("SSAPP.utils.scan_queue.STAGES", list(stages.items())):
+            jobs = scan_queue.claim_jobs("worker", 300, limit=10)
+            self.assertEqual(scan_queue.run_jobs(jobs, "worker", 300, max_attempts=3), {fresh[1].page_id: "Success"})
+        stages[ScanJob.STAGE_OCR].assert_not_called()
+        stages[ScanJob.STAGE_FILTER].assert_called_once()
+
+    def test_cancel_pending_jobs(self):
+        pending = ScanJob.objects.create(page=self.pages[0])
+        running = ScanJob.objects.create(page=self.pages[1], state=ScanJob.STATE_RUNNING, lease_owner="worker")
+
+        self.assertEqual(scan_queue.cancel_pending_jobs(), 1)
+        pending.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual((pending.state, running.state), (ScanJob.STATE_CANCELLED, ScanJob.STATE_RUNNING))
+        # Cancelled pages can be queued again
+        self.assertEqual(scan_queue.enqueue_pages([self.pages[0].id]), [self.pages[0].id])
+
+    def test_auto_scan_queues_pages_and_reports_status(self):
+        PDFPage.objects.filter(id=self.pages[2].id).update(scanned=True)
+
+        response = self.client.post("/api/pages/auto_scan/")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {"status": "Scanning queued", "queued_pages": [self.pages[0].id, self.pages[1].id]})
+        # Pages with an active job are not queued twice
+        self.assertEqual(self.client.post("/api/pages/auto_scan/").json()["queued_pages"], [])
+
+        scan_queue.claim_job("worker", 300)
+        status = self.client.get("/api/pages/scan_status/").json()
+        retries = status.pop("openai_retries")
+        self.assertEqual(status, {"pending": 1, "running": 1, "done": 0, "failed": 0, "cancelled": 0})
+        self.assertEqual(set(retries), {"requests", "retries", "failures", "backoff_seconds", "retries_by_reason"})
+
+        response = self.client.post("/api/pages/stop_scanning/")
+        self.assertEqual(response.json(), {"status": "Scanning stopped", "cancelled_jobs": 1})
+        self.assertEqual(self.client.get("/api/pages/scan_status/").json()["cancelled"], 1)
+
+
+@override_settings(CONFIG_VERSION_CHECK_SECONDS=2)
+class ConfigSnapshotTests(TestCase):
+    def test_saves_bump_the_version_and_refresh_this_process(self):
+        settings_obj = Settings.objects.create(scan_workers=2, gpt_messages=["First"])
+        version = current_version()
+        self.assertEqual(get_config().settings.scan_workers, 2)
+
+        settings_obj.scan_workers = 4
+        settings_obj.save()
+        AppKeys.objects.create(openai_api_key="key")
+
+        self.assertEqual(current_version(), version + 2)
+        config = get_config()
+        self.assertEqual((config.version, config.settings.scan_workers), (version + 2, 4))
+        self.assertEqual(config.app_keys.openai_api_key, "key")
+        # Snapshots are immutable, JSON values included
+        self.assertEqual(config.settings.gpt_messages, ("First",))
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            config.settings.scan_workers = 8
+
+    def test_other_processes_reload_after_the_check_interval(self):
+        Settings.objects.create(scan_workers=2)
+        clock = FakeClock()
+
+        with mock.patch("SSAPP.utils.config.time.monotonic", clock):
+            self.assertEqual(get_config().settings.scan_workers, 2)
+
+            # Another process saves the settings: no signal reaches this one, only the version
+            Settings.objects.update(scan_workers=6)
+            ConfigVersion.objects.update(version=F("version") + 1)
+
+            clock.advance(1)
+            with self.assertNumQueries(0):
+                self.assertEqual(get_config().settings.scan_workers, 2)
+
+            clock.advance(1)
+            self.assertEqual(get_config().settings.scan_workers, 6)
+            # An unchanged version is checked without reloading the rows
+            clock.advance(2)
+            with self.assertNumQueries(1):
+                self.assertEqual(get_config().settings.scan_workers, 6)
+
+
+@override_settings(DOCUMENTAI_INSECURE_CHANNEL=True, DOCUMENTAI_API_ENDPOINT="localhost:1")
+class DocumentAIClientTests(TestCase):
+    def test_client_is_reused_until_the_configuration_changes(self):
+        settings_obj = Settings.objects.create(project_id="project", processor_id="first", processor_version="rc")
+
+        with mock.patch("SSAPP.utils.documentAI._client", None), \
+                mock.patch("SSAPP.utils.documentAI._configuration", None):
+            _, client, _ = initialize_configuration()
+            # Unrelated settings changes keep the client
+            settings_obj.scan_workers = 4
+            settings_obj.save()
+            self.assertIs(initialize_configuration()[1], client)
+
+            settings_obj.processor_id = "second"
+            settings_obj.save()
+            with mock.patch.object(client.transport, "close", wraps=client.transport.close) as close:
+                _, new_client, client_version = initialize_configuration()
+
+            self.assertIsNot(new_client, client)
+            close.assert_called_once()
+            self.assertIn("/processors/second/", client_version)
+            new_client.transport.close()
+
+
+class GPTCacheEvictionTests(TestCase):
+    def test_evicts_least_recently_used_entries_in_batches(self):
+        now = timezone.now()
+        for index in range(5):
+            GPTCacheEntry.objects.create(
+                key=f"key{index}", model="gpt", response="x" * 100, input_tokens=1, output_tokens=1, size=100
+            )
+        for index in range(5):
+            # Entry 0 was used last
+            GPTCacheEntry.objects.filter(key=f"key{index}").update(last_used_at=now - timedelta(minutes=index if index else -1))
+
+        # 500 bytes down to 90% of 250 frees 275 bytes, so three entries, two per DELETE
+        with mock.patch("SSAPP.utils.gpt_cache.EVICTION_BATCH_SIZE", 2), \
+                self.assertNumQueries(5):
+            self.assertEqual(evict(250), 3)
+        self.assertEqual(sorted(GPTCacheEntry.objects.values_list("key", flat=True)), ["key0", "key1"])
+
+    def test_size_is_checked_every_tenth_of_the_limit(self):
+        with mock.patch("SSAPP.utils.gpt_cache._written", None), \
+                mock.patch("SSAPP.utils.gpt_cache.evict") as evict_mock:
+            for index in range(11):
+                store_response(f"key{index}", "gpt", "x" * 10000, 1, 1, max_mb=1)
+            # The first store, then once more than a tenth of a megabyte has been stored since
+            self.assertEqual(evict_mock.call_count, 1)
+            store_response("key11", "gpt", "x" * 10000, 1, 1, max_mb=1)
+            self.assertEqual(evict_mock.call_count, 2)
+            evict_mock.assert_called_with(1024 * 1024)
+
+
+class TiktokenCacheTests(SimpleTestCase):
+    def test_encoding_loads_from_cache_dir_without_network(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        # A stand-in for cl100k_base with one token per byte, stored where tiktoken looks for the download
+        url = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+        with open(os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest()), "wb") as file:
+            file.writelines(base64.b64encode(bytes([byte])) + f" {byte}\n".encode() for byte in range(256))
+
+        environ = {key: value for key, value in os.environ.items() if key != "TIKTOKEN_CACHE_DIR"}
+        with override_settings(TIKTOKEN_CACHE_DIR=cache_dir), \
+                mock.patch.dict(os.environ, environ, clear=True), \
+                mock.patch.dict(tiktoken.registry.ENCODINGS, clear=True), \
+                mock.patch("tiktoken.load.read_file", side_effect=OSError("Network access is disabled")), \
+                mock.patch("tiktoken.load.check_hash", return_value=True):
+            self.assertEqual(count_tokens("hello", "gpt-4"), 5)
+            self.assertEqual(os.environ["TIKTOKEN_CACHE_DIR"], cache_dir)
+
+
+class TokenFilterTests(TestCase):
+    def test_filters_page_with_one_update(self):
+        Settings.objects.create(confidence_filter=0.5, font_size_filter=3, color_similarity_threshold=0.5)
+        pdf_file = PDFFile.objects.create(name="test.pdf", file="pdfs/test.pdf")
+        pdf_page = PDFPage.objects.create(pdf_file=pdf_file, page_number=1, file="pdf_pages/test.pdf")
+
+        def token(i, text, confidence=0.9, font_size=10, handwritten=False, red=0.0):
+            token = Token(page=pdf_page, token_id=f"token{i}", x1=0, y1=0, x2=1, y2=1)
+            token.set_token_info({
+                "text": text,
+                "layout": {"confidence": confidence},
+                "style_info": {
+                    "font_size": font_size,
+                    "handwritten": handwritten,
+                    "text_color": {"red": red, "green": 0.0, "blue": 0.0},
+                },
+            })
+            return token
+
+        Token.objects.bulk_create([
+            token(0, "kept "),
+            token(1, "unsure ", confidence=0.2),
+            token(2, "tiny ", font_size=2),
+            token(3, "unsized ", font_size=0),
+            token(4, "written ", handwritten=True),
+            token(5, "caf\u00e9 "),
+        ] + [token(i, "plain ") for i in range(6, 206)] + [token(206, "red ", red=1.0)])
+
+        config = get_config()
+        # The page, the average color, and one UPDATE
+        with self.assertNumQueries(3):
+            token_filter(pdf_page.id, config)
+
+        filtered = dict(pdf_page.tokens.values_list("token_id", "filtered"))
+        self.assertEqual(
+            [token_id for token_id, flag in sorted(filtered.items(), key=lambda item: int(item[0][5:])) if flag],
+            ["token1", "token2", "token4", "token5", "token206"],
+        )
+
+
+class QueryCountTests(TestCase):
+    def setUp(self):
+        for name in ["first.pdf", "second.pdf"]:
+            pdf_file = PDFFile.objects.create(name=name, file=f"pdfs/{name}")
+            for page_number in range(1, 7):
+                pdf_page = PDFPage.objects.create(
+                    pdf_file=pdf_file, page_number=page_number, file=f"pdf_pages/{name}_{page_number}.pdf", scanned=page_number % 2 == 0
+                )
+                if pdf_page.scanned:
+                    GPTResponse.objects.create(page=pdf_page, json_response={"content": f"Page {page_number}"}, cost=0.01)
+        self.pdf_file = pdf_file
+
+    def test_list_and_detail_queries_do_not_grow_with_pages(self):
+        # Count, pages, GPT responses
+        with self.assertNumQueries(3):
+            pages = self.client.get("/api/pages/?page_size=100").json()["results"]
+        self.assertEqual(len(pages), 12)
+        self.assertEqual(pages[1]["json_output"], {"content": "Page 2"})
+
+        # Page, GPT responses
+        with self.assertNumQueries(2):
+            self.client.get(f"/api/pages/{pages[1]['id']}/")
+
+        # Count, PDF files, pages, GPT responses
+        with self.assertNumQueries(4):
+            pdf_files = self.client.get("/api/pdfs/?page_size=10").json()["results"]
+        self.assertEqual([len(pdf_file["pages"]) for pdf_file in pdf_files], [6, 6])
+        self.assertEqual(pdf_files[0]["pages"][3]["gpt_cost"], 0.01)
+
+        # PDF file, pages, GPT responses, pages for rendering
+        with mock.patch("SSAPP.utils.utils.rendered_image_url", return_value="/api/media/render_cache/page.jpeg"), \
+                self.assertNumQueries(4):
+            pdf_file = self.client.get(f"/api/pdfs/{self.pdf_file.id}/").json()
+        self.assertEqual(pdf_file["pages"][5]["json_output"], {"content": "Page 6"})
+
+
+class TokenInfoCodecTests(SimpleTestCase):
+    token_info = {
+        "text": "caf\u00e9 ",
+        "layout": {
+            "text_anchor": {"text_segments": [{"start_index": 25, "end_index": 30}]},
+            "confidence": 0.9900000095367432,
+            "bounding_poly": {"vertices": [[124, 31], [143, 42]], "normalized_vertices": [[0.2033986747264862, 0.04]]},
+            "orientation": 0,
+        },
+        "detected_break": {"type_": 1},
+        "detected_languages": [{"language_code": "fr", "confidence": 0.5}],
+        "style_info": {
+            "font_size": 10,
+            "pixel_font_size": 10.991998672485352,
+            "font_type": "",
+            "font_weight": 0,
+            "bold": False,
+            "italic": True,
+            "underlined": False,
+            "handwritten": False,
+            "letter_spacing": 0.0,
+            "text_color": {"red": 0.1, "green": 0.2, "blue": 0.3},
+            "background_color": {"red": 1.0, "green": 1.0, "blue": 1.0},
+        },
+    }
+
+    def test_compact_round_trip(self):
+        value = encode_token_info(self.token_info, "zlib")
+        self.assertLess(len(value), len(json.dumps(self.token_info)) // 2)
+        self.assertEqual(decode_token_info(value), self.token_info)
+        self.assertEqual(decode_token_info_field(value, "style_info", "text_color"), {"red": 0.1, "green": 0.2, "blue": 0.3})
+        self.assertEqual(decode_token_info_field(value, "detected_languages"), [{"language_code": "fr", "confidence": 0.5}])
+
+    def test_reads_json_and_keeps_unknown_layouts_as_json(self):
+        value = json.dumps(self.token_info)
+        self.assertEqual(decode_token_info(value), self.token_info)
+        self.assertEqual(decode_token_info_field(value, "layout", "confidence"), 0.9900000095367432)
+
+        unknown = {**self.token_info, "extra": 1}
+        self.assertEqual(json.loads(encode_token_info(unknown, "zlib")), unknown)
+
+
+class FakeClock:
+    """
+    A clock for rate limiters that only moves when told to.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_token_bucket_refills_and_allows_debt(self):
+        # 600 per minute at 95% is 9.5 per second, with 10 seconds of burst
+        bucket = TokenBucket(600, now=0.0)
+        self.assertAlmostEqual(bucket.capacity, 95)
+        self.assertEqual(bucket.wait_time(95, 0.0), 0)
+        bucket.take(95)
+        self.assertAlmostEqual(bucket.wait_time(19, 0.0), 2.0)
+        self.assertEqual(bucket.wait_time(19, 2.0), 0)
+
+        # A request larger than the bucket waits for a full bucket, then leaves it in debt
+        self.assertAlmostEqual(bucket.wait_time(500, 2.0), 76 / 9.5)
+        self.assertEqual(bucket.wait_time(500, 10.0), 0)
+        bucket.take(500)
+        self.assertAlmostEqual(bucket.wait_time(1, 10.0), 406 / 9.5)
+
+    def test_rate_limiter_admits_against_both_buckets(self):
+        clock = FakeClock()
+        limiter = RateLimiter(60, 6000, clock=clock)
+
+        self.assertEqual(limiter.try_acquire(900), 0)
+        # The token bucket holds 950, so the second request waits, checking again soon
+        self.assertAlmostEqual(limiter.wait_time(900), 850 / 95)
+        self.assertEqual(limiter.try_acquire(900), 0.25)
+        clock.advance(9)
+        self.assertEqual(limiter.try_acquire(900), 0)
+
+        # Once both are full, the request bucket admits 9 small requests in a burst
+        clock.advance(10)
+        admitted = 0
+        while limiter.try_acquire(1) == 0:
+            admitted += 1
+        self.assertEqual(admitted, 9)
+        self.assertAlmostEqual(limiter.wait_time(1), 0.5 / 0.95)
+
+    def test_observe_learns_limits_and_remaining_budget(self):
+        clock = FakeClock()
+        limiter = RateLimiter(60, 6000, clock=clock)
+        limiter.observe({
+            "x-ratelimit-limit-requests": "600",
+            "x-ratelimit-limit-tokens": "60000",
+            "x-ratelimit-remaining-requests": "599",
+            "x-ratelimit-remaining-tokens": "500",
+        })
+
+        self.assertTrue(limiter.learned)
+        self.assertAlmostEqual(limiter.tokens.capacity, 9500)
+        self.assertAlmostEqual(limiter.requests.capacity, 95)
+        # Other users of the key have spent most of the budget
+        self.assertAlmostEqual(limiter.tokens.level, 475)
+        self.assertAlmostEqual(limiter.requests.level, 9.5)
+
+        # Unparseable headers change nothing
+        limiter.observe({"x-ratelimit-limit-tokens": "unknown", "x-ratelimit-remaining-tokens": ""})
+        self.assertAlmostEqual(limiter.tokens.capacity, 9500)
+        self.assertAlmostEqual(limiter.tokens.level, 475)
+
+    def test_header_numbers(self):
+        headers = {"a": "42", "b": " 1.5s", "c": "6m0s", "d": "none"}
+        self.assertEqual(
+            [_header_number(headers, name) for name in ["a", "b", "c", "d", "missing"]],
+            [42.0, 1.5, 6.0, None, None],
+        )
+
+    def test_unused_tokens_are_only_released_without_a_remaining_count(self):
+        clock = FakeClock()
+        limiter = RateLimiter(60, 6000, clock=clock)
+        limiter.try_acquire(900)
+        response_json = {"usage": {"total_tokens": 100}}
+
+        release_unused_tokens(limiter, 900, response_json, {"x-ratelimit-limit-tokens": "6000"})
+        self.assertAlmostEqual(limiter.tokens.level, 850)
+
+        limiter.observe({"x-ratelimit-remaining-tokens": "200"})
+        release_unused_tokens(limiter, 900, response_json, {"x-ratelimit-remaining-tokens": "200"})
+        self.assertAlmostEqual(limiter.tokens.level, 190)
+
+    def test_choose_api_key_prefers_the_key_that_can_send_soonest(self):
+        with mock.patch.dict("SSAPP.utils.rate_limit._limiters", clear=True):
+            api_key, limiter = choose_api_key(["key-a", "key-b"], "gpt-4o", 900, 60, 6000)
+            self.assertEqual(api_key, "key-a")
+            self.assertIs(limiter, get_rate_limiter("key-a", "gpt-4o", 60, 6000))
+
+            self.assertEqual(limiter.try_acquire(900), 0)
+            self.assertEqual(choose_api_key(["key-a", "key-b"], "gpt-4o", 900, 60, 6000)[0], "key-b")
+            # Limits are kept per model
+            self.assertEqual(choose_api_key(["key-a", "key-b"], "gpt-4o-mini", 900, 60, 6000)[0], "key-a")
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(b"")
+    return response
+
+
+@override_settings(OPENAI_MAX_RETRIES=2, OPENAI_BACKOFF_BASE=1.0, OPENAI_BACKOFF_MAX=5.0)
+class PostWithRetriesTests(SimpleTestCase):
+    def setUp(self):
+        retry_stats.reset()
+        self.session = mock.Mock()
+        patches = [
+            mock.patch("SSAPP.utils.http_session.get_session", return_value=self.session),
+            mock.patch("SSAPP.utils.http_session.time.sleep"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_retries_rate_limits_and_server_errors(self):
+        self.session.post.side_effect = [
+            make_response(429, {"Retry-After": "2"}),
+            make_response(503),
+            make_response(200),
+        ]
+        observed = []
+
+        response = post_with_retries("https://api.test/v1", on_response=observed.append, json={})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(len(observed), 3)
+        stats = retry_stats.as_dict()
+        self.assertEqual((stats["requests"], stats["retries"], stats["failures"]), (3, 2, 0))
+        self.assertEqual(stats["retries_by_reason"], {"429": 1, "503": 1})
+        self.assertGreaterEqual(stats["backoff_seconds"], 2.0)
+
+    def test_other_errors_are_not_retried(self):
+        self.session.post.return_value = make_response(400)
+
+        self.assertEqual(post_with_retries("https://api.test/v1").status_code, 400)
+        self.assertEqual(self.session.post.call_count, 1)
+        self.assertEqual(retry_stats.as_dict()["retries"], 0)
+
+    def test_gives_up_after_max_retries(self):
+        self.session.post.return_value = make_response(500)
+
+        self.assertEqual(post_with_retries("https://api.test/v1").status_code, 500)
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(retry_stats.as_dict()["failures"], 1)
+
+        self.session.post.reset_mock(return_value=True)
+        self.session.post.side_effect = requests.exceptions.ConnectionError("refused")
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            post_with_retries("https://api.test/v1")
+        self.assertEqual(self.session.post.call_count, 3)
+        self.assertEqual(retry_stats.as_dict()["retries_by_reason"]["ConnectionError"], 2)
+
+    def test_retry_delay(self):
+        # Retry-After is honored in seconds or as a date, up to the maximum
+        self.assertEqual(retry_delay(1, "3"), 3.0)
+        self.assertEqual(retry_delay(1, "120"), 5.0)
+        self.assertEqual(retry_delay(1, "Thu, 01 Jan 1970 00:00:00 GMT"), 0.0)
+
+        # Otherwise the jitter is drawn below a doubling, capped bound
+        with mock.patch("SSAPP.utils.http_session.random.uniform", side_effect=lambda low, high: high):
+            self.assertEqual([retry_delay(attempt, "soon") for attempt in range(1, 6)], [1.0, 2.0, 4.0, 5.0, 5.0])
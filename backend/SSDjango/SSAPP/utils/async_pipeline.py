@@ -0,0 +1,312 @@
+# async_pipeline.py
+
+import asyncio
+import grpc
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings as django_settings
+from django.db import connections
+from django.utils import timezone
+from google.cloud import documentai
+from google.cloud.documentai_v1.services.document_processor_service.transports import (
+    DocumentProcessorServiceGrpcAsyncIOTransport,
+)
+from ..models import PDFPage
+from .documentAI import (
+    GRPC_CHANNEL_OPTIONS,
+    get_api_endpoint,
+    get_page_dimensions,
+    get_processor_version_path,
+    load_configuration,
+    page_content_hash,
+    process_tokens,
+)
+from .config import get_config
+from .documentai_store import document_key, load_document, save_document
+from .page_files import page_source, read_page_file
+from .filter_tokens import token_filter
+from .gpt_cache import get_cached_response, gpt_cache_key, store_response
+from .http_session import RETRY_STATUS_CODES, retry_delay, retry_stats
+from .gpt import (
+    build_gpt_request,
+    count_instruction_tokens,
+    count_tokens,
+    generate_text,
+    get_gpt_settings,
+    get_openai_api_keys,
+    gpt_cost,
+    release_unused_tokens,
+    reserve_gpt_request,
+    save_gpt_response,
+)
+import logging
+
+logger = logging.getLogger("django")
+
+
+def create_async_client(settings: dict):
+    """
+    Creates an asyncio Document AI client for the configured location.
+
+    Args:
+        settings (dict): The Document AI settings returned by `load_configuration`.
+
+    Returns:
+        documentai.DocumentProcessorServiceAsyncClient: The client.
+    """
+    api_endpoint = get_api_endpoint(settings["location"])
+    if django_settings.DOCUMENTAI_INSECURE_CHANNEL:
+        channel = grpc.aio.insecure_channel(api_endpoint, options=GRPC_CHANNEL_OPTIONS)
+    else:
+        channel = DocumentProcessorServiceGrpcAsyncIOTransport.create_channel(
+            f"{api_endpoint}:443",
+            credentials_file=settings["cred_file"],
+            options=GRPC_CHANNEL_OPTIONS,
+        )
+    return documentai.DocumentProcessorServiceAsyncClient(
+        transport=DocumentProcessorServiceGrpcAsyncIOTransport(channel=channel)
+    )
+
+
+def _page_document_key(page_id: int, process_options, client_version: str):
+    pdf_page = PDFPage.objects.select_related("pdf_file").get(id=page_id)
+    return pdf_page, document_key(page_content_hash(pdf_page), process_options, client_version)
+
+
+def _save_document(pdf_page, document, config):
+    page_width, page_height = get_page_dimensions(*page_source(pdf_page))
+    process_tokens(pdf_page, document, page_width, page_height, config=config)
+
+
+async def process_page_async(client, page_id: int, process_options, client_version: str, config=None):
+    """
+    Processes a page with the asyncio Document AI client and saves its tokens, using a
+    stored result instead when there is one.
+
+    Args:
+        client (documentai.DocumentProcessorServiceAsyncClient): The Document AI client.
+        page_id (int): The ID of the page.
+        process_options (documentai.ProcessOptions): The OCR options.
+        client_version (str): The full resource path of the processor version.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Raises:
+        Exception: If the page could not be read, processed or saved.
+    """
+    logger.info(f"Processing page {page_id}...")
+    try:
+        pdf_page, key = await sync_to_async(_page_document_key)(page_id, process_options, client_version)
+        document = await sync_to_async(load_document)(key)
+        if document is None:
+            content = await sync_to_async(read_page_file)(pdf_page)
+            request = documentai.ProcessRequest(
+                name=client_version,
+                raw_document=documentai.RawDocument(content=content, mime_type="application/pdf"),
+                process_options=process_options,
+            )
+            response = await client.process_document(request=request)
+            document = response.document
+            await sync_to_async(save_document)(key, document)
+
+        await sync_to_async(_save_document)(pdf_page, document, config)
+    except Exception as e:
+        raise Exception(f"Failed to process page {page_id}: {e}")
+
+
+async def post_with_retries_async(http_client, url: str, on_response=None, **kwargs):
+    """
+    Sends a POST request with an async HTTP client, retrying like `post_with_retries`.
+
+    Returns:
+        httpx.Response: The last response, which may still be an error response.
+
+    Raises:
+        httpx.HTTPError: If the last attempt failed without a response.
+    """
+    max_retries = django_settings.OPENAI_MAX_RETRIES
+
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_stats.record_request()
+        try:
+            response = await http_client.post(url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt > max_retries:
+                retry_stats.record_failure()
+                raise
+            reason, retry_after = type(e).__name__, None
+        else:
+            if on_response is not None:
+                on_response(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt > max_retries:
+                if response.status_code in RETRY_STATUS_CODES:
+                    retry_stats.record_failure()
+                return response
+            reason, retry_after = str(response.status_code), response.headers.get("Retry-After")
+
+        delay = retry_delay(attempt, retry_after)
+        retry_stats.record_retry(reason, delay)
+        logger.warning(f"Request to {url} failed ({reason}), retry {attempt}/{max_retries} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+async def process_gpt_async(http_client, text, instructions, format_response: str, max_tokens: int, model: str, api_keys: list, config):
+    """
+    Calls the OpenAI API with an async HTTP client to process text using specified instructions and format.
+
+    Responses are cached like in `process_gpt`, requests wait for the same rate limiters, and
+    failed calls are retried with the same backoff policy and statistics as `post_with_retries`.
+
+    Returns:
+        tuple: A tuple containing the processed message and its cost.
+
+    Raises:
+        ConnectionError: If there is a problem with the network or reaching the API.
+        RuntimeError: For any other issues with API interaction.
+    """
+    logger.info("Processing text with GPT...")
+    try:
+        settings_obj = config.settings
+
+        cache_key = None
+        if settings_obj.gpt_cache_enabled:
+            cache_key = gpt_cache_key(model, instructions, format_response, max_tokens, text)
+            cached = await sync_to_async(get_cached_response)(cache_key)
+            if cached is not None:
+                return cached.response, 0.0
+
+        input_tokens = count_tokens(text, model) + count_instruction_tokens(instructions, model)
+        reserved_tokens = input_tokens + max_tokens
+
+        while True:
+            api_key, limiter, delay = reserve_gpt_request(api_keys, model, reserved_tokens, config)
+            if delay == 0:
+                break
+            await asyncio.sleep(delay)
+
+        headers, payload = build_gpt_request(text, instructions, format_response, max_tokens, model, api_key)
+        response = await post_with_retries_async(
+            http_client, f"{django_settings.OPENAI_API_BASE}/chat/completions",
+            on_response=limiter.observe, headers=headers, json=payload,
+        )
+
+        if response.status_code == 200:
+            response_json = response.json()
+            release_unused_tokens(limiter, reserved_tokens, response_json, response.headers)
+            message_content = response_json["choices"][0]["message"]["content"]
+            output_tokens = count_tokens(message_content, model)
+
+            if cache_key is not None:
+                await sync_to_async(store_response)(
+                    cache_key, model, message_content, input_tokens, output_tokens, settings_obj.gpt_cache_max_mb
+                )
+
+            return message_content, gpt_cost(input_tokens, output_tokens)
+        else:
+            logger.error(f"API error: {response.status_code} - {response.text}")
+            raise RuntimeError(f"API error: {response.status_code} - {response.text}")
+
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to connect to OpenAI API: {e}")
+        raise ConnectionError(f"Failed to connect to OpenAI API: {e}")
+
+
+async def gpt_token_processing_async(http_client, page_id: int, settings: dict, api_keys: list, config):
+    """
+    Reformats the text of a page with two GPT calls and saves the response.
+
+    Args:
+        http_client (httpx.AsyncClient): The HTTP client.
+        page_id (int): The ID of the PDFPage instance.
+        settings (dict): The GPT settings returned by `get_gpt_settings`.
+        api_keys (list): The OpenAI API keys.
+        config (ConfigSnapshot): The configuration, which provides the initial rate limits.
+    """
+    logger.info(f"Processing GPT token for page {page_id}...")
+
+    documentAI_text = await sync_to_async(generate_text)(page_id)
+
+    instructions1 = settings["gpt_instructions"][0]
+    instructions2 = settings["gpt_instructions"][1]
+
+    message_content, cost = await process_gpt_async(
+        http_client, documentAI_text, instructions1, "text", settings["gpt_max_tokens"], settings["gpt_model"], api_keys, config
+    )
+    json_output, cost2 = await process_gpt_async(
+        http_client, message_content, instructions2, "json_object", settings["gpt_max_tokens"], settings["gpt_model"], api_keys, config
+    )
+
+    await sync_to_async(save_gpt_response)(page_id, json_output, cost + cost2)
+
+
+async def process_pages_async(page_ids: list, concurrency: int, should_continue=None, config=None, on_stage_done=None):
+    """
+    Processes pages on a single event loop, with at most `concurrency` pages in flight.
+
+    Database work runs through `sync_to_async`, while the Document AI and OpenAI calls are
+    awaited directly, so hundreds of requests can be in flight without a thread for each.
+
+    Args:
+        page_ids (list): The list of page IDs.
+        concurrency (int): The maximum number of pages processed at once.
+        should_continue (callable, optional): Checked before each page is started.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+        on_stage_done (callable, optional): Called with a list of page IDs and the stage they
+            have just completed: "ocr", "filter" or "gpt". Raising marks the pages as failed.
+
+    Returns:
+        dict: A dictionary with keys as page IDs and values as status messages.
+    """
+    config = config or await sync_to_async(get_config)()
+    process_options, docai_settings = await sync_to_async(load_configuration)(config)
+    client_version = get_processor_version_path(docai_settings)
+    gpt_settings = get_gpt_settings(config)
+    api_keys = get_openai_api_keys(config)
+
+    client = create_async_client(docai_settings)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = {}
+
+    limits = httpx.Limits(max_connections=max(1, concurrency), max_keepalive_connections=max(1, concurrency))
+    timeout = httpx.Timeout(django_settings.OPENAI_READ_TIMEOUT, connect=django_settings.OPENAI_CONNECT_TIMEOUT)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=timeout) as http_client:
+
+            async def stage_done(page_id, stage):
+                if on_stage_done is not None:
+                    await sync_to_async(on_stage_done)([page_id], stage)
+
+            async def run(page_id):
+                async with semaphore:
+                    if should_continue is not None and not should_continue():
+                        return
+                    try:
+                        await sync_to_async(PDFPage.objects.filter(id=page_id).update)(scan_start_time=timezone.now())
+
+                        await process_page_async(client, page_id, process_options, client_version, config)
+                        await stage_done(page_id, "ocr")
+                        await sync_to_async(token_filter)(page_id, config)
+                        await stage_done(page_id, "filter")
+                        await gpt_token_processing_async(http_client, page_id, gpt_settings, api_keys, config)
+                        await stage_done(page_id, "gpt")
+
+                        await sync_to_async(PDFPage.objects.filter(id=page_id).update)(scan_end_time=timezone.now())
+                        results[page_id] = "Success"
+                    except Exception as e:
+                        logger.error(f"Failed to process page {page_id}: {str(e)}")
+                        results[page_id] = f"Failed to process page {page_id}: {str(e)}"
+
+            await asyncio.gather(*(run(page_id) for page_id in page_ids))
+    finally:
+        await client.transport.close()
+        await sync_to_async(connections.close_all)()
+
+    return {page_id: results[page_id] for page_id in page_ids if page_id in results}
+
+
+def process_pages_util_async(page_ids: list, concurrency: int, should_continue=None, config=None, on_stage_done=None):
+    """
+    Runs `process_pages_async` on a new event loop from synchronous code.
+    """
+    return asyncio.run(process_pages_async(page_ids, concurrency, should_continue, config, on_stage_done))
@@ -0,0 +1,187 @@
+# chunked_upload.py
+
+import os
+from datetime import timedelta
+from django.conf import settings as django_settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from ..models import ChunkedUpload, PDFFile
+from .content_hash import file_sha256
+import logging
+
+logger = logging.getLogger("django")
+
+# Chunks are copied from the request to the part file in blocks of this size, so memory use
+# does not depend on the chunk or file size
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """
+    A chunk or completion request that does not fit the state of the upload.
+
+    Args:
+        message (str): The error message.
+        offset (int, optional): The offset the client should resume at.
+    """
+    def __init__(self, message: str, offset: int = None):
+        super().__init__(message)
+        self.offset = offset
+
+
+def start_upload(name: str, size: int, sha256: str):
+    """
+    Starts a chunked upload by creating its session and an empty part file.
+
+    Sessions that have not received a chunk for UPLOAD_EXPIRY_HOURS are deleted first.
+
+    Returns:
+        ChunkedUpload: The new upload.
+
+    Raises:
+        UploadError: If the size or checksum is invalid.
+    """
+    if size <= 0 or size > django_settings.UPLOAD_MAX_MB * 1024 * 1024:
+        raise UploadError(f"size must be between 1 byte and {django_settings.UPLOAD_MAX_MB} MB.")
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(char not in "0123456789abcdef" for char in sha256):
+        raise UploadError("sha256 must be the hex SHA-256 digest of the file.")
+
+    delete_expired_uploads()
+    upload = ChunkedUpload.objects.create(name=name, size=size, sha256=sha256)
+    os.makedirs(os.path.dirname(upload.part_path), exist_ok=True)
+    open(upload.part_path, "wb").close()
+    logger.info(f"Started upload {upload.id} of {name} ({size} bytes)")
+    return upload
+
+
+def write_chunk(upload: ChunkedUpload, offset: int, stream, length: int):
+    """
+    Writes a chunk read from a stream into the part file of an upload.
+
+    A chunk may start anywhere up to the number of bytes received so far, so a chunk whose
+    response was lost can be sent again.
+
+    Args:
+        upload (ChunkedUpload): The upload.
+        offset (int): The position of the chunk in the file.
+        stream: A file-like object to read the chunk from, such as the request.
+        length (int): The length of the chunk in bytes.
+
+    Returns:
+        int: The number of bytes received so far.
+
+    Raises:
+        UploadError: If the chunk starts past the received bytes, ends past the declared size,
+            or the stream ends early, or the upload is being completed.
+    """
+    if upload.completing:
+        raise UploadError("The upload is being completed.", upload.received)
+    if offset < 0 or offset > upload.received:
+        raise UploadError(f"Expected a chunk at offset {upload.received}, got {offset}.", upload.received)
+    if length <= 0 or offset + length > upload.size:
+        raise UploadError(f"A chunk of {length} bytes at offset {offset} does not fit in {upload.size} bytes.", upload.received)
+
+    written = 0
+    with open(upload.part_path, "r+b") as part:
+        part.seek(offset)
+        while written < length:
+            block = stream.read(min(COPY_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            part.write(block)
+            written += len(block)
+
+    received = offset + written
+    # A retried chunk must not move the received count back
+    ChunkedUpload.objects.filter(id=upload.id).update(
+        received=Greatest(F("received"), received), updated_at=timezone.now()
+    )
+    upload.refresh_from_db(fields=["received", "updated_at"])
+    if written < length:
+        raise UploadError(f"The chunk ended after {written} of {length} bytes.", upload.received)
+    return upload.received
+
+
+def complete_upload(upload: ChunkedUpload):
+    """
+    Checks a fully received upload against its checksum and moves it into a new PDFFile,
+    unless a PDF file with the same content exists already.
+
+    The upload is claimed first with a conditional UPDATE, so of two concurrent requests only
+    one completes it; the other gets the PDF file if it is finished, or an error. The upload
+    session is deleted once it is completed or fails, but not when bytes are still missing.
+
+    Returns:
+        tuple: The PDF file, not split into pages yet if it is new, and whether it is new.
+
+    Raises:
+        UploadError: If bytes are missing, the upload is being completed by another request,
+            the checksum does not match, or a different PDF file has the same name.
+    """
+    if upload.received < upload.size:
+        raise UploadError(f"Received {upload.received} of {upload.size} bytes.", upload.received)
+
+    claimed = ChunkedUpload.objects.filter(id=upload.id, completing=False).update(
+        completing=True, updated_at=timezone.now()
+    )
+    if not claimed:
+        finished = PDFFile.objects.filter(sha256=upload.sha256).first()
+        if finished is not None:
+            return finished, False
+        raise UploadError("The upload is already being completed.")
+    upload.completing = True
+
+    try:
+        digest = file_sha256(upload.part_path)
+        if digest != upload.sha256:
+            logger.error(f"Upload {upload.id} of {upload.name} failed its checksum: expected {upload.sha256}, got {digest}")
+            upload.delete()
+            raise UploadError(f"The checksum of the uploaded file is {digest}, expected {upload.sha256}. Start the upload again.")
+
+        with transaction.atomic():
+            duplicate = PDFFile.objects.filter(sha256=digest).first()
+            if duplicate is not None:
+                upload.delete()
+                logger.info(f"Upload of {upload.name} is identical to PDF file {duplicate.id}")
+                return duplicate, False
+            # Another file may have taken the name since the upload started
+            name_taken = PDFFile.objects.filter(name=upload.name).exists()
+            if not name_taken:
+                file_name = default_storage.get_available_name(os.path.join("pdfs", os.path.basename(upload.name)))
+                os.makedirs(os.path.dirname(default_storage.path(file_name)), exist_ok=True)
+                os.replace(upload.part_path, default_storage.path(file_name))
+                pdf_file = PDFFile.objects.create(name=upload.name, file=file_name, sha256=digest)
+                upload.delete()
+
+        if name_taken:
+            upload.delete()
+            raise UploadError(f"A PDF file named {upload.name} already exists with different content.")
+    except UploadError:
+        raise
+    except Exception:
+        # Let the upload be completed again
+        ChunkedUpload.objects.filter(id=upload.id).update(completing=False)
+        raise
+
+    logger.info(f"Completed upload of {upload.name} as PDF file {pdf_file.id}")
+    return pdf_file, True
+
+
+def delete_expired_uploads():
+    """
+    Deletes the uploads that have not received a chunk for UPLOAD_EXPIRY_HOURS.
+
+    Returns:
+        int: The number of deleted uploads.
+    """
+    cutoff = timezone.now() - timedelta(hours=django_settings.UPLOAD_EXPIRY_HOURS)
+    expired = list(ChunkedUpload.objects.filter(updated_at__lt=cutoff))
+    for upload in expired:
+        upload.delete()
+    if expired:
+        logger.info(f"Deleted {len(expired)} expired uploads")
+    return len(expired)
@@ -0,0 +1,143 @@
+# config.py
+
+import threading
+import time
+from dataclasses import dataclass, make_dataclass
+from typing import Optional
+from django.conf import settings as django_settings
+from django.db import models
+from django.db.models import F
+from ..models import AppKeys, ConfigVersion, Settings
+import logging
+
+logger = logging.getLogger("django")
+
+CONFIG_VERSION_ID = 1
+
+_FIELD_TYPES = {
+    models.BooleanField: bool,
+    models.IntegerField: int,
+    models.BigIntegerField: int,
+    models.FloatField: float,
+    models.JSONField: tuple,
+}
+
+
+def _freeze(value):
+    """
+    Converts JSON values to immutable equivalents.
+    """
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, _freeze(item)) for key, item in value.items())
+    return value
+
+
+def _snapshot_class(model, name):
+    """
+    Builds a frozen dataclass with one typed attribute per concrete field of a model.
+    """
+    fields = [
+        (field.name, _FIELD_TYPES.get(type(field), str))
+        for field in model._meta.concrete_fields
+        if not field.primary_key
+    ]
+    cls = make_dataclass(name, fields, frozen=True)
+
+    def from_instance(instance):
+        values = {}
+        for field in model._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            value = getattr(instance, field.name)
+            if isinstance(field, models.FileField):
+                value = value.path if value else None
+            values[field.name] = _freeze(value)
+        return cls(**values)
+
+    cls.from_instance = staticmethod(from_instance)
+    return cls
+
+
+SettingsSnapshot = _snapshot_class(Settings, "SettingsSnapshot")
+AppKeysSnapshot = _snapshot_class(AppKeys, "AppKeysSnapshot")
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """
+    An immutable copy of the `Settings` and `AppKeys` rows at one configuration version.
+
+    Attributes:
+        version (int): The configuration version the snapshot was read at.
+        settings (SettingsSnapshot): The settings, or None if none have been saved.
+        app_keys (AppKeysSnapshot): The API keys, or None if none have been saved.
+    """
+    version: int
+    settings: Optional[SettingsSnapshot]
+    app_keys: Optional[AppKeysSnapshot]
+
+
+_snapshot = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def current_version():
+    """
+    Returns the configuration version stored in the database.
+    """
+    version = ConfigVersion.objects.filter(id=CONFIG_VERSION_ID).values_list("version", flat=True).first()
+    return version or 0
+
+
+def get_config():
+    """
+    Returns the configuration snapshot, reading `Settings` and `AppKeys` only when they have changed.
+
+    The database version counter is checked at most once every `CONFIG_VERSION_CHECK_SECONDS`,
+    so edits made by another process are picked up within that interval. Edits made in this
+    process invalidate the snapshot straight away through the model signals.
+
+    Returns:
+        ConfigSnapshot: The configuration snapshot.
+    """
+    global _snapshot, _checked_at
+    with _lock:
+        now = time.monotonic()
+        if _snapshot is not None and now - _checked_at < django_settings.CONFIG_VERSION_CHECK_SECONDS:
+            return _snapshot
+
+        version = current_version()
+        if _snapshot is None or _snapshot.version != version:
+            settings_obj = Settings.objects.first()
+            app_keys = AppKeys.objects.first()
+            _snapshot = ConfigSnapshot(
+                version=version,
+                settings=SettingsSnapshot.from_instance(settings_obj) if settings_obj else None,
+                app_keys=AppKeysSnapshot.from_instance(app_keys) if app_keys else None,
+            )
+            logger.info(f"Loaded configuration version {version}")
+
+        _checked_at = now
+        return _snapshot
+
+
+def invalidate_config():
+    """
+    Drops the cached snapshot in this process.
+    """
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+def bump_config_version():
+    """
+    Increments the database version counter, so every process reloads its configuration.
+    """
+    updated = ConfigVersion.objects.filter(id=CONFIG_VERSION_ID).update(version=F("version") + 1)
+    if not updated:
+        ConfigVersion.objects.get_or_create(id=CONFIG_VERSION_ID, defaults={"version": 1})
+    invalidate_config()
@@ -0,0 +1,136 @@
+# content_hash.py
+
+import hashlib
+from collections import defaultdict
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+from ..models import PDFPage, Token, GPTResponse
+import logging
+
+logger = logging.getLogger("django")
+
+# PDFFile.sha256 and PDFPage.sha256 hold SHA-256 digests of the file contents. A re-uploaded
+# PDF is recognised by its digest and answered with the existing file, and a new page whose
+# digest matches an already scanned page gets a copy of that page's scan results.
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Tokens copied from a duplicate page are created in batches of this size
+TOKEN_COPY_BATCH_SIZE = 2000
+
+
+class Sha256UploadHandler(FileUploadHandler):
+    """
+    An upload handler computing the SHA-256 digest of each uploaded file as its chunks stream
+    through, before the next handler stores them.
+
+    Insert it first in `request.upload_handlers` before the files are read. `digests` maps
+    each form field to the digests of its files, in upload order.
+    """
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = defaultdict(list)
+        self._digest = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._digest.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests[self.field_name].append(self._digest.hexdigest())
+        return None
+
+
+def file_sha256(path: str):
+    """
+    Returns the hex SHA-256 digest of a file, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def uploaded_file_sha256(uploaded_file):
+    """
+    Returns the hex SHA-256 digest of an uploaded file, read in chunks, and rewinds it.
+    """
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks(HASH_BLOCK_SIZE):
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def link_duplicate_pages(pdf_pages: list):
+    """
+    Gives each new page that is byte-identical to an already scanned page a copy of that
+    page's scan results, so it is not scanned again.
+
+    Args:
+        pdf_pages (list): Saved PDFPage instances with their `sha256` set.
+
+    Returns:
+        list: The IDs of the pages that were linked.
+    """
+    hashes = {pdf_page.sha256 for pdf_page in pdf_pages if pdf_page.sha256}
+    if not hashes:
+        return []
+
+    sources = {}
+    new_ids = [pdf_page.id for pdf_page in pdf_pages]
+    for source in PDFPage.objects.filter(sha256__in=hashes, scanned=True).exclude(id__in=new_ids).order_by("id"):
+        sources.setdefault(source.sha256, source)
+
+    linked = []
+    for pdf_page in pdf_pages:
+        source = sources.get(pdf_page.sha256)
+        if source is None:
+            continue
+        try:
+            copy_scan_results(source, pdf_page)
+            linked.append(pdf_page.id)
+        except Exception as e:
+            # The page is simply scanned like any other
+            logger.error(f"Failed to copy the scan results of page {source.id} to page {pdf_page.id}: {e}")
+
+    if linked:
+        logger.info(f"Linked {len(linked)} pages to the scan results of identical pages")
+    return linked
+
+
+def copy_scan_results(source: PDFPage, target: PDFPage):
+    """
+    Copies the tokens and GPT response of a scanned page to another page and marks it scanned.
+
+    Nothing is paid for the copy, so the target's costs are zero.
+    """
+    with transaction.atomic():
+        if source.token_blob:
+            with source.token_blob.open("rb") as blob:
+                target.token_blob.save(f"page_{target.id}.tokens", ContentFile(blob.read()), save=False)
+
+        last_id = 0
+        while True:
+            tokens = list(Token.objects.filter(page=source, id__gt=last_id).order_by("id")[:TOKEN_COPY_BATCH_SIZE])
+            if not tokens:
+                break
+            last_id = tokens[-1].id
+            for token in tokens:
+                token.pk = None
+                token.page = target
+            Token.objects.bulk_create(tokens)
+
+        gpt_response = GPTResponse.objects.filter(page=source).first()
+        if gpt_response is not None:
+            GPTResponse.objects.create(page=target, _json_response=gpt_response._json_response, cost=0.0)
+
+        target.scanned = True
+        target.cost = 0.0
+        target.save(update_fields=["token_blob", "scanned", "cost"])
@@ -0,0 +1,184 @@
+# disk_cache.py
+
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+from django.conf import settings as django_settings
+import logging
+
+logger = logging.getLogger("django")
+
+# Eviction removes the least recently used files until the cache is this fraction of its limit
+EVICTION_TARGET = 0.9
+
+
+class DiskCache:
+    """
+    A size-bounded cache of files under MEDIA_ROOT, evicting the least recently used files.
+
+    Files are written under a temporary name and renamed into place, so concurrent readers and
+    other processes never see a partial file. A read refreshes a file's modification time,
+    which is the recency eviction goes by.
+
+    Args:
+        directory (str): The cache directory, relative to MEDIA_ROOT.
+        max_mb_setting (str): The name of the Django setting holding the size limit in megabytes.
+        suffix (str, optional): The file name extension of the cached files.
+    """
+    def __init__(self, directory: str, max_mb_setting: str, suffix: str = ""):
+        self.directory = directory
+        self.max_mb_setting = max_mb_setting
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        # Bytes written by this process since the directory was last measured
+        self._written = None
+
+    @property
+    def root(self):
+        return Path(django_settings.MEDIA_ROOT) / self.directory
+
+    @property
+    def max_bytes(self):
+        return getattr(django_settings, self.max_mb_setting) * 1024 * 1024
+
+    def path(self, key: str):
+        """
+        Returns the path a key is cached at, in one of 256 subdirectories.
+        """
+        shard = hashlib.sha1(key.encode()).hexdigest()[:2]
+        return self.root / shard / f"{key}{self.suffix}"
+
+    def url(self, key: str):
+        """
+        Returns the media URL of a cached file.
+        """
+        return f"{django_settings.MEDIA_URL}{self.path(key).relative_to(django_settings.MEDIA_ROOT).as_posix()}"
+
+    def get(self, key: str):
+        """
+        Returns the path of a cached file and marks it as used, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes):
+        """
+        Caches data under a key, then evicts old files if the cache has grown past its limit.
+
+        Returns:
+            Path: The path of the cached file.
+        """
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+        with self._lock:
+            # Measure the directory on the first write and after every tenth of the limit
+            first_write = self._written is None
+            self._written = (self._written or 0) + len(data)
+            should_evict = first_write or self._written > self.max_bytes * 0.1
+            if should_evict:
+                self._written = 0
+        if should_evict:
+            self.evict()
+        return path
+
+    def get_or_create(self, key: str, build):
+        """
+        Returns the path of a cached file, calling `build()` for its bytes on a miss.
+        """
+        path = self.get(key)
+        if path is None:
+            path = self.put(key, build())
+        return path
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """
+        Deletes every cached file.
+
+        Returns:
+            int: The number of deleted files.
+        """
+        return self.delete_prefixed(None)
+
+    def delete_prefixed(self, prefixes):
+        """
+        Deletes every cached file whose key is one of `prefixes` followed by "_" and more, in
+        one pass over the cache. With `prefixes` None, every file is deleted.
+
+        Returns:
+            int: The number of deleted files.
+        """
+        # Every name starts with the empty prefix
+        prefixes = ("",) if prefixes is None else tuple(f"{prefix}_" for prefix in prefixes)
+        if not prefixes or not self.root.exists():
+            return 0
+        deleted = 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(prefixes) and not entry.name.endswith(".tmp"):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    deleted += 1
+        return deleted
+
+    def evict(self):
+        """
+        Deletes the least recently used files until the cache fits in its limit.
+
+        Returns:
+            int: The number of deleted files.
+        """
+        entries = []
+        total = 0
+        if not self.root.exists():
+            return 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return 0
+
+        to_free = total - int(self.max_bytes * EVICTION_TARGET)
+        freed = deleted = 0
+        for _, size, path in sorted(entries):
+            if freed >= to_free:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+            deleted += 1
+        logger.info(f"Evicted {deleted} files ({freed} bytes) from {self.directory}")
+        return deleted
@@ -1,7 +1,23 @@
+import hashlib
+import json
 import os
-from google.api_core.client_options import ClientOptions
+import threading
+import grpc
+import fitz  # PyMuPDF
+import proto
+from django.conf import settings as django_settings
+from django.db import transaction
 from google.cloud import documentai
-from ..models import PDFPage, Token, Settings
+from google.cloud.documentai_v1.services.document_processor_service.transports import (
+    DocumentProcessorServiceGrpcTransport,
+)
+import numpy as np
+from ..models import PDFFile, PDFPage, Token
+from .config import get_config
+from .content_hash import file_sha256
+from .documentai_store import document_key, load_document, save_document, split_document
+from .page_files import page_source, read_page_file
+from .token_store import PageTokens, delete_page_tokens, load_page_tokens, save_page_tokens
 from pathlib import Path
 from PyPDF2 import (
     PdfReader as PyPDF2Reader,
@@ -11,92 +27,254 @@ import logging
 
 logger = logging.getLogger("django")
 
+# The most pages Document AI accepts in one online processing request
+DOCUMENTAI_MAX_PAGES = 15
+
+# The Document AI cost recorded for each scanned page, in dollars
+DOCUMENTAI_PAGE_COST = 0.006
+
+# The number of tokens written per INSERT statement
+TOKEN_BATCH_SIZE = 500
+
+# Options for the Document AI gRPC channel, which is kept open across pages
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+# The configuration for the current configuration snapshot, and the Document AI client with
+# the fingerprint of the configuration it was built for
+_configuration = None
+_client = None
+_configuration_lock = threading.Lock()
 
-def initialize_configuration():
+
+def load_configuration(config=None):
     """
-    Initializes the application's configuration by setting up Google Application Credentials,
-    fetching application settings, and preparing Document AI client and options.
+    Sets up Google Application Credentials and reads the Document AI settings from the configuration.
+
+    Args:
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
 
     Returns:
-        tuple: Returns a tuple containing the configured process options, Document AI client,
-               and the full resource path for the client version.
+        tuple: Returns a tuple containing the configured process options and a dictionary of the
+               Document AI settings.
 
     Raises:
         FileNotFoundError: If the credentials file does not exist.
-        ImportError: If the required modules are not found.
-        Exception: General exceptions that could occur when setting up the client.
+        Exception: If the application settings cannot be fetched.
     """
-    logger.info("Initializing configuration...")
-    try:
-        # Set up Google Application Credentials
-        base_dir = Path(__file__).resolve().parent.parent.parent
-        creds_dir = base_dir / 'media' / 'creds'
+    config = config or get_config()
+
+    # Set up Google Application Credentials; a local fake server does not need them
+    if not django_settings.DOCUMENTAI_INSECURE_CHANNEL:
+        creds_dir = Path(django_settings.MEDIA_ROOT) / 'creds'
         cred_file = next(creds_dir.glob('*'), None)  # Get the first file in the creds directory
         if not cred_file or not cred_file.is_file():
             logger.error(f"No credentials file found in: {creds_dir}")
             raise FileNotFoundError(f"No credentials file found in: {creds_dir}")
         logger.info(f"Using credentials file: {cred_file}")
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(cred_file)
+    else:
+        cred_file = None
+
+    app_settings = config.settings
+    if app_settings is None:
+        logger.error("Failed to fetch application settings: no settings have been configured.")
+        raise Exception("Failed to fetch application settings: no settings have been configured.")
+
+    settings = {
+        "cred_file": str(cred_file) if cred_file else None,
+        "compute_style_info": app_settings.compute_style_info,
+        "enable_native_pdf_parsing": app_settings.enable_native_pdf_parsing,
+        "enable_image_quality_scores": app_settings.enable_image_quality_scores,
+        "enable_symbol": app_settings.enable_symbol,
+        "location": app_settings.location,
+        "project_id": app_settings.project_id,
+        "processor_id": app_settings.processor_id,
+        "processor_version": app_settings.processor_version,
+        "mime_type": app_settings.mime_type,
+    }
+
+    # Configure the process options
+    process_options = documentai.ProcessOptions(
+        ocr_config=documentai.OcrConfig(
+            compute_style_info=settings["compute_style_info"],
+            enable_native_pdf_parsing=settings["enable_native_pdf_parsing"],
+            enable_image_quality_scores=settings["enable_image_quality_scores"],
+            enable_symbol=settings["enable_symbol"],
+        )
+    )
+
+    return process_options, settings
 
-        settings = {}
 
-        # Fetch application settings from the database
+def get_api_endpoint(location: str):
+    """
+    Returns the Document AI endpoint for a location, unless overridden by `DOCUMENTAI_API_ENDPOINT`.
+    """
+    return django_settings.DOCUMENTAI_API_ENDPOINT or f"{location}-documentai.googleapis.com"
+
+
+def get_processor_version_path(settings: dict):
+    """
+    Returns the full resource path of the configured processor version.
+    """
+    return documentai.DocumentProcessorServiceClient.processor_version_path(
+        settings["project_id"],
+        settings["location"],
+        settings["processor_id"],
+        settings["processor_version"],
+    )
+
+
+def configuration_fingerprint(settings: dict):
+    """
+    Returns a fingerprint of everything a Document AI client and its process options depend on.
+
+    The credentials file is fingerprinted by its content, so replacing it under the same
+    name still produces a new fingerprint.
+
+    Args:
+        settings (dict): The Document AI settings returned by `load_configuration`.
+
+    Returns:
+        str: A SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    if settings["cred_file"]:
+        digest.update(settings["cred_file"].encode())
+        with open(settings["cred_file"], "rb") as file:
+            digest.update(file.read())
+    digest.update(json.dumps({key: value for key, value in settings.items() if key != "cred_file"}, sort_keys=True).encode())
+    digest.update(get_api_endpoint(settings["location"]).encode())
+    digest.update(str(django_settings.DOCUMENTAI_INSECURE_CHANNEL).encode())
+    return digest.hexdigest()
+
+
+def create_client(settings: dict):
+    """
+    Creates a Document AI client with a long-lived gRPC channel.
+
+    The channel sends keepalive pings so that it stays usable between pages instead of
+    being torn down and re-established with a new TLS handshake.
+
+    Args:
+        settings (dict): The Document AI settings returned by `load_configuration`.
+
+    Returns:
+        documentai.DocumentProcessorServiceClient: The client.
+    """
+    api_endpoint = get_api_endpoint(settings["location"])
+    if django_settings.DOCUMENTAI_INSECURE_CHANNEL:
+        channel = grpc.insecure_channel(api_endpoint, options=GRPC_CHANNEL_OPTIONS)
+    else:
+        channel = DocumentProcessorServiceGrpcTransport.create_channel(
+            f"{api_endpoint}:443",
+            credentials_file=settings["cred_file"],
+            options=GRPC_CHANNEL_OPTIONS,
+        )
+    return documentai.DocumentProcessorServiceClient(
+        transport=DocumentProcessorServiceGrpcTransport(channel=channel)
+    )
+
+
+def initialize_configuration(config=None):
+    """
+    Initializes the application's configuration by setting up Google Application Credentials,
+    fetching application settings, and preparing Document AI client and options.
+
+    The result is cached for the whole process until a new configuration snapshot is loaded.
+    The client is kept while the configuration fingerprint stays the same, so pages share one
+    client and channel; when it changes, the old client is closed and a new one is created.
+
+    Args:
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Returns:
+        tuple: Returns a tuple containing the configured process options, Document AI client,
+               and the full resource path for the client version.
+
+    Raises:
+        FileNotFoundError: If the credentials file does not exist.
+        ImportError: If the required modules are not found.
+        Exception: General exceptions that could occur when setting up the client.
+    """
+    global _configuration, _client
+    config = config or get_config()
+    with _configuration_lock:
+        if _configuration is not None and _configuration[0] is config:
+            return _configuration[1]
+
+        logger.info("Initializing configuration...")
         try:
-            app_settings = Settings.objects.first()
-            if app_settings:
-                settings["compute_style_info"] = app_settings.compute_style_info
-                settings["enable_native_pdf_parsing"] = app_settings.enable_native_pdf_parsing
-                settings["enable_image_quality_scores"] = app_settings.enable_image_quality_scores
-                settings["enable_symbol"] = app_settings.enable_symbol
-                settings["location"] = app_settings.location
-                settings["project_id"] = app_settings.project_id
-                settings["processor_id"] = app_settings.processor_id
-                settings["processor_version"] = app_settings.processor_version
-                settings["mime_type"] = app_settings.mime_type
+            process_options, settings = load_configuration(config)
+
+            # Reuse the client built for an identical configuration
+            fingerprint = configuration_fingerprint(settings)
+            if _client is None or _client[0] != fingerprint:
+                logger.info(f"Creating Document AI client for configuration {fingerprint[:12]}")
+                client = create_client(settings)
+                if _client is not None:
+                    # Requests still running on the old channel fail and are retried as failed pages
+                    _client[1].transport.close()
+                _client = (fingerprint, client)
+            client = _client[1]
+
+            client_version = get_processor_version_path(settings)
+
+            _configuration = (config, (process_options, client, client_version))
+            return _configuration[1]
+
+        except ImportError as e:
+            logger.error(f"Failed to import required modules: {e}")
+            raise ImportError(f"Failed to import required modules: {e}")
         except Exception as e:
-            logger.error(f"Failed to fetch application settings: {e}")
-            raise Exception(f"Failed to fetch application settings: {e}")
-
-        
-        # Configure the Document AI client and process options
-        process_options = documentai.ProcessOptions(
-            ocr_config=documentai.OcrConfig(
-                compute_style_info=settings["compute_style_info"],
-                enable_native_pdf_parsing=settings["enable_native_pdf_parsing"],
-                enable_image_quality_scores=settings["enable_image_quality_scores"],
-                enable_symbol=settings["enable_symbol"],
-            )
-        )
-        
-        client = documentai.DocumentProcessorServiceClient(
-            client_options=ClientOptions(
-                api_endpoint=f"{settings['location']}-documentai.googleapis.com"
-            )
-        )
-        
-        client_version = client.processor_version_path(
-            settings["project_id"],
-            settings["location"],
-            settings["processor_id"],
-            settings["processor_version"],
-        )
+            logger.error(f"An error occurred while initializing configuration: {e}")
+            raise Exception(f"An error occurred while initializing configuration: {e}")
 
-        return process_options, client, client_version
 
-    except ImportError as e:
-        logger.error(f"Failed to import required modules: {e}")
-        raise ImportError(f"Failed to import required modules: {e}")
-    except Exception as e:
-        logger.error(f"An error occurred while initializing configuration: {e}")
-        raise Exception(f"An error occurred while initializing configuration: {e}")
+def page_content_hash(pdf_page):
+    """
+    Returns a hex SHA-256 digest identifying the content of a page, without reading the page.
 
+    A page with its own PDF file is identified by its `sha256`. A virtual page is identified by
+    the hash of its PDF file and its page number, which does not change when its own hash is
+    recorded on first extraction. A hash missing from an older row is computed and saved.
 
-def process_page(page_id: int):
+    Args:
+        pdf_page (PDFPage): The page.
+
+    Returns:
+        str: The hex digest.
+    """
+    if pdf_page.file:
+        if not pdf_page.sha256:
+            pdf_page.sha256 = file_sha256(pdf_page.file.path)
+            PDFPage.objects.filter(id=pdf_page.id).update(sha256=pdf_page.sha256)
+        return pdf_page.sha256
+
+    pdf_file = pdf_page.pdf_file
+    if not pdf_file.sha256:
+        pdf_file.sha256 = file_sha256(pdf_file.file.path)
+        PDFFile.objects.filter(id=pdf_file.id).update(sha256=pdf_file.sha256)
+    return hashlib.sha256(f"{pdf_file.sha256}:{pdf_page.page_number}".encode()).hexdigest()
+
+
+def process_page(page_id: int, config=None):
     """
     Process a page using Document AI.
 
+    The raw result is stored by page content and OCR options, and a stored result is used
+    instead of calling Document AI again.
+
     Args:
         page_id (int): The ID of the page.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
 
     Raises:
         PDFPage.DoesNotExist: If the page with the specified ID does not exist.
@@ -107,7 +285,7 @@ def process_page(page_id: int):
     logger.info(f"Processing page {page_id}...")
     try:
         # Initialize configuration
-        process_options, client, client_version = initialize_configuration()
+        process_options, client, client_version = initialize_configuration(config)
 
         # Get the page from the database
         try:
@@ -116,33 +294,38 @@ def process_page(page_id: int):
             logger.error(f"Page with ID {page_id} does not exist")
             raise PDFPage.DoesNotExist(f"Page with ID {page_id} does not exist")
 
-        # Read the file content
-        try:
-            with open(pdf_page.file.path, "rb") as file:
-                content = file.read()
-        except IOError as e:
-            logger.error(f"Failed to read the file: {e}")
-            raise IOError(f"Failed to read the file: {e}")
-
         # Prepare the request
         try:
-            request = documentai.ProcessRequest(
-                name=client_version,
-                raw_document=documentai.RawDocument(
-                    content=content, mime_type="application/pdf"
-                ),
-                process_options=process_options,
-            )
-
-            # Process the document
-            response = client.process_document(request=request)
-            document = response.document
+            key = document_key(page_content_hash(pdf_page), process_options, client_version)
+            document = load_document(key)
+            if document is not None:
+                logger.info(f"Using the stored Document AI result for page {page_id}")
+            else:
+                # Read the file content
+                try:
+                    content = read_page_file(pdf_page)
+                except IOError as e:
+                    logger.error(f"Failed to read the file: {e}")
+                    raise IOError(f"Failed to read the file: {e}")
+
+                request = documentai.ProcessRequest(
+                    name=client_version,
+                    raw_document=documentai.RawDocument(
+                        content=content, mime_type="application/pdf"
+                    ),
+                    process_options=process_options,
+                )
+
+                # Process the document
+                response = client.process_document(request=request)
+                document = response.document
+                save_document(key, document)
 
             # Extract page dimensions
-            page_width, page_height = get_page_dimensions(pdf_page.file.path)
+            page_width, page_height = get_page_dimensions(*page_source(pdf_page))
 
             # Process the tokens extracted from the document
-            process_tokens(pdf_page, document, page_width, page_height)
+            process_tokens(pdf_page, document, page_width, page_height, config=config)
         except ValueError as e:
             logger.error(f"Document processing failed: {e}")
             raise ValueError(f"Document processing failed: {e}")
@@ -155,15 +338,172 @@ def process_page(page_id: int):
         raise Exception(f"Failed to process page {page_id}: {e}")
 
 
-def process_tokens(pdf_page, document, page_width, page_height):
+def replay_page(page_id: int, config=None):
+    """
+    Rebuilds the tokens of a page from its stored Document AI result, without calling Document AI.
+
+    Args:
+        page_id (int): The ID of the page.
+        config (ConfigSnapshot, optional): The configuration whose OCR options the result was
+            stored under. Defaults to the current one.
+
+    Returns:
+        int: The number of tokens saved.
+
+    Raises:
+        LookupError: If no result is stored for the page's content and options.
+    """
+    process_options, settings = load_configuration(config)
+    client_version = get_processor_version_path(settings)
+
+    pdf_page = PDFPage.objects.get(id=page_id)
+    key = document_key(page_content_hash(pdf_page), process_options, client_version)
+    document = load_document(key)
+    if document is None:
+        raise LookupError(f"No stored Document AI result for page {page_id}")
+
+    with transaction.atomic():
+        delete_page_tokens(pdf_page)
+        page_width, page_height = get_page_dimensions(*page_source(pdf_page))
+        process_tokens(pdf_page, document, page_width, page_height, config=config)
+
+    pdf_page.refresh_from_db()
+    page_tokens = load_page_tokens(pdf_page)
+    return len(page_tokens) if page_tokens is not None else pdf_page.tokens.count()
+
+
+def group_page_ranges(page_ids: list, max_pages: int):
+    """
+    Groups pages into runs of consecutive pages of the same PDF file.
+
+    Args:
+        page_ids (list): The list of page IDs.
+        max_pages (int): The maximum number of pages in a group.
+
+    Returns:
+        list: A list of lists of page IDs, each ordered by page number.
+    """
+    pages = PDFPage.objects.filter(id__in=page_ids).order_by("pdf_file_id", "page_number")
+    groups = []
+    previous = None
+    for pdf_page in pages:
+        if (
+            previous is not None
+            and pdf_page.pdf_file_id == previous.pdf_file_id
+            and pdf_page.page_number == previous.page_number + 1
+            and len(groups[-1]) < max_pages
+        ):
+            groups[-1].append(pdf_page.id)
+        else:
+            groups.append([pdf_page.id])
+        previous = pdf_page
+
+    # Pages that could not be found are kept so that their errors are reported
+    found = {page_id for group in groups for page_id in group}
+    groups += [[page_id] for page_id in page_ids if page_id not in found]
+    return groups
+
+
+def extract_page_range(pdf_path, first_page_number: int, last_page_number: int):
+    """
+    Extracts a range of pages from a PDF into a new PDF.
+
+    Args:
+        pdf_path (str): The path to the source PDF.
+        first_page_number (int): The first page to extract, starting at 1.
+        last_page_number (int): The last page to extract, inclusive.
+
+    Returns:
+        bytes: The content of the new PDF.
+    """
+    with fitz.open(pdf_path) as source:
+        with fitz.open() as sub_doc:
+            sub_doc.insert_pdf(source, from_page=first_page_number - 1, to_page=last_page_number - 1)
+            return sub_doc.tobytes(garbage=4, deflate=True)
+
+
+def process_page_range(page_ids: list, config=None):
+    """
+    Process a run of consecutive pages of one PDF file with a single Document AI request.
+
+    The pages are cut from the original PDF file and sent together, and the returned
+    `document.pages` are saved to the matching PDFPage rows by page number. Each page's part
+    of the result is stored like in `process_page`, and no request is made when every page
+    has a stored result.
+
+    Args:
+        page_ids (list): The IDs of consecutive pages of the same PDF file.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Raises:
+        ValueError: If the pages are not consecutive pages of one file, or the response
+            does not hold one page per requested page.
+        Exception: For any other unexpected issues.
+    """
+    if len(page_ids) == 1:
+        return process_page(page_ids[0], config)
+
+    logger.info(f"Processing pages {page_ids} in one request...")
+    try:
+        process_options, client, client_version = initialize_configuration(config)
+
+        pdf_pages = list(PDFPage.objects.filter(id__in=page_ids).select_related("pdf_file").order_by("page_number"))
+        if len(pdf_pages) != len(page_ids):
+            raise ValueError("Some of the pages do not exist.")
+        first_page, last_page = pdf_pages[0], pdf_pages[-1]
+        if (
+            len({pdf_page.pdf_file_id for pdf_page in pdf_pages}) != 1
+            or last_page.page_number - first_page.page_number + 1 != len(pdf_pages)
+        ):
+            raise ValueError("Pages must be consecutive pages of the same PDF file.")
+
+        keys = [document_key(page_content_hash(pdf_page), process_options, client_version) for pdf_page in pdf_pages]
+        page_documents = [load_document(key) for key in keys]
+
+        if any(page_document is None for page_document in page_documents):
+            content = extract_page_range(first_page.pdf_file.file.path, first_page.page_number, last_page.page_number)
+
+            request = documentai.ProcessRequest(
+                name=client_version,
+                raw_document=documentai.RawDocument(content=content, mime_type="application/pdf"),
+                process_options=process_options,
+            )
+            response = client.process_document(request=request)
+            document = response.document
+
+            if len(document.pages) != len(pdf_pages):
+                raise ValueError(f"Expected {len(pdf_pages)} pages in the response, got {len(document.pages)}.")
+
+            page_documents = [split_document(document, page_offset) for page_offset in range(len(pdf_pages))]
+            for key, page_document in zip(keys, page_documents):
+                save_document(key, page_document)
+        else:
+            logger.info(f"Using the stored Document AI results for pages {page_ids}")
+
+        # Spread the returned pages back onto their PDFPage rows
+        for pdf_page, page_document in zip(pdf_pages, page_documents):
+            page_width, page_height = get_page_dimensions(*page_source(pdf_page))
+            process_tokens(pdf_page, page_document, page_width, page_height, config=config)
+
+    except Exception as e:
+        logger.error(f"Failed to process pages {page_ids}: {e}")
+        raise Exception(f"Failed to process pages {page_ids}: {e}")
+
+
+def process_tokens(pdf_page, document, page_width, page_height, config=None):
     """
     Process the tokens in a Document AI document and save them as Token instances.
 
+    The coordinates of each page are converted in one array operation, and all Token rows
+    are built in memory and written in batches inside a single transaction. With the
+    `columnar` token storage setting the tokens are saved as one token blob instead.
+
     Args:
         pdf_page (PDFPage): The PDFPage object.
         document (documentai.Document): The Document AI document.
         page_width (float): The width of the PDF page.
         page_height (float): The height of the PDF page.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
 
     Raises:
         ValueError: If any parameters are missing or incorrect.
@@ -180,46 +520,56 @@ def process_tokens(pdf_page, document, page_width, page_height):
             logger.error("Document contains no text.")
             raise ValueError("Document contains no text.")
 
-        # Iterate over each page in the document
-        for page_number, page in enumerate(document.pages, start=1):
-            # Iterate over each token in the page
-            for token_number, token in enumerate(page.tokens, start=1):
+        # Read the underlying protobuf messages, which are much faster to access than their wrappers
+        pages = documentai.Document.pb(document).pages
 
-                # Get the bounding box of the token
-                bounding_box = token.layout.bounding_poly
-                if not bounding_box.normalized_vertices:
+        token_ids = []
+        token_infos = []
+        bboxes = []
+        # Iterate over each page in the document
+        for page_number, page in enumerate(pages, start=1):
+            tokens = page.tokens
+            if not tokens:
+                continue
+
+            # Get the corners of every token's bounding box
+            corners = []
+            for token in tokens:
+                vertices = token.layout.bounding_poly.normalized_vertices
+                if len(vertices) < 3:
                     logger.error("Bounding box coordinates are missing for a token.")
                     raise ValueError("Bounding box coordinates are missing for a token.")
+                corners.append((vertices[0].x, vertices[0].y, vertices[2].x, vertices[2].y))
 
-                # Convert the normalized coordinates to the PDF's coordinate system
-                try:
-                    x1, y1, x2, y2 = convert_coordinates(
-                        bounding_box.normalized_vertices, page_width, page_height
-                    )
-                except Exception as e:
-                    logger.error(f"Error converting coordinates: {e}")
-                    raise Exception(f"Error converting coordinates: {e}")
-
-                token_id = f"page{page_number}_token{token_number}"
-                token_info = token_info_to_dict(token, document_text)
-                token_confidence = token.layout.confidence
-
-                # Create and save a Token instance
-                try:
-                    token_instance = Token.objects.create(
-                        page=pdf_page,
-                        token_id=token_id,
-                        x1=x1,
-                        y1=y1,
-                        x2=x2,
-                        y2=y2,
-                        token_confidence=token_confidence,
-                    )
+            # Convert the normalized coordinates of the whole page to the PDF's coordinate system
+            try:
+                bboxes.append(convert_coordinates(corners, page_width, page_height))
+            except Exception as e:
+                logger.error(f"Error converting coordinates: {e}")
+                raise Exception(f"Error converting coordinates: {e}")
+
+            for token_number, token in enumerate(tokens, start=1):
+                token_ids.append(f"page{page_number}_token{token_number}")
+                token_infos.append(token_info_to_dict(token, document_text))
+
+        bboxes = np.vstack(bboxes) if bboxes else np.zeros((0, 4))
+        settings_obj = (config or get_config()).settings
+
+        # Save all the tokens at once
+        try:
+            if settings_obj is not None and settings_obj.token_storage == "columnar":
+                save_page_tokens(pdf_page, PageTokens.from_token_infos(bboxes, token_infos))
+            else:
+                token_instances = []
+                for token_id, token_info, (x1, y1, x2, y2) in zip(token_ids, token_infos, bboxes.tolist()):
+                    token_instance = Token(page=pdf_page, token_id=token_id, x1=x1, y1=y1, x2=x2, y2=y2)
                     token_instance.set_token_info(token_info)
-                    token_instance.save()
-                except Exception as e:
-                    logger.error(f"Failed to create or save token {token_id}: {e}")
-                    raise Exception(f"Failed to create or save token {token_id}: {e}")
+                    token_instances.append(token_instance)
+                with transaction.atomic():
+                    Token.objects.bulk_create(token_instances, batch_size=TOKEN_BATCH_SIZE)
+        except Exception as e:
+            logger.error(f"Failed to save the tokens of page {pdf_page.id}: {e}")
+            raise Exception(f"Failed to save the tokens of page {pdf_page.id}: {e}")
 
     except ValueError as ve:
         logger.error(f"Token processing error: {ve}")
@@ -229,12 +579,13 @@ def process_tokens(pdf_page, document, page_width, page_height):
         raise Exception(f"An unexpected error occurred during token processing: {e}")
 
 
-def get_page_dimensions(input_pdf_path):
+def get_page_dimensions(input_pdf_path, page_index: int = 0):
     """
-    Gets the dimensions of the first page of a PDF.
+    Gets the dimensions of a page of a PDF.
 
     Args:
         input_pdf_path (str): The path to the input PDF.
+        page_index (int, optional): The index of the page. Defaults to the first page.
 
     Returns:
         tuple: The width and height of the page.
@@ -262,8 +613,8 @@ def get_page_dimensions(input_pdf_path):
             logger.error("The PDF file is empty or does not contain any readable pages.")
             raise ValueError("The PDF file is empty or does not contain any readable pages.")
 
-        # Access the first page
-        page = pdf.pages[0]
+        # Access the page
+        page = pdf.pages[page_index]
 
         # Try to get one of the defined boxes for dimensions
         box = page.mediabox or page.artbox or page.bleedbox or page.cropbox or page.trimbox
@@ -282,25 +633,23 @@ def get_page_dimensions(input_pdf_path):
         raise Exception(f"An unexpected error occurred while obtaining page dimensions: {e}")
 
 
-def convert_coordinates(normalized_vertices, page_width, page_height):
-    
+def convert_coordinates(corners, page_width, page_height):
     """
-    Converts normalized coordinates to the PDF's coordinate system.
+    Converts normalized coordinates to the PDF's coordinate system, for every token of a page at once.
 
     Args:
-        normalized_vertices (list): The normalized vertices, expecting at least two points for a rectangle.
+        corners (array-like): One row of (x1, y1, x2, y2) per token, with the normalized
+            coordinates of the first and third vertex of its bounding box.
         page_width (float): The width of the PDF page.
         page_height (float): The height of the PDF page.
 
     Returns:
-        tuple: The converted coordinates (x1, y1, x2, y2).
+        numpy.ndarray: The converted coordinates, with one row of (x1, y1, x2, y2) per token.
 
     Raises:
-        ValueError: If the input vertices are not valid or insufficient.
+        ValueError: If the input corners are not valid.
         TypeError: If the input types are incorrect.
     """
-    # logger.info("Converting coordinates...")
-
     try:
         # Ensure the page dimensions are of float type and properly converted
         page_width = float(page_width)
@@ -309,17 +658,15 @@ def convert_coordinates(normalized_vertices, page_width, page_height):
         logger.error("Page width and height must be numbers that can be converted to float.")
         raise TypeError("Page width and height must be numbers that can be converted to float.")
 
-    # Attempt to calculate the coordinates, ensuring each vertex has an x and y attribute
-    try:
-        x1 = normalized_vertices[0].x * page_width
-        y1 = page_height - normalized_vertices[0].y * page_height
-        x2 = normalized_vertices[2].x * page_width
-        y2 = page_height - normalized_vertices[2].y * page_height
-    except AttributeError:
-        logger.error("Each vertex must have 'x' and 'y' attributes.")
-        raise ValueError("Each vertex must have 'x' and 'y' attributes as float types.")
+    corners = np.asarray(corners, dtype=np.float64)
+    if corners.ndim != 2 or corners.shape[1] != 4:
+        logger.error("Corners must have one row of four coordinates per token.")
+        raise ValueError("Corners must have one row of four coordinates per token.")
 
-    return x1, y1, x2, y2
+    # x is scaled to the page width; y is scaled and flipped, since PDF coordinates start at the bottom
+    scale = np.array([page_width, -page_height, page_width, -page_height])
+    offset = np.array([0.0, page_height, 0.0, page_height])
+    return corners * scale + offset
 
 
 def token_info_to_dict(token, document_text):
@@ -327,7 +674,7 @@ def token_info_to_dict(token, document_text):
     Converts a `Token` object to a dictionary.
 
     Args:
-        token (documentai.Token): The token object.
+        token (documentai.Document.Page.Token): The token object, or its underlying protobuf message.
         document_text (str): The text of the document.
 
     Returns:
@@ -344,6 +691,9 @@ def token_info_to_dict(token, document_text):
             logger.error("Token object or document text cannot be None.")
             raise ValueError("Token object or document text cannot be None.")
 
+        if isinstance(token, proto.Message):
+            token = type(token).pb(token)
+
         # Extract text segment indices safely
         try:
             start_index = token.layout.text_anchor.text_segments[0].start_index
@@ -0,0 +1,128 @@
+# documentai_store.py
+
+import hashlib
+import os
+import uuid
+import zlib
+from pathlib import Path
+from django.conf import settings as django_settings
+from google.cloud import documentai
+import logging
+
+logger = logging.getLogger("django")
+
+# Raw Document AI results are kept as zlib-compressed binary protobuf files, keyed by a hash
+# of the page content, the OCR options and the processor version. A page whose bytes and
+# options have not changed can be turned into tokens again without calling Document AI.
+# The page content is identified by a hash known beforehand, so looking a result up does not
+# read the page.
+
+
+def get_store_dir():
+    """
+    Returns the directory holding the stored Document AI results.
+    """
+    return Path(django_settings.MEDIA_ROOT) / "documentai_results"
+
+
+def document_key(content_sha256: str, process_options, client_version: str):
+    """
+    Returns the key of the Document AI result for a page.
+
+    Args:
+        content_sha256 (str): The hex SHA-256 digest identifying the page's content, as
+            returned by `documentAI.page_content_hash`.
+        process_options (documentai.ProcessOptions): The OCR options.
+        client_version (str): The full resource path of the processor version.
+
+    Returns:
+        str: A SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(bytes.fromhex(content_sha256))
+    digest.update(documentai.ProcessOptions.serialize(process_options))
+    digest.update(client_version.encode())
+    return digest.hexdigest()
+
+
+def get_document_path(key: str):
+    return get_store_dir() / key[:2] / f"{key}.pb.z"
+
+
+def load_document(key: str):
+    """
+    Loads a stored Document AI result.
+
+    Returns:
+        documentai.Document: The document, or None if none is stored under the key or the
+            stored file cannot be read.
+    """
+    path = get_document_path(key)
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except FileNotFoundError:
+        return None
+
+    try:
+        return documentai.Document.deserialize(zlib.decompress(data))
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable Document AI result {path}: {e}")
+        return None
+
+
+def save_document(key: str, document):
+    """
+    Stores a Document AI result under its key.
+
+    The file is written under a temporary name and renamed into place, so concurrent readers
+    never see a partial file.
+    """
+    path = get_document_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(zlib.compress(documentai.Document.serialize(document)))
+        os.replace(temp_path, path)
+    except OSError as e:
+        # The result only saves a future request, so failing to store it is not fatal
+        logger.warning(f"Failed to store Document AI result {path}: {e}")
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def split_document(document, page_offset: int):
+    """
+    Returns a document holding only one page of a multi-page document.
+
+    The text is cut down to the span that the page's text anchors refer to, and the anchors
+    are shifted to match, so each stored page holds only its own text.
+    """
+    source = documentai.Document.pb(document)
+    page_document = type(source)(mime_type=source.mime_type)
+    page = page_document.pages.add()
+    page.CopyFrom(source.pages[page_offset])
+
+    segments = list(_text_segments(page))
+    start = min((segment.start_index for segment in segments), default=0)
+    end = max((segment.end_index for segment in segments), default=0)
+    for segment in segments:
+        segment.start_index -= start
+        segment.end_index -= start
+    page_document.text = source.text[start:end]
+    return documentai.Document.wrap(page_document)
+
+
+def _text_segments(message):
+    """
+    Yields every text anchor segment in a protobuf message and the messages it contains.
+    """
+    for field, value in message.ListFields():
+        if field.message_type is None or field.message_type.GetOptions().map_entry:
+            continue
+        for item in value if field.label == field.LABEL_REPEATED else [value]:
+            if field.message_type.name == "TextSegment":
+                yield item
+            else:
+                yield from _text_segments(item)
@@ -0,0 +1,228 @@
+# fake_apis.py
+
+import json
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import fitz  # PyMuPDF
+import grpc
+from google.cloud import documentai
+import logging
+
+logger = logging.getLogger("django")
+
+# Local stand-ins for the OpenAI and Document AI APIs, so the scanning pipelines can be run
+# and tested without network access or API keys. Point the app at them with the
+# OPENAI_API_BASE, DOCUMENTAI_API_ENDPOINT and DOCUMENTAI_INSECURE_CHANNEL settings.
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        self.server.requests.append(payload)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        text = payload["messages"][-1]["content"]
+        if payload.get("response_format", {}).get("type") == "json_object":
+            content = json.dumps({"title": text.split("\n")[0][:80], "content": text, "source": ""})
+        else:
+            content = text
+
+        prompt_tokens = sum(len(message["content"].split()) for message in payload["messages"])
+        completion_tokens = len(content.split())
+        self._send(200, {
+            "id": f"chatcmpl-fake-{len(self.server.requests)}",
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def _send(self, status_code, body):
+        data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in self.server.rate_limit_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Fake OpenAI server: {format % args}")
+
+
+class FakeOpenAIServer:
+    """
+    A local HTTP server that answers OpenAI chat completion requests.
+
+    Text requests echo the user message back; JSON requests wrap it in a small JSON object.
+    Responses report their usage in words and carry fixed rate limit headers. Every request
+    payload is recorded in `requests`.
+
+    Args:
+        port (int, optional): The port to listen on. Defaults to a free port.
+        latency (float, optional): Seconds to wait before answering, to simulate the real API.
+        requests_per_minute (int, optional): The request limit reported in the headers.
+        tokens_per_minute (int, optional): The token limit reported in the headers.
+    """
+    def __init__(self, port=0, latency=0.0, requests_per_minute=10000, tokens_per_minute=10000000):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _OpenAIHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.requests = []
+        self.httpd.latency = latency
+        self.httpd.rate_limit_headers = {
+            "x-ratelimit-limit-requests": str(requests_per_minute),
+            "x-ratelimit-limit-tokens": str(tokens_per_minute),
+        }
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def api_base(self):
+        """
+        The value to use for the OPENAI_API_BASE setting.
+        """
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def fake_document(content: bytes):
+    """
+    Builds a Document AI `Document` for a PDF from the words in its text layer.
+
+    Every page of the PDF becomes a page of the document, with one token per word. Pages
+    without a text layer get a single placeholder token.
+
+    Args:
+        content (bytes): The PDF bytes sent to the processor.
+
+    Returns:
+        documentai.Document: The document.
+    """
+    text = ""
+    pages = []
+    with fitz.open(stream=content, filetype="pdf") as pdf:
+        for page_number, page in enumerate(pdf, start=1):
+            width, height = page.rect.width, page.rect.height
+            words = page.get_text("words") or [(0, 0, width / 4, height / 20, "[blank]", 0, 0, 0)]
+
+            tokens = []
+            for index, (x0, y0, x1, y1, word, *_) in enumerate(words):
+                last = index + 1 == len(words) or words[index + 1][5:7] != tuple(words[index][5:7])
+                token_text = word + ("\n" if last else " ")
+                start_index = len(text)
+                text += token_text
+
+                normalized = [(x0 / width, y0 / height), (x1 / width, y0 / height), (x1 / width, y1 / height), (x0 / width, y1 / height)]
+                tokens.append(documentai.Document.Page.Token(
+                    layout=documentai.Document.Page.Layout(
+                        text_anchor=documentai.Document.TextAnchor(text_segments=[
+                            documentai.Document.TextAnchor.TextSegment(start_index=start_index, end_index=len(text))
+                        ]),
+                        confidence=0.99,
+                        bounding_poly=documentai.BoundingPoly(
+                            vertices=[documentai.Vertex(x=int(x * width), y=int(y * height)) for x, y in normalized],
+                            normalized_vertices=[documentai.NormalizedVertex(x=x, y=y) for x, y in normalized],
+                        ),
+                    ),
+                    style_info=documentai.Document.Page.Token.StyleInfo(
+                        font_size=int(y1 - y0),
+                        pixel_font_size=float(y1 - y0),
+                        text_color={"red": 0.0, "green": 0.0, "blue": 0.0},
+                        background_color={"red": 1.0, "green": 1.0, "blue": 1.0},
+                    ),
+                ))
+
+            pages.append(documentai.Document.Page(
+                page_number=page_number,
+                dimension=documentai.Document.Page.Dimension(width=width, height=height, unit="points"),
+                tokens=tokens,
+            ))
+
+    return documentai.Document(text=text, pages=pages, mime_type="application/pdf")
+
+
+class FakeDocumentAIServer:
+    """
+    A local gRPC server implementing Document AI's `ProcessDocument` call.
+
+    It works with both the synchronous and the asyncio Document AI clients when they are
+    connected over an insecure channel. Every request is recorded in `requests`.
+
+    Args:
+        port (int, optional): The port to listen on. Defaults to a free port.
+        latency (float, optional): Seconds to wait before answering, to simulate the real API.
+        max_workers (int, optional): The number of requests served at once.
+    """
+    def __init__(self, port=0, latency=0.0, max_workers=32):
+        self.latency = latency
+        self.requests = []
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+        self.server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(
+            "google.cloud.documentai.v1.DocumentProcessorService",
+            {
+                "ProcessDocument": grpc.unary_unary_rpc_method_handler(
+                    self._process_document,
+                    request_deserializer=documentai.ProcessRequest.deserialize,
+                    response_serializer=documentai.ProcessResponse.serialize,
+                ),
+            },
+        ),))
+        self.port = self.server.add_insecure_port(f"127.0.0.1:{port}")
+
+    @property
+    def api_endpoint(self):
+        """
+        The value to use for the DOCUMENTAI_API_ENDPOINT setting.
+        """
+        return f"127.0.0.1:{self.port}"
+
+    def _process_document(self, request, context):
+        self.requests.append(request)
+        if self.latency:
+            time.sleep(self.latency)
+        return documentai.ProcessResponse(document=fake_document(request.raw_document.content))
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(grace=None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,17 +1,27 @@
-from ..models import PDFPage, Settings
+from ..models import PDFPage
+from .config import get_config
+from .token_store import load_page_tokens
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Avg, Case, Count, F, Q, Value, When
+from django.db.models.lookups import GreaterThan
+from functools import reduce
 import numpy as np
+import operator
 import logging
 
 logger = logging.getLogger("django")
 
 
-def token_filter(page_id: int):
+def token_filter(page_id: int, config=None):
     """
     Filters tokens based on specified criteria.
 
+    Token rows are filtered with a single UPDATE over their promoted columns, and token
+    blobs with array operations over the whole page.
+
     Args:
         page_id (int): The ID of the PDFPage instance.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
 
     Raises:
         ObjectDoesNotExist: If the PDFPage instance does not exist.
@@ -21,9 +31,9 @@ def token_filter(page_id: int):
     logger.info(f"Filtering tokens for page {page_id}...")
     settings = {}
 
-    # Get the settings from the database
+    # Get the settings from the configuration
     try:
-        settings_obj = Settings.objects.first()
+        settings_obj = (config or get_config()).settings
         if settings_obj:
             settings = {
                 "color_filter": settings_obj.color_filter,
@@ -45,55 +55,28 @@ def token_filter(page_id: int):
             logger.error(f"PDFPage with ID {page_id} does not exist.")
             raise ObjectDoesNotExist(f"PDFPage with ID {page_id} does not exist.")
 
-        # Get all Token objects related to this PDFPage instance
+        # Filter a columnar token blob in place
+        page_tokens = load_page_tokens(pdf_page, writable=True)
+        if page_tokens is not None:
+            filter_page_tokens(page_tokens, settings)
+            return
+
         tokens = pdf_page.tokens.all()
 
-        # Calculate average color
-        try:
-            avg_color = average_color(tokens)  # Ensure this function is properly defined
-        except Exception as e:
-            logger.error(f"Error calculating average color: {e}")
-            raise ValueError(f"Error calculating average color: {e}")
-
-        for token in tokens:
-            token_info = token.get_token_info()  # Assume this method is well-defined
-
-            # Update the color for the current token
-            try:
-                color = np.array([
-                    token_info["style_info"]["text_color"]["red"],
-                    token_info["style_info"]["text_color"]["green"],
-                    token_info["style_info"]["text_color"]["blue"]
-                ])
-            except KeyError as e:
-                logger.error(f"Token information is incomplete: {e}")
-                raise ValueError(f"Token information is incomplete: {e}")
-
-            try:
-                # Check if the token's color is similar to the average color
-                if settings["color_filter"]:
-                    color_distance = np.linalg.norm(color - avg_color)
-                    if color_distance > settings["color_similarity_threshold"]:
-                        token.filtered = True
-                        token.save()
-
-                # Check if the token is handwritten
-                if settings["handwritten_filter"] and token_info["style_info"]["handwritten"]:
-                    token.filtered = True
-                    token.save()
-
-                # Check if the token contains unicode characters
-                if settings["unicode_filter"] and any(ord(char) > 127 for char in token_info["text"]):
-                    token.filtered = True
-                    token.save()
-
-                # Check if the token's confidence is less than the threshold
-                if settings["confidence_filter"] and token_info["layout"]["confidence"] < settings["confidence_filter"]:
-                    token.filtered = True
-                    token.save()
-            except Exception as e:
-                logger.error(f"Error processing token {token.id}: {e}")
-                raise ValueError(f"Error processing token {token.id}: {e}")
+        # Average color of the page's tokens
+        avg_color = tokens.aggregate(
+            red=Avg("color_red"), green=Avg("color_green"), blue=Avg("color_blue"), count=Count("id")
+        )
+        if not avg_color["count"]:
+            logger.info(f"No tokens to filter for page {page_id}.")
+            return
+
+        # Set every token's flag with one UPDATE over the promoted token columns
+        conditions = filter_conditions(avg_color, settings)
+        filtered_count = tokens.update(
+            filtered=Case(When(conditions, then=Value(True)), default=Value(False)) if conditions else Value(False)
+        )
+        logger.info(f"Updated the filtered flag of {filtered_count} tokens for page {page_id}.")
 
     except Exception as e:
         logger.error(f"Failed to filter tokens for page {page_id}: {e}")
@@ -101,51 +84,99 @@ def token_filter(page_id: int):
         raise Exception(f"Failed to filter tokens for page {page_id}: {e}")
 
 
-def average_color(tokens):
+def filter_conditions(avg_color: dict, settings: dict):
     """
-    Calculates the average color of a list of tokens.
+    Builds the conditions under which a Token row is filtered out.
 
     Args:
-        tokens (list): A list of tokens.
+        avg_color (dict): The average `red`, `green` and `blue` of the page's tokens.
+        settings (dict): The filter settings built by `token_filter`.
 
     Returns:
-        numpy.ndarray: The average color as a numpy array with shape (3,).
+        Q: The combined conditions, or None if every filter is off.
+    """
+    conditions = []
 
-    Raises:
-        ValueError: If tokens are empty or color data is incomplete.
-        Exception: For any other unexpected issues.
+    # Tokens whose color is far from the page's average color, comparing squared distances
+    if settings["color_filter"]:
+        squared_distance = sum(
+            (F(f"color_{channel}") - avg_color[channel]) * (F(f"color_{channel}") - avg_color[channel])
+            for channel in ("red", "green", "blue")
+        )
+        threshold = settings["color_similarity_threshold"]
+        conditions.append(Q(GreaterThan(squared_distance, threshold * threshold)))
+
+    if settings["handwritten_filter"]:
+        conditions.append(Q(handwritten=True))
+
+    if settings["unicode_filter"]:
+        conditions.append(Q(text__regex=r"[^\x00-\x7f]"))
+
+    if settings["confidence_filter"]:
+        conditions.append(Q(token_confidence__lt=settings["confidence_filter"]))
+
+    # Tokens in a font smaller than the threshold; tokens without a detected size are kept
+    if settings["font_size_filter"]:
+        conditions.append(Q(font_size__gt=0, font_size__lt=settings["font_size_filter"]))
+
+    if not conditions:
+        return None
+    return reduce(operator.or_, conditions)
+
+
+def filter_mask(colors, confidence, font_size, handwritten, non_ascii, settings: dict):
     """
-    logger.info("Calculating average color...")
-    try:
-        if not tokens:
-            raise ValueError("Token list is empty.")
-
-        colors = []
-        for token in tokens:
-            try:
-                token_info = token.get_token_info()  # Ensure this method is properly defined
-                color = token_info["style_info"]["text_color"]
-                colors.append([color["red"], color["green"], color["blue"]])
-            except KeyError as e:
-                logger.error(f"Missing color information in a token: {e}")
-                raise ValueError(f"Missing color information in a token: {e}")
-
-        if not colors:
-            raise ValueError("No valid color data found in tokens.")
+    Computes which tokens of a page are filtered out, with array operations over the whole page.
 
-        try:
-            average_color = np.mean(colors, axis=0)
-        except TypeError as e:
-            logger.error(f"Error calculating average due to data type issues: {e}")
-            raise TypeError(f"Error calculating average due to data type issues: {e}")
-        except Exception as e:
-            logger.error(f"Error calculating average color: {e}")
-            raise Exception(f"Error calculating average color: {e}")
+    Args:
+        colors (numpy.ndarray): The (N, 3) text colors of the tokens.
+        confidence (numpy.ndarray): The OCR confidence of each token.
+        font_size (numpy.ndarray): The font size of each token, 0 when Document AI did not detect one.
+        handwritten (numpy.ndarray): Whether each token is handwritten.
+        non_ascii (numpy.ndarray): Whether each token contains characters beyond ASCII.
+        settings (dict): The filter settings built by `token_filter`.
 
-        return average_color
+    Returns:
+        numpy.ndarray: A boolean array, True for the tokens to filter out.
+    """
+    mask = np.zeros(len(confidence), dtype=bool)
+    if len(mask) == 0:
+        return mask
 
-    except Exception as e:
-        logger.error(f"Failed to calculate average color: {e}")
-        # General exception for any other issues that are not caught by specific exceptions
-        raise Exception(f"Failed to calculate average color: {e}")
-        
\ No newline at end of file
+    # Tokens whose color is far from the page's average color
+    if settings["color_filter"]:
+        avg_color = colors.mean(axis=0)
+        mask |= np.linalg.norm(colors - avg_color, axis=1) > settings["color_similarity_threshold"]
+
+    if settings["handwritten_filter"]:
+        mask |= handwritten
+
+    if settings["unicode_filter"]:
+        mask |= non_ascii
+
+    if settings["confidence_filter"]:
+        mask |= confidence < settings["confidence_filter"]
+
+    # Tokens in a font smaller than the threshold; tokens without a detected size are kept
+    if settings["font_size_filter"]:
+        mask |= (font_size > 0) & (font_size < settings["font_size_filter"])
+
+    return mask
+
+
+def filter_page_tokens(page_tokens, settings: dict):
+    """
+    Applies the filters to the columns of a token blob, saving the flags in the blob.
+
+    Args:
+        page_tokens (PageTokens): The tokens, opened writable so the flags are saved to the blob.
+        settings (dict): The filter settings built by `token_filter`.
+    """
+    page_tokens.filtered[:] = filter_mask(
+        page_tokens.color,
+        page_tokens.confidence,
+        page_tokens.font_size,
+        page_tokens.handwritten,
+        page_tokens.non_ascii(),
+        settings,
+    )
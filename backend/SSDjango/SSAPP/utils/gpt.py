@@ -1,7 +1,16 @@
-from ..models import PDFPage, GPTResponse, AppKeys, Settings
+from ..models import PDFPage, GPTResponse
+from .config import get_config
+from .gpt_cache import get_cached_response, gpt_cache_key, store_response
+from .http_session import post_with_retries
+from .rate_limit import choose_api_key, reports_remaining_tokens
+from .token_store import load_page_tokens
+import os
+import time
+from functools import lru_cache
 import tiktoken
 import requests
 import json
+from django.conf import settings as django_settings
 from django.core.exceptions import ObjectDoesNotExist
 import logging
 
@@ -32,39 +41,23 @@ def generate_text(page_id: int):
             logger.error(f"PDFPage with ID {page_id} does not exist.")
             raise PDFPage.DoesNotExist(f"PDFPage with ID {page_id} does not exist.")
 
-        # Get all Token objects related to this PDFPage instance
-        tokens = pdf_page.tokens.all()
-
-        if tokens is None or len(tokens) == 0:
-            logger.error(f"No tokens available for page {page_id}.")
-            raise ValueError("No tokens available for this page.")
-
-        lines = []
-        line = ""
-        for token in tokens:
-            filtered = token.filtered
-            if not filtered:
-                try:
-                    token_info = token.get_token_info()  # Assume this method is properly defined
-                    text = token_info["text"]
-
-                    # Process text with potential newlines
-                    if text:
-                        if "\n" in text:
-                            parts = text.split("\n")
-                            line += parts[0]
-                            lines.append(line)
-                            line = parts[1] if len(parts) > 1 else ""
-                        else:
-                            line += text
-                except KeyError as e:
-                    logger.error(f"Token data is incomplete or invalid: {e}")
-                    raise ValueError(f"Token data is incomplete or invalid: {e}")
-        if line:
-            lines.append(line)
-
-        combined_text = "\n".join(lines)
-        return combined_text
+        # Read the unfiltered token texts from the token blob or the Token rows
+        page_tokens = load_page_tokens(pdf_page)
+        if page_tokens is not None:
+            if len(page_tokens) == 0:
+                logger.error(f"No tokens available for page {page_id}.")
+                raise ValueError("No tokens available for this page.")
+            texts = [text for text, filtered in zip(page_tokens.texts(), page_tokens.filtered.tolist()) if not filtered]
+        else:
+            tokens = list(pdf_page.tokens.order_by("id").values_list("text", "filtered"))
+
+            if not tokens:
+                logger.error(f"No tokens available for page {page_id}.")
+                raise ValueError("No tokens available for this page.")
+
+            texts = [text for text, filtered in tokens if not filtered]
+
+        return join_token_texts(texts)
 
     except Exception as e:
         logger.error(f"Failed to generate text for page {page_id}: {e}")
@@ -72,14 +65,155 @@ def generate_text(page_id: int):
         raise Exception(f"Failed to generate text for page {page_id}: {e}")
 
 
-def process_gpt(text, instructions, format_response: str, max_tokens: int, model: str):
+def join_token_texts(texts):
+    """
+    Joins token texts into lines, breaking a line at each newline inside a token.
+
+    Args:
+        texts (list): The token texts in reading order.
+
+    Returns:
+        str: The combined text.
+    """
+    lines = []
+    line = ""
+    for text in texts:
+        # Process text with potential newlines
+        if text:
+            if "\n" in text:
+                parts = text.split("\n")
+                line += parts[0]
+                lines.append(line)
+                line = parts[1] if len(parts) > 1 else ""
+            else:
+                line += text
+    if line:
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+def get_openai_api_key(config=None):
+    """
+    Fetches the OpenAI API key from the configuration.
+
+    Args:
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Raises:
+        ObjectDoesNotExist: If no API key has been configured.
+    """
+    app_keys = (config or get_config()).app_keys
+    if not app_keys:
+        raise ObjectDoesNotExist("API key does not exist.")
+    return app_keys.openai_api_key
+
+
+def get_openai_api_keys(config=None):
+    """
+    Fetches every configured OpenAI API key, the main key first.
+
+    Args:
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Raises:
+        ObjectDoesNotExist: If no API key has been configured.
+    """
+    config = config or get_config()
+    api_keys = [get_openai_api_key(config)]
+    for api_key in config.app_keys.extra_openai_api_keys:
+        if api_key and api_key not in api_keys:
+            api_keys.append(api_key)
+    return api_keys
+
+
+def reserve_gpt_request(api_keys: list, model: str, tokens: int, config=None):
+    """
+    Picks the API key that can take a request soonest and reserves the request against its
+    rate limits, without blocking.
+
+    Args:
+        api_keys (list): The API keys to choose from.
+        model (str): The model of the request.
+        tokens (int): The most tokens the request can use: its prompt plus `gpt_max_tokens`.
+        config (ConfigSnapshot, optional): Provides the limits used until the API reports
+            the real ones. Defaults to the current one.
+
+    Returns:
+        tuple: The API key, its `RateLimiter`, and the seconds to wait before trying again
+               (0 if the request was reserved).
+    """
+    settings_obj = (config or get_config()).settings
+    api_key, limiter = choose_api_key(
+        api_keys, model, tokens, settings_obj.gpt_requests_per_minute, settings_obj.gpt_tokens_per_minute
+    )
+    return api_key, limiter, limiter.try_acquire(tokens)
+
+
+def release_unused_tokens(limiter, reserved_tokens: int, response_json: dict, response_headers=None):
+    """
+    Gives back the part of a reservation that the response reports as unused.
+
+    Nothing is given back when the response headers reported the remaining tokens: the
+    limiter has already been synced to the server's count, which only charges what was used.
+    """
+    if response_headers is not None and reports_remaining_tokens(response_headers):
+        return
+    used_tokens = response_json.get("usage", {}).get("total_tokens")
+    if used_tokens is not None:
+        limiter.release(reserved_tokens - used_tokens)
+
+
+def build_gpt_request(text, instructions, format_response: str, max_tokens: int, model: str, api_key: str):
+    """
+    Builds the headers and payload of a chat completions request.
+
+    Returns:
+        tuple: A tuple containing the request headers and the JSON payload.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+    payload = {
+        "model": model,
+        "response_format": {"type": format_response},
+        "messages": [
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": text},
+        ],
+        "max_tokens": max_tokens,
+    }
+    return headers, payload
+
+
+def gpt_cost(input_tokens: int, output_tokens: int):
+    """
+    Returns the cost in dollars of a GPT call.
+    """
+    cost_per_input_token = 0.01 / 1000  # $0.01 per 1,000 tokens for input
+    cost_per_output_token = 0.03 / 1000  # $0.03 per 1,000 tokens for output
+
+    return (input_tokens * cost_per_input_token) + (output_tokens * cost_per_output_token)
+
+
+def process_gpt(text, instructions, format_response: str, max_tokens: int, model: str, config=None):
     """
     Calls the OpenAI API to process text using specified instructions and format.
 
+    Responses are cached by their inputs when `gpt_cache_enabled` is set, and a cached
+    response is returned without calling the API, at no cost.
+
+    The request waits until the rate limits of one of the configured API keys can take its
+    estimated size, the prompt tokens plus `max_tokens`, so that many workers together stay
+    just below the limits instead of running into 429 responses.
+
     Args:
         text (str): The text to be processed.
         instructions (str): Instructions for the text processing.
         format_response (str): The format of the response.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
 
     Returns:
         tuple: A tuple containing the processed message and its cost, or (None, None) on failure.
@@ -91,47 +225,43 @@ def process_gpt(text, instructions, format_response: str, max_tokens: int, model
     """
     logger.info("Processing text with GPT...")
     try:
-        # Fetch the OpenAI API key from the database
-        app_keys = AppKeys.objects.first()  # Replace with your query
-        if not app_keys:
-            raise ObjectDoesNotExist("API key does not exist.")
-        
-        api_key = app_keys.openai_api_key
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        }
-
-        payload = {
-            "model": model,
-            "response_format": {"type": format_response},
-            "messages": [
-                {"role": "system", "content": instructions},
-                {"role": "user", "content": text},
-            ],
-            "max_tokens": max_tokens,
-        }
-
-        input_tokens = count_tokens(text, model) + count_tokens(instructions, model)
-
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions", headers=headers, json=payload
+        config = config or get_config()
+        settings_obj = config.settings
+
+        cache_key = None
+        if settings_obj.gpt_cache_enabled:
+            cache_key = gpt_cache_key(model, instructions, format_response, max_tokens, text)
+            cached = get_cached_response(cache_key)
+            if cached is not None:
+                return cached.response, 0.0
+
+        api_keys = get_openai_api_keys(config)
+
+        input_tokens = count_tokens(text, model) + count_instruction_tokens(instructions, model)
+        reserved_tokens = input_tokens + max_tokens
+
+        while True:
+            api_key, limiter, delay = reserve_gpt_request(api_keys, model, reserved_tokens, config)
+            if delay == 0:
+                break
+            time.sleep(delay)
+
+        headers, payload = build_gpt_request(text, instructions, format_response, max_tokens, model, api_key)
+        response = post_with_retries(
+            f"{django_settings.OPENAI_API_BASE}/chat/completions", on_response=limiter.observe, headers=headers, json=payload
         )
 
         if response.status_code == 200:
             response_json = response.json()
+            release_unused_tokens(limiter, reserved_tokens, response_json, response.headers)
             message_content = response_json["choices"][0]["message"]["content"]
 
             # Count tokens in the output text
             output_tokens = count_tokens(message_content, model)
+            cost = gpt_cost(input_tokens, output_tokens)
 
-            cost_per_input_token = 0.01 / 1000  # $0.01 per 1,000 tokens for input
-            cost_per_output_token = 0.03 / 1000  # $0.03 per 1,000 tokens for output
-
-            cost = (input_tokens * cost_per_input_token) + (
-                output_tokens * cost_per_output_token
-            )
+            if cache_key is not None:
+                store_response(cache_key, model, message_content, input_tokens, output_tokens, settings_obj.gpt_cache_max_mb)
 
             return message_content, cost
         else:
@@ -146,6 +276,39 @@ def process_gpt(text, instructions, format_response: str, max_tokens: int, model
         raise RuntimeError(f"An unexpected error occurred: {e}")
 
 
+def get_encoding(model: str):
+    """
+    Returns the tiktoken encoder for a model. tiktoken builds each encoding only once per
+    process and keeps it.
+
+    The BPE files are read from `TIKTOKEN_CACHE_DIR`, so a directory filled by the
+    `download_tiktoken_encodings` command lets workers start without network access.
+
+    Args:
+        model (str): The model name.
+
+    Returns:
+        tiktoken.Encoding: The encoder.
+
+    Raises:
+        KeyError: If tiktoken does not know the model.
+    """
+    # tiktoken reads the cache location from the environment when it loads a file
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(django_settings.TIKTOKEN_CACHE_DIR))
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=128)
+def count_instruction_tokens(instructions: str, model: str):
+    """
+    Counts the tokens in a GPT instruction prompt.
+
+    The prompts come from the settings and are the same for every page, so the counts are
+    memoized by prompt text; a changed prompt is simply a new cache entry.
+    """
+    return count_tokens(instructions, model)
+
+
 def count_tokens(input_text, model):
     """
     Counts the number of tokens in the given text using a specific model's encoding.
@@ -166,8 +329,7 @@ def count_tokens(input_text, model):
         raise ValueError("Input text must be a string.")
 
     try:
-        # Assume 'tiktoken' is a hypothetical module and 'encoding_for_model' is a method that retrieves a model-specific encoder
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = get_encoding(model)
         if encoding is None:
             raise RuntimeError("Failed to retrieve the encoder for the model.")
 
@@ -182,25 +344,23 @@ def count_tokens(input_text, model):
         raise RuntimeError(f"An unexpected error occurred during token counting: {e}")
 
 
-def gpt_token_processing(page_id: int):
+def get_gpt_settings(config=None):
     """
-    Processes text extracted from a PDF page by reformating it using GPT-4 and saving the response.
+    Reads the GPT settings from the configuration.
 
     Args:
-        page_id (int): The ID of the PDFPage instance.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Returns:
+        dict: The GPT instructions, max tokens and model.
 
     Raises:
-        ObjectDoesNotExist: If no PDFPage with the given ID exists.
-        ValueError: For issues with processing or JSON formatting.
-        Exception: For other unexpected issues.
+        ValueError: If the settings cannot be read.
     """
-    logger.info(f"Processing GPT token for page {page_id}...")
-
-    # Get settings from the database
     try:
-        settings_obj = Settings.objects.first()
+        settings_obj = (config or get_config()).settings
         if settings_obj:
-            settings = {
+            return {
                 "gpt_instructions": settings_obj.gpt_messages,
                 "gpt_max_tokens": settings_obj.gpt_max_tokens,
                 "gpt_model": settings_obj.gpt_model,
@@ -208,7 +368,46 @@ def gpt_token_processing(page_id: int):
     except Exception as e:
         logger.error(f"Error getting settings: {e}")
         raise ValueError(f"Error getting settings: {e}")
+    raise ValueError("Error getting settings: no settings have been configured.")
+
+
+def save_gpt_response(page_id: int, json_output: str, cost: float):
+    """
+    Parses the JSON output of the second GPT call and saves it as a GPTResponse for the page.
+
+    Returns:
+        GPTResponse: The saved response.
+    """
+    json_output_dict = json.loads(json_output)
+
+    # Create a new GPTResponse and save it to the database
+    gpt_response = GPTResponse()
+    gpt_response.page = PDFPage.objects.get(id=page_id)  # Set the page field
+    gpt_response.json_response = json_output_dict  # Set the json_response field
+    gpt_response.cost = round(cost, 3)  # Set the cost field
+
+    gpt_response.save()
+    return gpt_response
+
+
+def gpt_token_processing(page_id: int, config=None):
+    """
+    Processes text extracted from a PDF page by reformating it using GPT-4 and saving the response.
+
+    Args:
+        page_id (int): The ID of the PDFPage instance.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+
+    Raises:
+        ObjectDoesNotExist: If no PDFPage with the given ID exists.
+        ValueError: For issues with processing or JSON formatting.
+        Exception: For other unexpected issues.
+    """
+    logger.info(f"Processing GPT token for page {page_id}...")
 
+    # Get settings from the configuration
+    config = config or get_config()
+    settings = get_gpt_settings(config)
 
     documentAI_text = generate_text(page_id)
 
@@ -218,19 +417,11 @@ def gpt_token_processing(page_id: int):
     instructions2 = settings["gpt_instructions"][1]
 
 
-    message_content, cost = process_gpt(documentAI_text, instructions1, "text", settings["gpt_max_tokens"], settings["gpt_model"])
+    message_content, cost = process_gpt(documentAI_text, instructions1, "text", settings["gpt_max_tokens"], settings["gpt_model"], config)
 
     print('----------------------------------------------------------------------')
     print(message_content)
 
-    json_output, cost2 = process_gpt(message_content, instructions2, "json_object", settings["gpt_max_tokens"], settings["gpt_model"])
-    json_output_dict = json.loads(json_output)
-    json_output_dict = json.loads(json_output)
-
-    # Create a new GPTResponse and save it to the database
-    gpt_response = GPTResponse()
-    gpt_response.page = PDFPage.objects.get(id=page_id)  # Set the page field
-    gpt_response.json_response = json_output_dict  # Set the json_response field
-    gpt_response.cost = round(cost + cost2, 3)  # Set the cost field
+    json_output, cost2 = process_gpt(message_content, instructions2, "json_object", settings["gpt_max_tokens"], settings["gpt_model"], config)
 
-    gpt_response.save()
+    save_gpt_response(page_id, json_output, cost + cost2)
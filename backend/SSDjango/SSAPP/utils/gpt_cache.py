@@ -0,0 +1,157 @@
+# gpt_cache.py
+
+import hashlib
+import json
+import threading
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from ..models import GPTCacheEntry
+import logging
+
+logger = logging.getLogger("django")
+
+# Eviction removes the least recently used entries until the cache is this fraction of its limit,
+# so that it does not run again on the next insert
+EVICTION_TARGET = 0.9
+
+# Entries are evicted in DELETE statements of at most this many rows
+EVICTION_BATCH_SIZE = 500
+
+# Bytes stored by this process since the cache size was last checked
+_written = None
+_written_lock = threading.Lock()
+
+
+class CacheStats:
+    """
+    Thread-safe hit and miss counters of the GPT cache in this process, for monitoring.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def record_evictions(self, count: int):
+        with self._lock:
+            self.evictions += count
+
+    def as_dict(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+cache_stats = CacheStats()
+
+
+def gpt_cache_key(model: str, instructions: str, format_response: str, max_tokens: int, text: str):
+    """
+    Returns the cache key of a GPT request: a SHA-256 hash of every input that determines its response.
+    """
+    request = json.dumps([model, instructions, format_response, max_tokens, text], ensure_ascii=False)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def get_cached_response(key: str):
+    """
+    Looks up a cached GPT response and marks it as used.
+
+    Args:
+        key (str): The key returned by `gpt_cache_key`.
+
+    Returns:
+        GPTCacheEntry: The entry, or None on a miss.
+    """
+    entry = GPTCacheEntry.objects.filter(key=key).first()
+    cache_stats.record(entry is not None)
+    if entry is not None:
+        GPTCacheEntry.objects.filter(id=entry.id).update(hits=F("hits") + 1, last_used_at=timezone.now())
+        logger.info(f"GPT cache hit for {key[:12]}")
+    return entry
+
+
+def store_response(key: str, model: str, response: str, input_tokens: int, output_tokens: int, max_mb: int):
+    """
+    Stores a GPT response, then evicts the least recently used entries if the cache has
+    grown past `max_mb` megabytes.
+
+    The cache size is only summed on the first store of the process and after every tenth
+    of the limit stored since, like `DiskCache.put`.
+    """
+    global _written
+    size = len(response.encode())
+    try:
+        with transaction.atomic():
+            GPTCacheEntry.objects.create(
+                key=key,
+                model=model,
+                response=response,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                size=size,
+            )
+    except IntegrityError:
+        # Another worker stored the same response first
+        return
+
+    max_bytes = max_mb * 1024 * 1024
+    with _written_lock:
+        first_write = _written is None
+        _written = (_written or 0) + size
+        should_evict = first_write or _written > max_bytes * 0.1
+        if should_evict:
+            _written = 0
+    if should_evict:
+        evict(max_bytes)
+
+
+def evict(max_bytes: int):
+    """
+    Deletes the least recently used entries until the cache fits in `max_bytes`.
+
+    Returns:
+        int: The number of deleted entries.
+    """
+    total = GPTCacheEntry.objects.aggregate(total=Sum("size"))["total"] or 0
+    if total <= max_bytes:
+        return 0
+
+    to_free = total - int(max_bytes * EVICTION_TARGET)
+    freed = deleted = 0
+    while freed < to_free:
+        # The oldest entries left, which move on as each batch is deleted
+        evicted_ids = []
+        oldest = GPTCacheEntry.objects.order_by("last_used_at", "id").values_list("id", "size")[:EVICTION_BATCH_SIZE]
+        for entry_id, size in oldest:
+            if freed >= to_free:
+                break
+            evicted_ids.append(entry_id)
+            freed += size
+        if not evicted_ids:
+            break
+        deleted += GPTCacheEntry.objects.filter(id__in=evicted_ids).delete()[0]
+
+    cache_stats.record_evictions(deleted)
+    logger.info(f"Evicted {deleted} GPT cache entries ({freed} bytes)")
+    return deleted
+
+
+def gpt_cache_status():
+    """
+    Returns the size of the GPT cache and the hit and miss counters of this process.
+    """
+    totals = GPTCacheEntry.objects.aggregate(size=Sum("size"), hits=Sum("hits"))
+    return {
+        "entries": GPTCacheEntry.objects.count(),
+        "size_bytes": totals["size"] or 0,
+        "total_hits": totals["hits"] or 0,
+        **cache_stats.as_dict(),
+    }
@@ -0,0 +1,199 @@
+# http_session.py
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings as django_settings
+from django.utils import timezone
+from .config import get_config
+import logging
+
+logger = logging.getLogger("django")
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_session = None
+_session_pool_size = None
+_session_lock = threading.Lock()
+
+
+class RetryStats:
+    """
+    Thread-safe counters of the retries made by this process, for monitoring.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.failures = 0
+            self.backoff_seconds = 0.0
+            self.retries_by_reason = {}
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_retry(self, reason: str, delay: float):
+        with self._lock:
+            self.retries += 1
+            self.backoff_seconds += delay
+            self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def as_dict(self):
+        """
+        Returns a copy of the counters.
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "backoff_seconds": round(self.backoff_seconds, 3),
+                "retries_by_reason": dict(self.retries_by_reason),
+            }
+
+
+retry_stats = RetryStats()
+
+
+def get_pool_size():
+    """
+    Returns the number of connections to keep per host: one for every page that can be
+    waiting on the API at once.
+    """
+    settings_obj = get_config().settings
+    if settings_obj is None:
+        return 1
+    return max(1, settings_obj.scan_workers, settings_obj.gpt_workers)
+
+
+def get_session():
+    """
+    Returns the process-wide `requests.Session`, whose connections are kept alive between calls.
+
+    The session is rebuilt when the configured concurrency changes, so the pool stays sized to it.
+
+    Returns:
+        requests.Session: The session.
+    """
+    global _session, _session_pool_size
+    pool_size = get_pool_size()
+    with _session_lock:
+        if _session is None or _session_pool_size != pool_size:
+            session = requests.Session()
+            # Retries are handled by `post_with_retries`, which also keeps the statistics
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # Requests still running on a replaced session keep their own reference to it
+            _session = session
+            _session_pool_size = pool_size
+        return _session
+
+
+def get_timeout():
+    """
+    Returns the (connect, read) timeout in seconds for API calls.
+    """
+    return django_settings.OPENAI_CONNECT_TIMEOUT, django_settings.OPENAI_READ_TIMEOUT
+
+
+def parse_retry_after(value):
+    """
+    Parses a `Retry-After` header given either in seconds or as an HTTP date.
+
+    Returns:
+        float: The number of seconds to wait, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - timezone.now()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt: int, retry_after=None):
+    """
+    Returns how long to wait before a retry.
+
+    A `Retry-After` value from the server is honored (up to `OPENAI_BACKOFF_MAX`); otherwise
+    the delay grows exponentially with full jitter, so clients that failed together do not
+    retry together.
+
+    Args:
+        attempt (int): The number of attempts made so far, starting at 1.
+        retry_after (str, optional): The `Retry-After` header of the failed response.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    maximum = django_settings.OPENAI_BACKOFF_MAX
+    server_delay = parse_retry_after(retry_after)
+    if server_delay is not None:
+        return min(server_delay, maximum)
+    return random.uniform(0, min(maximum, django_settings.OPENAI_BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def post_with_retries(url: str, on_response=None, **kwargs):
+    """
+    Sends a POST request on the shared session, retrying rate limits, server errors,
+    timeouts and connection errors up to `OPENAI_MAX_RETRIES` times.
+
+    Args:
+        url (str): The URL.
+        on_response (callable, optional): Called with the headers of every response, including
+            the ones that are retried.
+        **kwargs: Passed on to `requests.Session.post`.
+
+    Returns:
+        requests.Response: The last response, which may still be an error response.
+
+    Raises:
+        requests.exceptions.RequestException: If the last attempt failed without a response.
+    """
+    session = get_session()
+    kwargs.setdefault("timeout", get_timeout())
+    max_retries = django_settings.OPENAI_MAX_RETRIES
+
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_stats.record_request()
+        try:
+            response = session.post(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt > max_retries:
+                retry_stats.record_failure()
+                raise
+            reason, retry_after = type(e).__name__, None
+        else:
+            if on_response is not None:
+                on_response(response.headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt > max_retries:
+                if response.status_code in RETRY_STATUS_CODES:
+                    retry_stats.record_failure()
+                return response
+            reason, retry_after = str(response.status_code), response.headers.get("Retry-After")
+            response.close()
+
+        delay = retry_delay(attempt, retry_after)
+        retry_stats.record_retry(reason, delay)
+        logger.warning(f"Request to {url} failed ({reason}), retry {attempt}/{max_retries} in {delay:.2f}s")
+        time.sleep(delay)
@@ -0,0 +1,348 @@
+# page_files.py
+
+import hashlib
+import io
+import math
+import os
+import threading
+import fitz  # PyMuPDF
+import pypdfium2 as pdfium
+from PIL import Image
+from .disk_cache import DiskCache
+
+# A virtual page has no pdf_pages/ file of its own; its single-page PDF is cut from the parent
+# PDFFile when Document AI or a download first needs it, and kept in this cache. Its content
+# hash is recorded then too, since the page is never split at upload.
+page_cache = DiskCache("page_cache", "PAGE_CACHE_MAX_MB", ".pdf")
+
+# Thumbnails are rendered when first requested, at the requested size rounded up to a multiple
+# of THUMBNAIL_SIZE_STEP pixels so a few sizes serve every request. Like rendered images and
+# tiles, they are keyed by the page's fingerprint, so identical pages share them.
+thumbnail_cache = DiskCache("thumbnail_cache", "THUMBNAIL_CACHE_MAX_MB", ".png")
+THUMBNAIL_DEFAULT_SIZE = 400
+THUMBNAIL_MIN_SIZE = 32
+THUMBNAIL_MAX_SIZE = 1024
+THUMBNAIL_SIZE_STEP = 32
+
+# High-resolution page images, keyed by a fingerprint of the page's file, the scale and the
+# format, so a cached image stays valid until the file changes
+render_cache = DiskCache("render_cache", "RENDER_CACHE_MAX_MB")
+_pdfium_lock = threading.Lock()
+
+# Deep Zoom tile pyramid: the full-resolution level is the page at TILE_MAX_SCALE pixels per
+# point, every level below halves it down to a single pixel, and each level is cut into
+# TILE_SIZE pixel tiles which overlap their neighbours by TILE_OVERLAP pixels. Tiles are
+# rendered from just their region of the page when first requested.
+tile_cache = DiskCache("tile_cache", "TILE_CACHE_MAX_MB", ".jpg")
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_MAX_SCALE = 4
+TILE_FORMAT = "jpg"
+TILE_JPEG_QUALITY = 85
+# Low levels are rendered at this scale at least and downsampled, since pdfium drops thin
+# shapes when it rasterizes at a tiny scale
+TILE_MIN_RENDER_SCALE = 0.5
+
+
+def extract_page(pdf_path: str, page_index: int):
+    """
+    Extracts one page of a PDF into a new single-page PDF.
+
+    Args:
+        pdf_path (str): The path to the source PDF.
+        page_index (int): The index of the page, starting at 0.
+
+    Returns:
+        bytes: The content of the new PDF.
+    """
+    with fitz.open(pdf_path) as source:
+        with fitz.open() as sub_doc:
+            sub_doc.insert_pdf(source, from_page=page_index, to_page=page_index)
+            # Without a new random /ID the bytes are the same on every extraction, so the page
+            # keeps its stored Document AI result when it is extracted again after eviction
+            return sub_doc.tobytes(garbage=4, deflate=True, no_new_id=True)
+
+
+def page_cache_key(pdf_page):
+    return f"{pdf_page.pdf_file_id}_{pdf_page.page_number}"
+
+
+def page_file_path(pdf_page):
+    """
+    Returns the path of a page's single-page PDF, extracting and caching it for a virtual page.
+
+    The first time a virtual page is extracted, the hash of its bytes is saved as its `sha256`.
+
+    Args:
+        pdf_page (PDFPage): The page.
+
+    Returns:
+        str: The path of the PDF file.
+    """
+    if pdf_page.file:
+        return pdf_page.file.path
+    path = page_cache.get_or_create(
+        page_cache_key(pdf_page),
+        lambda: extract_page(pdf_page.pdf_file.file.path, pdf_page.page_number - 1),
+    )
+    if not pdf_page.sha256:
+        with open(path, "rb") as file:
+            pdf_page.sha256 = hashlib.sha256(file.read()).hexdigest()
+        # models imports this module, so the page's own class is used instead of PDFPage
+        type(pdf_page).objects.filter(id=pdf_page.id, sha256="").update(sha256=pdf_page.sha256)
+    return str(path)
+
+
+def read_page_file(pdf_page):
+    """
+    Returns the bytes of a page's single-page PDF.
+    """
+    with open(page_file_path(pdf_page), "rb") as file:
+        return file.read()
+
+
+def page_source(pdf_page):
+    """
+    Returns where a page can be read without extracting it: the path of a PDF and the index
+    of the page in it.
+    """
+    if pdf_page.file:
+        return pdf_page.file.path, 0
+    return pdf_page.pdf_file.file.path, pdf_page.page_number - 1
+
+
+def thumbnail_size(requested=None):
+    """
+    Returns the longest side in pixels a thumbnail is rendered at for a requested size.
+
+    Raises:
+        ValueError: If the size is not a number.
+    """
+    size = THUMBNAIL_DEFAULT_SIZE if requested in (None, "") else int(requested)
+    size = -(-size // THUMBNAIL_SIZE_STEP) * THUMBNAIL_SIZE_STEP
+    return max(THUMBNAIL_MIN_SIZE, min(size, THUMBNAIL_MAX_SIZE))
+
+
+def render_thumbnail(pdf_page, size: int):
+    """
+    Renders a PNG thumbnail of a page whose longest side is `size` pixels.
+    """
+    pdf_path, page_index = page_source(pdf_page)
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_index]
+        scale = size / max(page.rect.width, page.rect.height)
+        return page.get_pixmap(matrix=fitz.Matrix(scale, scale)).tobytes("png")
+
+
+def thumbnail_path(pdf_page, size: int):
+    """
+    Returns the path of a page's thumbnail, rendering and caching it on first use.
+
+    Args:
+        pdf_page (PDFPage): The page.
+        size (int): The longest side in pixels, as returned by `thumbnail_size`.
+    """
+    return thumbnail_cache.get_or_create(
+        f"{page_fingerprint(pdf_page)}_{size}",
+        lambda: render_thumbnail(pdf_page, size),
+    )
+
+
+def page_fingerprint(pdf_page):
+    """
+    Returns a hash identifying the content of a page: its content hash, so identical pages share
+    cached images, or for a page without one, a hash of its source file's path, size and
+    modification time and the page index, which changes whenever the file is replaced.
+    """
+    if pdf_page.sha256:
+        return pdf_page.sha256[:32]
+    pdf_path, page_index = page_source(pdf_page)
+    stat = os.stat(pdf_path)
+    identity = f"{pdf_path}:{stat.st_size}:{stat.st_mtime_ns}:{page_index}"
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def delete_page_caches(pdf_pages: list):
+    """
+    Removes the cached files of pages that are being deleted: their extracted PDFs, and the
+    thumbnails, rendered images and tiles that no other page shares. Each cache is scanned
+    once for all the pages.
+
+    Args:
+        pdf_pages (list): The PDFPage instances, before their files are deleted.
+    """
+    if not pdf_pages:
+        return
+    fingerprints = set()
+    for pdf_page in pdf_pages:
+        page_cache.delete(page_cache_key(pdf_page))
+        try:
+            fingerprints.add(page_fingerprint(pdf_page))
+        except OSError:
+            # Without its source file, the page's images cannot have a live fingerprint
+            continue
+
+    # Identical pages that are kept still use the shared files
+    hashes = {pdf_page.sha256 for pdf_page in pdf_pages if pdf_page.sha256}
+    if hashes:
+        kept = type(pdf_pages[0]).objects.filter(sha256__in=hashes).exclude(id__in=[pdf_page.id for pdf_page in pdf_pages])
+        fingerprints -= {sha256[:32] for sha256 in kept.values_list("sha256", flat=True)}
+
+    for cache in (thumbnail_cache, render_cache, tile_cache):
+        cache.delete_prefixed(fingerprints)
+
+
+def render_cache_key(pdf_page, scale: float, image_format: str):
+    return f"{page_fingerprint(pdf_page)}_{scale:g}.{image_format.lower()}"
+
+
+def render_page_image(pdf_page, scale: float, image_format: str):
+    """
+    Renders a page to an image with pypdfium2.
+
+    Args:
+        pdf_page (PDFPage): The page.
+        scale (float): The number of pixels per PDF point.
+        image_format (str): A Pillow image format, such as "JPEG".
+
+    Returns:
+        bytes: The encoded image.
+    """
+    pdf_path, page_index = page_source(pdf_page)
+    # pdfium is not thread-safe
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            image = pdf[page_index].render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format=image_format)
+    return output.getvalue()
+
+
+def rendered_image_url(pdf_page, scale: float, image_format: str):
+    """
+    Returns the media URL of a page image, rendering and caching it only if it is not cached.
+    """
+    key = render_cache_key(pdf_page, scale, image_format)
+    render_cache.get_or_create(key, lambda: render_page_image(pdf_page, scale, image_format))
+    return render_cache.url(key)
+
+
+def page_size_points(pdf_page):
+    """
+    Returns the width and height of a page in PDF points, as displayed after its rotation.
+    """
+    pdf_path, page_index = page_source(pdf_page)
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            return pdf[page_index].get_size()
+        finally:
+            pdf.close()
+
+
+def tile_pyramid(width_points: float, height_points: float):
+    """
+    Returns the Deep Zoom description of a page's tile pyramid.
+
+    Args:
+        width_points (float): The page width in PDF points.
+        height_points (float): The page height in PDF points.
+
+    Returns:
+        dict: The full-resolution width and height in pixels, the tile size, overlap and format,
+        and the highest level, whose images are the full-resolution ones.
+    """
+    width = math.ceil(width_points * TILE_MAX_SCALE)
+    height = math.ceil(height_points * TILE_MAX_SCALE)
+    return {
+        "width": width,
+        "height": height,
+        "tile_size": TILE_SIZE,
+        "overlap": TILE_OVERLAP,
+        "format": TILE_FORMAT,
+        "max_level": math.ceil(math.log2(max(width, height, 1))),
+    }
+
+
+def tile_bounds(pyramid: dict, level: int, col: int, row: int):
+    """
+    Returns the pixel box of a tile in the image of its level, including the overlap.
+
+    Returns:
+        tuple: The level's width and height, and the tile's left, top, right and bottom.
+
+    Raises:
+        ValueError: If the tile is outside the pyramid.
+    """
+    if not 0 <= level <= pyramid["max_level"]:
+        raise ValueError(f"Level {level} is outside the pyramid")
+    divisor = 2 ** (pyramid["max_level"] - level)
+    level_width = math.ceil(pyramid["width"] / divisor)
+    level_height = math.ceil(pyramid["height"] / divisor)
+    left, top = col * TILE_SIZE, row * TILE_SIZE
+    if col < 0 or row < 0 or left >= level_width or top >= level_height:
+        raise ValueError(f"Tile {col}_{row} is outside level {level}")
+    return (
+        level_width,
+        level_height,
+        max(left - TILE_OVERLAP, 0),
+        max(top - TILE_OVERLAP, 0),
+        min(left + TILE_SIZE + TILE_OVERLAP, level_width),
+        min(top + TILE_SIZE + TILE_OVERLAP, level_height),
+    )
+
+
+def render_tile(pdf_page, level: int, col: int, row: int):
+    """
+    Renders one tile of a page's pyramid, rasterizing only the region of the page it covers.
+
+    Raises:
+        ValueError: If the tile is outside the pyramid.
+    """
+    pdf_path, page_index = page_source(pdf_page)
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            page = pdf[page_index]
+            width_points, height_points = page.get_size()
+            level_width, level_height, left, top, right, bottom = tile_bounds(
+                tile_pyramid(width_points, height_points), level, col, row
+            )
+            scale_x = level_width / width_points
+            scale_y = level_height / height_points
+            # The crop is the margin to leave out on each side, in points: left, bottom, right, top
+            crop = (
+                max(left / scale_x, 0),
+                max(height_points - bottom / scale_y, 0),
+                max(width_points - right / scale_x, 0),
+                max(top / scale_y, 0),
+            )
+            image = page.render(scale=max(scale_x, TILE_MIN_RENDER_SCALE), crop=crop).to_pil()
+        finally:
+            pdf.close()
+
+    size = (right - left, bottom - top)
+    image = image.convert("RGB")
+    if image.size != size:
+        # Downsamples low levels, and absorbs rounding in pdfium's bitmap size and the slightly
+        # different vertical scale
+        image = image.resize(size, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=TILE_JPEG_QUALITY)
+    return output.getvalue()
+
+
+def tile_path(pdf_page, level: int, col: int, row: int):
+    """
+    Returns the path of a tile of a page's pyramid, rendering and caching it on first use.
+
+    Raises:
+        ValueError: If the tile is outside the pyramid.
+    """
+    return tile_cache.get_or_create(
+        f"{page_fingerprint(pdf_page)}_{level}_{col}_{row}",
+        lambda: render_tile(pdf_page, level, col, row),
+    )
@@ -0,0 +1,45 @@
+# pdf_split.py
+
+import fitz  # PyMuPDF
+
+# This module runs in the worker processes of `split_pdf`, so it must not import Django models:
+# with the spawn start method a worker imports it without setting Django up.
+
+
+def split_page_range(file_path: str, start: int, stop: int):
+    """
+    Extracts a range of pages of a PDF as single-page PDFs.
+
+    The source PDF is opened once for the whole range.
+
+    Args:
+        file_path (str): The path of the PDF file.
+        start (int): The index of the first page.
+        stop (int): The index after the last page.
+
+    Returns:
+        list: A (page index, PDF bytes) tuple per page.
+    """
+    results = []
+    with fitz.open(file_path) as doc:
+        for page_index in range(start, stop):
+            with fitz.open() as sub_doc:
+                sub_doc.insert_pdf(doc, from_page=page_index, to_page=page_index)
+                # Without a new random /ID, identical pages give identical bytes and content hashes
+                results.append((page_index, sub_doc.tobytes(garbage=4, deflate=True, no_new_id=True)))
+    return results
+
+
+def shard_pages(page_count: int, shard_count: int):
+    """
+    Splits the page indexes into contiguous (start, stop) ranges of nearly equal size.
+    """
+    shard_count = max(1, min(shard_count, page_count))
+    size, extra = divmod(page_count, shard_count)
+    shards = []
+    start = 0
+    for shard in range(shard_count):
+        stop = start + size + (1 if shard < extra else 0)
+        shards.append((start, stop))
+        start = stop
+    return shards
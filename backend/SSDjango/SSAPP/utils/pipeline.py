@@ -0,0 +1,178 @@
+# pipeline.py
+
+import queue
+import threading
+from functools import partial
+from django.db import connections
+from django.utils import timezone
+from ..models import PDFPage
+from .documentAI import process_page_range
+from .filter_tokens import token_filter
+from .gpt import gpt_token_processing
+import logging
+
+logger = logging.getLogger("django")
+
+# Marks the end of the work for a stage worker
+_STOP = object()
+
+
+class PipelineStage:
+    """
+    One stage of a `StagedPipeline`, run by its own pool of worker threads.
+
+    Args:
+        name (str): The name of the stage, used in logs and thread names.
+        function (callable): Called with a page ID; raising marks the page as failed.
+        workers (int): The number of threads running this stage.
+        batched (bool, optional): Whether the stage is called with a list of page IDs
+            instead of a single ID. Pages of a batch continue to later, unbatched stages
+            one at a time.
+    """
+    def __init__(self, name, function, workers, batched=False):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.batched = batched
+
+
+class StagedPipeline:
+    """
+    Runs pages through a sequence of stages, with a bounded queue in front of every stage.
+
+    Each stage has its own worker pool, so different pages can be in different stages at the
+    same time and throughput is limited by the slowest stage rather than the sum of all of them.
+    The bounded queues keep a fast stage from running far ahead of a slow one.
+
+    Args:
+        stages (list): The `PipelineStage` objects, in order.
+        queue_size (int): The maximum number of pages waiting in front of each stage.
+        should_continue (callable, optional): Checked before each page is admitted; no new
+            pages are admitted once it returns False.
+        on_stage_done (callable, optional): Called with a list of page IDs and the name of the
+            stage they have just completed. Raising marks the pages as failed.
+    """
+    def __init__(self, stages, queue_size, should_continue=None, on_stage_done=None):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+        self.should_continue = should_continue
+        self.on_stage_done = on_stage_done
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _record(self, page_id, result):
+        with self._lock:
+            self.results[page_id] = result
+
+    def _feed(self, items):
+        for item in items:
+            if self.should_continue is not None and not self.should_continue():
+                break
+            self.queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self.queues[0].put(_STOP)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while True:
+                item = inbox.get()
+                if item is _STOP:
+                    break
+                page_ids = list(item) if stage.batched else [item]
+                try:
+                    if index == 0:
+                        PDFPage.objects.filter(id__in=page_ids).update(scan_start_time=timezone.now())
+
+                    logger.info(f"Pipeline stage '{stage.name}' for pages {page_ids}")
+                    stage.function(item)
+                    if self.on_stage_done is not None:
+                        self.on_stage_done(page_ids, stage.name)
+
+                    if outbox is not None:
+                        if stage.batched and not self.stages[index + 1].batched:
+                            for page_id in page_ids:
+                                outbox.put(page_id)
+                        else:
+                            outbox.put(item)
+                    else:
+                        PDFPage.objects.filter(id__in=page_ids).update(scan_end_time=timezone.now())
+                        for page_id in page_ids:
+                            self._record(page_id, "Success")
+                except Exception as e:
+                    for page_id in page_ids:
+                        logger.error(f"Failed to process page {page_id}: {str(e)}")
+                        self._record(page_id, f"Failed to process page {page_id}: {str(e)}")
+        finally:
+            connections.close_all()
+
+    def _run_stage(self, index):
+        threads = [
+            threading.Thread(target=self._work, args=(index,), name=f"pipeline-{self.stages[index].name}-{n}")
+            for n in range(self.stages[index].workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every worker of this stage is done, so the next stage gets no more pages
+        if index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self.queues[index + 1].put(_STOP)
+
+    def run(self, items: list):
+        """
+        Runs the pages through every stage and waits for them to finish.
+
+        Args:
+            items (list): The page IDs, or lists of page IDs if the first stage is batched.
+
+        Returns:
+            dict: A dictionary with keys as page IDs and values as status messages. Pages that
+                  were never admitted are left out.
+        """
+        threads = [threading.Thread(target=self._feed, args=(items,), name="pipeline-feed")]
+        threads += [
+            threading.Thread(target=self._run_stage, args=(index,), name=f"pipeline-{stage.name}")
+            for index, stage in enumerate(self.stages)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        page_ids = [page_id for item in items for page_id in (item if self.stages[0].batched else [item])]
+        return {page_id: self.results[page_id] for page_id in page_ids if page_id in self.results}
+
+
+def process_pages_pipeline(groups: list, config, should_continue=None, on_stage_done=None):
+    """
+    Processes pages through overlapping Document AI, token filtering and GPT stages.
+
+    Args:
+        groups (list): Lists of consecutive page IDs, each sent to Document AI in one request.
+        config (ConfigSnapshot): The configuration used by every stage; its settings provide
+            the per-stage worker counts and queue size.
+        should_continue (callable, optional): Checked before each group is started.
+        on_stage_done (callable, optional): Called with a list of page IDs and the stage they
+            have just completed: "ocr", "filter" or "gpt".
+
+    Returns:
+        dict: A dictionary with keys as page IDs and values as status messages.
+    """
+    settings_obj = config.settings
+    stages = [
+        PipelineStage("ocr", partial(process_page_range, config=config), settings_obj.ocr_workers, batched=True),
+        PipelineStage("filter", partial(token_filter, config=config), settings_obj.filter_workers),
+        PipelineStage("gpt", partial(gpt_token_processing, config=config), settings_obj.gpt_workers),
+    ]
+    page_count = sum(len(group) for group in groups)
+    logger.info(
+        f"Processing {page_count} pages in a pipeline with "
+        + ", ".join(f"{stage.workers} {stage.name} workers" for stage in stages)
+    )
+    pipeline = StagedPipeline(stages, settings_obj.pipeline_queue_size, should_continue, on_stage_done)
+    return pipeline.run(groups)
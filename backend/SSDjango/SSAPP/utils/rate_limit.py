@@ -0,0 +1,202 @@
+# rate_limit.py
+
+import hashlib
+import re
+import threading
+import time
+import logging
+
+logger = logging.getLogger("django")
+
+# Fraction of the reported limits to aim for, so that steady traffic stays just under them
+TARGET_UTILIZATION = 0.95
+
+# How many seconds of the per-minute budget can be spent in one burst
+BURST_SECONDS = 10
+
+# Longest wait before a waiting request checks again, so that limits learned in the meantime apply
+RECHECK_SECONDS = 0.25
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at a fixed rate.
+
+    A request larger than the bucket's capacity is admitted once the bucket is full and
+    leaves it in debt, so large requests are slowed down rather than blocked forever.
+
+    Args:
+        per_minute (float): The sustained number of units admitted per minute.
+        now (float, optional): The current time on the clock passed to the other methods.
+            Defaults to `time.monotonic()`.
+    """
+    def __init__(self, per_minute: float, now: float = None):
+        self.level = 0.0
+        self.set_rate(per_minute)
+        self.level = self.capacity
+        self.updated_at = time.monotonic() if now is None else now
+
+    def set_rate(self, per_minute: float):
+        self.rate = max(per_minute, 1.0) * TARGET_UTILIZATION / 60
+        self.capacity = max(self.rate * BURST_SECONDS, 1.0)
+        self.level = min(self.level, self.capacity)
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float):
+        """
+        Returns the seconds until `amount` units can be taken, 0 if they can be taken now.
+        """
+        self.refill(now)
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync_remaining(self, remaining: float):
+        """
+        Lowers the level to what the API reports as remaining, which also accounts for
+        other processes using the same key.
+        """
+        self.level = min(self.level, remaining * TARGET_UTILIZATION)
+
+
+class RateLimiter:
+    """
+    Admits requests for one API key and model against a requests-per-minute and a
+    tokens-per-minute bucket.
+
+    The limits start at the configured values and are replaced with the real ones as soon
+    as a response reports them in its `x-ratelimit-*` headers.
+
+    Args:
+        requests_per_minute (int): The initial request limit.
+        tokens_per_minute (int): The initial token limit.
+        clock (callable, optional): Returns the current time in seconds. Defaults to `time.monotonic`.
+    """
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, clock=time.monotonic):
+        self.clock = clock
+        self.requests = TokenBucket(requests_per_minute, clock())
+        self.tokens = TokenBucket(tokens_per_minute, clock())
+        self.learned = False
+        self._lock = threading.Lock()
+
+    def wait_time(self, tokens: int):
+        """
+        Returns the seconds until a request of `tokens` tokens would be admitted.
+        """
+        with self._lock:
+            now = self.clock()
+            return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def try_acquire(self, tokens: int):
+        """
+        Admits a request of `tokens` tokens if both buckets allow it.
+
+        Returns:
+            float: 0 if the request was admitted, otherwise the seconds to wait before trying again.
+        """
+        with self._lock:
+            now = self.clock()
+            delay = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if delay == 0:
+                self.requests.take(1)
+                self.tokens.take(tokens)
+            return min(delay, RECHECK_SECONDS)
+
+    def acquire(self, tokens: int):
+        """
+        Blocks until a request of `tokens` tokens is admitted.
+        """
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay == 0:
+                return
+            time.sleep(delay)
+
+    def release(self, tokens: int):
+        """
+        Returns tokens that were reserved but not used, once the real usage is known.
+        """
+        if tokens > 0:
+            with self._lock:
+                self.tokens.give_back(tokens)
+
+    def observe(self, headers):
+        """
+        Learns the limits and the remaining budget from the rate limit headers of a response.
+        """
+        limit_requests = _header_number(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _header_number(headers, "x-ratelimit-limit-tokens")
+        remaining_requests = _header_number(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+
+        with self._lock:
+            now = self.clock()
+            if limit_requests:
+                self.requests.refill(now)
+                self.requests.set_rate(limit_requests)
+            if limit_tokens:
+                self.tokens.refill(now)
+                self.tokens.set_rate(limit_tokens)
+            if remaining_requests is not None:
+                self.requests.sync_remaining(remaining_requests)
+            if remaining_tokens is not None:
+                self.tokens.sync_remaining(remaining_tokens)
+            if (limit_requests or limit_tokens) and not self.learned:
+                self.learned = True
+                logger.info(f"Learned OpenAI rate limits: {limit_requests} requests and {limit_tokens} tokens per minute")
+
+
+def reports_remaining_tokens(headers):
+    """
+    Returns whether a response reports the remaining token budget, which `observe` syncs.
+    """
+    return _header_number(headers, "x-ratelimit-remaining-tokens") is not None
+
+
+def _header_number(headers, name: str):
+    value = headers.get(name)
+    if value is None:
+        return None
+    match = re.match(r"\s*(\d+(?:\.\d+)?)", str(value))
+    return float(match.group(1)) if match else None
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_key: str, model: str, requests_per_minute: int, tokens_per_minute: int):
+    """
+    Returns the process-wide rate limiter for an API key and model, creating it on first use.
+    """
+    key = (hashlib.sha256(api_key.encode()).hexdigest(), model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[key] = limiter
+        return limiter
+
+
+def choose_api_key(api_keys: list, model: str, tokens: int, requests_per_minute: int, tokens_per_minute: int):
+    """
+    Picks the API key whose limiter can admit a request of `tokens` tokens soonest.
+
+    Returns:
+        tuple: The API key and its `RateLimiter`.
+    """
+    candidates = [
+        (api_key, get_rate_limiter(api_key, model, requests_per_minute, tokens_per_minute))
+        for api_key in api_keys
+    ]
+    return min(candidates, key=lambda candidate: candidate[1].wait_time(tokens))
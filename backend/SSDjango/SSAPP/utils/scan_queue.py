@@ -0,0 +1,460 @@
+# scan_queue.py
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+from ..models import PDFPage, ScanJob
+from .config import get_config
+from .documentAI import DOCUMENTAI_MAX_PAGES, DOCUMENTAI_PAGE_COST, process_page
+from .filter_tokens import token_filter
+from .gpt import gpt_token_processing
+from .token_store import delete_page_tokens
+from .utils import process_pages_util
+import logging
+
+logger = logging.getLogger("django")
+
+# The stages a job runs through, in order, and the function that performs each one
+STAGES = [
+    (ScanJob.STAGE_OCR, process_page),
+    (ScanJob.STAGE_FILTER, token_filter),
+    (ScanJob.STAGE_GPT, gpt_token_processing),
+]
+
+ACTIVE_STATES = [ScanJob.STATE_PENDING, ScanJob.STATE_RUNNING]
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when a worker finds that another worker has taken over its job.
+    """
+
+
+def default_worker_id():
+    """
+    Returns an identifier for this worker that is unique across processes and hosts.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def enqueue_pages(page_ids: list):
+    """
+    Creates pending scan jobs for the given pages, skipping pages that already have an active job.
+
+    Args:
+        page_ids (list): The list of page IDs.
+
+    Returns:
+        list: The IDs of the pages that were queued.
+    """
+    with transaction.atomic():
+        active_page_ids = set(
+            ScanJob.objects.filter(page_id__in=page_ids, state__in=ACTIVE_STATES).values_list("page_id", flat=True)
+        )
+        new_page_ids = [page_id for page_id in dict.fromkeys(page_ids) if page_id not in active_page_ids]
+        ScanJob.objects.bulk_create([ScanJob(page_id=page_id) for page_id in new_page_ids])
+
+    logger.info(f"Queued {len(new_page_ids)} pages for scanning")
+    return new_page_ids
+
+
+def cancel_pending_jobs():
+    """
+    Cancels every job that has not been claimed by a worker yet.
+
+    Returns:
+        int: The number of cancelled jobs.
+    """
+    return ScanJob.objects.filter(state=ScanJob.STATE_PENDING).update(
+        state=ScanJob.STATE_CANCELLED, updated_at=timezone.now()
+    )
+
+
+def recover_stale_leases(max_attempts: int):
+    """
+    Returns running jobs whose lease has expired to the queue, or fails them once they
+    have used up their attempts.
+
+    Args:
+        max_attempts (int): The number of attempts a job gets before it is marked failed.
+
+    Returns:
+        int: The number of recovered jobs.
+    """
+    now = timezone.now()
+    stale = ScanJob.objects.filter(state=ScanJob.STATE_RUNNING, lease_expires_at__lt=now)
+
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        state=ScanJob.STATE_FAILED,
+        lease_owner=None,
+        lease_expires_at=None,
+        last_error="Lease expired after the final attempt.",
+        updated_at=now,
+    )
+    recovered = stale.filter(attempts__lt=max_attempts).update(
+        state=ScanJob.STATE_PENDING,
+        lease_owner=None,
+        lease_expires_at=None,
+        updated_at=now,
+    )
+    if failed or recovered:
+        logger.warning(f"Recovered {recovered} stale scan jobs and failed {failed}")
+    return recovered
+
+
+def _try_claim(job_id: int, worker_id: str, lease_seconds: int):
+    """
+    Claims a job if it is still pending.
+
+    The claim is a conditional UPDATE on the job's state, so two workers racing for the
+    same job cannot both win, whichever database backend is in use.
+
+    Returns:
+        bool: Whether this worker won the job.
+    """
+    now = timezone.now()
+    return bool(ScanJob.objects.filter(id=job_id, state=ScanJob.STATE_PENDING).update(
+        state=ScanJob.STATE_RUNNING,
+        lease_owner=worker_id,
+        lease_expires_at=now + timedelta(seconds=lease_seconds),
+        attempts=F("attempts") + 1,
+        updated_at=now,
+    ))
+
+
+def claim_jobs(worker_id: str, lease_seconds: int, limit: int = 1):
+    """
+    Atomically claims up to `limit` of the oldest pending jobs for a worker.
+
+    Args:
+        worker_id (str): The identifier of the claiming worker.
+        lease_seconds (int): How long the leases are valid without a heartbeat.
+        limit (int, optional): The most jobs to claim. Defaults to 1.
+
+    Returns:
+        list: The claimed jobs in queue order, empty if the queue is empty.
+    """
+    claimed_ids = []
+    while len(claimed_ids) < limit:
+        candidate_ids = list(
+            ScanJob.objects.filter(state=ScanJob.STATE_PENDING)
+            .order_by("id")
+            .values_list("id", flat=True)[:max(10, limit - len(claimed_ids))]
+        )
+        if not candidate_ids:
+            break
+
+        for job_id in candidate_ids:
+            if _try_claim(job_id, worker_id, lease_seconds):
+                claimed_ids.append(job_id)
+                if len(claimed_ids) == limit:
+                    break
+
+    return list(ScanJob.objects.filter(id__in=claimed_ids).order_by("id"))
+
+
+def claim_job(worker_id: str, lease_seconds: int):
+    """
+    Atomically claims the oldest pending job for a worker.
+
+    Returns:
+        ScanJob: The claimed job, or None if the queue is empty.
+    """
+    jobs = claim_jobs(worker_id, lease_seconds, 1)
+    return jobs[0] if jobs else None
+
+
+def scan_batch_size(settings_obj=None):
+    """
+    Returns how many jobs a worker claims at once, enough to keep the thread pool, the
+    staged pipeline or the async path busy and to fill Document AI batches.
+
+    Args:
+        settings_obj (Settings, optional): The scan settings. Defaults to the current ones.
+    """
+    if settings_obj is None:
+        settings_obj = get_config().settings
+    if settings_obj is None:
+        return 1
+    if settings_obj.scan_async:
+        return max(1, settings_obj.async_concurrency)
+
+    if settings_obj.scan_pipeline:
+        workers = max(settings_obj.ocr_workers, settings_obj.filter_workers, settings_obj.gpt_workers)
+    else:
+        workers = settings_obj.scan_workers
+    batch_pages = min(settings_obj.documentai_batch_pages, DOCUMENTAI_MAX_PAGES)
+    return max(1, workers) * max(1, batch_pages)
+
+
+def renew_leases(jobs: list, worker_id: str, lease_seconds: int):
+    """
+    Extends the leases on jobs held by this worker.
+
+    Returns:
+        int: The number of jobs whose lease is still held by this worker and was extended.
+    """
+    now = timezone.now()
+    return ScanJob.objects.filter(
+        id__in=[job.id for job in jobs], state=ScanJob.STATE_RUNNING, lease_owner=worker_id
+    ).update(lease_expires_at=now + timedelta(seconds=lease_seconds), updated_at=now)
+
+
+class Heartbeat:
+    """
+    Renews the leases of jobs from a background thread while they are being processed.
+
+    A failed renewal, such as a write blocked by a locked database, is retried on the next
+    beat. The leases count as lost once a renewal finds that another worker has taken a job
+    over, or once renewals have kept failing for as long as a lease lasts; the worker then
+    stops before its next stage.
+
+    Args:
+        jobs (list): The jobs being processed.
+        worker_id (str): The identifier of the worker holding the leases.
+        lease_seconds (int): The lease duration.
+        interval (float, optional): Seconds between renewals. Defaults to a third of the lease.
+    """
+    def __init__(self, jobs, worker_id, lease_seconds, interval=None):
+        self.jobs = list(jobs)
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval if interval is not None else max(1, lease_seconds / 3)
+        self.lost = False
+        self._stop = threading.Event()
+        job_ids = "-".join(str(job.id) for job in self.jobs[:3])
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job_ids}", daemon=True)
+
+    def _run(self):
+        last_renewal = time.monotonic()
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    renewed = renew_leases(self.jobs, self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    if time.monotonic() - last_renewal >= self.lease_seconds:
+                        logger.error(f"Giving up the leases on scan jobs {[job.id for job in self.jobs]}: {e}")
+                        self.lost = True
+                        return
+                    logger.warning(f"Failed to renew the leases on scan jobs {[job.id for job in self.jobs]}, retrying: {e}")
+                    continue
+
+                if renewed < len(self.jobs):
+                    logger.warning(f"Lost the lease on some of scan jobs {[job.id for job in self.jobs]}")
+                    self.lost = True
+                    return
+                last_renewal = time.monotonic()
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _update_owned_job(job: ScanJob, worker_id: str, **fields):
+    """
+    Updates a job only if this worker still holds its lease.
+
+    Raises:
+        LeaseLostError: If the job has been taken over by another worker.
+    """
+    fields["updated_at"] = timezone.now()
+    updated = ScanJob.objects.filter(id=job.id, state=ScanJob.STATE_RUNNING, lease_owner=worker_id).update(**fields)
+    if not updated:
+        raise LeaseLostError(f"Scan job {job.id} is no longer held by {worker_id}")
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def _next_stage(stage: str):
+    """
+    Returns the stage a job moves to once it has completed `stage`.
+    """
+    stage_names = [name for name, _ in STAGES]
+    index = stage_names.index(stage)
+    return stage_names[index + 1] if index + 1 < len(stage_names) else ScanJob.STAGE_DONE
+
+
+def _reset_stage(page_id: int, stage: str):
+    """
+    Removes partial output of a stage left behind by an earlier, interrupted attempt.
+    """
+    if stage == ScanJob.STAGE_OCR:
+        delete_page_tokens(PDFPage.objects.get(id=page_id))
+    elif stage == ScanJob.STAGE_GPT:
+        PDFPage.objects.get(id=page_id).gpt_responses.all().delete()
+
+
+def run_job(job: ScanJob, worker_id: str, lease_seconds: int, max_attempts: int):
+    """
+    Runs a claimed job through its remaining stages, recording progress after each one.
+
+    A job that is retried resumes at the stage it was in, so Document AI work that has
+    already completed is not paid for again.
+
+    Args:
+        job (ScanJob): The claimed job.
+        worker_id (str): The identifier of the worker holding the lease.
+        lease_seconds (int): The lease duration.
+        max_attempts (int): The number of attempts a job gets before it is marked failed.
+
+    Returns:
+        str: "Success", or an error message describing why the job failed.
+    """
+    page_id = job.page_id
+    stage_names = [name for name, _ in STAGES]
+    config = get_config()
+
+    with Heartbeat([job], worker_id, lease_seconds) as heartbeat:
+        try:
+            pdf_page = PDFPage.objects.get(id=page_id)
+            if job.stage == ScanJob.STAGE_OCR or not pdf_page.scan_start_time:
+                pdf_page.scan_start_time = timezone.now()
+                pdf_page.save(update_fields=["scan_start_time"])
+
+            first_stage = stage_names.index(job.stage) if job.stage in stage_names else len(STAGES)
+            for index in range(first_stage, len(STAGES)):
+                if heartbeat.lost:
+                    raise LeaseLostError(f"Scan job {job.id} is no longer held by {worker_id}")
+
+                stage, stage_function = STAGES[index]
+                logger.info(f"Scan job {job.id}: running stage '{stage}' for page {page_id}")
+                _reset_stage(page_id, stage)
+                stage_function(page_id, config)
+
+                _update_owned_job(job, worker_id, stage=_next_stage(stage))
+
+            _finish_job(job, worker_id, max_attempts)
+            return "Success"
+
+        except LeaseLostError as e:
+            # Another worker owns the job now, so leave its state alone
+            logger.warning(str(e))
+            return str(e)
+        except Exception as e:
+            logger.error(f"Scan job {job.id} failed for page {page_id}: {str(e)}")
+            error = f"Failed to process page {page_id}: {str(e)}"
+            try:
+                _finish_job(job, worker_id, max_attempts, error)
+            except LeaseLostError as lost:
+                logger.warning(str(lost))
+            return error
+
+
+def _finish_job(job: ScanJob, worker_id: str, max_attempts: int, error: str = None):
+    """
+    Releases a job as done, marking its page scanned, or as failed. A failed job goes back
+    to the queue until it has used up its attempts.
+
+    Raises:
+        LeaseLostError: If the job has been taken over by another worker.
+    """
+    if error is None:
+        _update_owned_job(
+            job, worker_id, stage=ScanJob.STAGE_DONE, state=ScanJob.STATE_DONE,
+            lease_owner=None, lease_expires_at=None, last_error=""
+        )
+        PDFPage.objects.filter(id=job.page_id).update(
+            scanned=True, cost=DOCUMENTAI_PAGE_COST, scan_end_time=timezone.now()
+        )
+    else:
+        state = ScanJob.STATE_FAILED if job.attempts >= max_attempts else ScanJob.STATE_PENDING
+        _update_owned_job(job, worker_id, state=state, lease_owner=None, lease_expires_at=None, last_error=error)
+
+
+def run_jobs(jobs: list, worker_id: str, lease_seconds: int, max_attempts: int):
+    """
+    Runs a batch of claimed jobs.
+
+    Jobs that have not started go through `process_pages_util` together, so the
+    scan_workers, scan_pipeline, scan_async and documentai_batch_pages settings apply to
+    them as they do to the synchronous endpoints. Their stage is saved as their pages
+    complete each stage, so jobs that are retried after getting past Document AI resume at
+    their saved stage through `run_job`.
+
+    Args:
+        jobs (list): The claimed jobs.
+        worker_id (str): The identifier of the worker holding the leases.
+        lease_seconds (int): The lease duration.
+        max_attempts (int): The number of attempts a job gets before it is marked failed.
+
+    Returns:
+        dict: A dictionary with keys as page IDs and values as status messages.
+    """
+    fresh = [job for job in jobs if job.stage == ScanJob.STAGE_OCR]
+    if len(fresh) < 2:
+        fresh = []
+    results = {}
+
+    if fresh:
+        results.update(_run_fresh_jobs(fresh, worker_id, lease_seconds, max_attempts))
+    for job in jobs:
+        if job.page_id not in results:
+            results[job.page_id] = run_job(job, worker_id, lease_seconds, max_attempts)
+    return results
+
+
+def _run_fresh_jobs(jobs: list, worker_id: str, lease_seconds: int, max_attempts: int):
+    """
+    Runs jobs that have not started through `process_pages_util` in one call, saving each
+    job's stage as its page completes one.
+
+    Returns:
+        dict: A dictionary with keys as page IDs and values as status messages.
+    """
+    jobs_by_page = {job.page_id: job for job in jobs}
+    results = {}
+
+    def record_stage(page_ids, stage):
+        # A job taken over by another worker fails its page here, before its next stage
+        for page_id in page_ids:
+            _update_owned_job(jobs_by_page[page_id], worker_id, stage=_next_stage(stage))
+
+    with Heartbeat(jobs, worker_id, lease_seconds) as heartbeat:
+        try:
+            for page_id in jobs_by_page:
+                _reset_stage(page_id, ScanJob.STAGE_OCR)
+                _reset_stage(page_id, ScanJob.STAGE_GPT)
+            page_results = process_pages_util(
+                list(jobs_by_page), should_continue=lambda: not heartbeat.lost, on_stage_done=record_stage
+            )
+        except Exception as e:
+            logger.error(f"Scan jobs {[job.id for job in jobs]} failed: {str(e)}")
+            page_results = {page_id: f"Failed to process page {page_id}: {str(e)}" for page_id in jobs_by_page}
+
+        for page_id, job in jobs_by_page.items():
+            # Pages left out of the results were skipped once the leases were lost
+            result = page_results.get(page_id, f"Scan job {job.id} is no longer held by {worker_id}")
+            try:
+                _finish_job(job, worker_id, max_attempts, None if result == "Success" else result)
+            except LeaseLostError as e:
+                logger.warning(str(e))
+                result = str(e)
+            results[page_id] = result
+
+    return results
+
+
+def queue_status():
+    """
+    Returns the number of scan jobs in each state.
+
+    Returns:
+        dict: A dictionary with a key for every job state.
+    """
+    counts = {state: 0 for state, _ in ScanJob.STATE_CHOICES}
+    for row in ScanJob.objects.values("state").annotate(count=Count("id")):
+        counts[row["state"]] = row["count"]
+    return counts
+
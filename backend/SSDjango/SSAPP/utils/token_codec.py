@@ -0,0 +1,261 @@
+# token_codec.py
+
+import base64
+import json
+import threading
+import zlib
+from functools import lru_cache
+from django.conf import settings as django_settings
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:
+    msgpack = zstandard = None
+
+# Token.token_info used to hold the JSON dictionary built by `token_info_to_dict`, which repeats
+# every key name for every token. The compact codecs store the values only, in the order of
+# SCHEMA, compress them against a dictionary shared by all tokens, and keep the result as
+# base64 text behind a tag. Values without a tag are JSON, so existing rows keep working.
+# They trade decode time for space: decoding one is slower than parsing the JSON.
+#
+# An entry of SCHEMA is a field name, (name, fields) for a nested dictionary, or
+# (name, [fields]) for a list of dictionaries.
+SCHEMA = (
+    "text",
+    ("layout", (
+        ("text_anchor", (("text_segments", [("start_index", "end_index")]),)),
+        "confidence",
+        ("bounding_poly", ("vertices", "normalized_vertices")),
+        "orientation",
+    )),
+    ("detected_break", ("type_",)),
+    ("detected_languages", [("language_code", "confidence")]),
+    ("style_info", (
+        "font_size",
+        "pixel_font_size",
+        "font_type",
+        "font_weight",
+        "bold",
+        "italic",
+        "underlined",
+        "handwritten",
+        "letter_spacing",
+        ("text_color", ("red", "green", "blue")),
+        ("background_color", ("red", "green", "blue")),
+    )),
+)
+
+# A typical packed token; both compressors start from it, so even a single token compresses
+# well. Rows are decoded with the dictionary they were written with, so a new dictionary needs
+# a new codec tag.
+SHARED_DICTIONARY = (
+    b'["word ",[[[25,30]],0.9900000095367432,[[[124,31],[143,31],[143,42],[124,42]],'
+    b'[[0.2033986747264862,0.039646465331315994],[0.23390845954418182,0.039646465331315994],'
+    b'[0.23390845954418182,0.053525250405073166],[0.2033986747264862,0.053525250405073166]]],0],'
+    b'[0],[["en",0.9900000095367432]],'
+    b'[10,10.991998672485352,"",0,false,false,false,false,0.0,[0.0,0.0,0.0],[1.0,1.0,1.0]]]'
+)
+
+ZLIB_TAG = "z1:"
+MSGPACK_ZSTD_TAG = "m1:"
+
+
+def pack(data: dict, schema=SCHEMA):
+    """
+    Converts a token info dictionary into nested lists of values in the order of `schema`.
+
+    Raises:
+        ValueError: If the dictionary does not have exactly the fields of the schema.
+    """
+    if len(data) != len(schema):
+        raise ValueError(f"Expected the fields {schema}, got {list(data)}")
+    packed = []
+    for entry in schema:
+        if isinstance(entry, str):
+            packed.append(data[entry])
+        elif isinstance(entry[1], list):
+            packed.append([pack(item, entry[1][0]) for item in data[entry[0]]])
+        else:
+            packed.append(pack(data[entry[0]], entry[1]))
+    return packed
+
+
+def unpack(packed: list, schema=SCHEMA):
+    """
+    Converts the lists made by `pack` back into a token info dictionary.
+    """
+    data = {}
+    for entry, value in zip(schema, packed):
+        if isinstance(entry, str):
+            data[entry] = value
+        elif isinstance(entry[1], list):
+            data[entry[0]] = [unpack(item, entry[1][0]) for item in value]
+        else:
+            data[entry[0]] = unpack(value, entry[1])
+    return data
+
+
+@lru_cache(maxsize=None)
+def field_location(path: tuple):
+    """
+    Returns the list indexes of a field in packed token info, and its schema entry.
+
+    Args:
+        path (tuple): The keys leading to the field, such as ("style_info", "font_size").
+
+    Raises:
+        KeyError: If the path does not name a field of the schema.
+    """
+    indexes = []
+    schema = SCHEMA
+    entry = None
+    for key in path:
+        if schema is None:
+            raise KeyError(key)
+        names = [item if isinstance(item, str) else item[0] for item in schema]
+        if key not in names:
+            raise KeyError(key)
+        index = names.index(key)
+        indexes.append(index)
+        entry = schema[index]
+        # Lists of dictionaries are returned whole
+        schema = entry[1] if not isinstance(entry, str) and not isinstance(entry[1], list) else None
+    return tuple(indexes), entry
+
+
+class ZlibCodec:
+    """
+    Packed token info as compact JSON, deflated against the shared dictionary. Needs only the
+    standard library.
+    """
+    tag = ZLIB_TAG
+
+    def encode(self, data: dict):
+        raw = json.dumps(pack(data), separators=(",", ":"), ensure_ascii=False).encode()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=SHARED_DICTIONARY)
+        return self.tag + base64.b64encode(compressor.compress(raw) + compressor.flush()).decode()
+
+    def decode_packed(self, value: str):
+        decompressor = zlib.decompressobj(-15, zdict=SHARED_DICTIONARY)
+        return json.loads(decompressor.decompress(base64.b64decode(value[len(self.tag):])))
+
+
+class MsgpackZstdCodec:
+    """
+    Packed token info as MessagePack, compressed with Zstandard using the shared dictionary. Needs the msgpack and zstandard packages.
+    """
+    tag = MSGPACK_ZSTD_TAG
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack and zstandard packages are needed for the msgpack-zstd codec")
+        self._dictionary = zstandard.ZstdCompressionDict(SHARED_DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        # Zstandard compressors must not be shared between threads
+        self._local = threading.local()
+
+    def _compressors(self):
+        if not hasattr(self._local, "compressor"):
+            self._local.compressor = zstandard.ZstdCompressor(level=19, dict_data=self._dictionary)
+            self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self._dictionary)
+        return self._local.compressor, self._local.decompressor
+
+    def encode(self, data: dict):
+        raw = msgpack.packb(pack(data))
+        compressor, _ = self._compressors()
+        return self.tag + base64.b64encode(compressor.compress(raw)).decode()
+
+    def decode_packed(self, value: str):
+        _, decompressor = self._compressors()
+        return msgpack.unpackb(decompressor.decompress(base64.b64decode(value[len(self.tag):])))
+
+
+@lru_cache(maxsize=None)
+def get_codec(name: str):
+    """
+    Returns a token info codec by name: "json", "zlib", "msgpack-zstd", or "compact" for
+    msgpack-zstd when its packages are installed and zlib otherwise.
+
+    Returns:
+        ZlibCodec | MsgpackZstdCodec: The codec, or None for plain JSON.
+    """
+    if name == "compact":
+        name = "msgpack-zstd" if msgpack is not None else "zlib"
+    if name == "json":
+        return None
+    if name == "zlib":
+        return ZlibCodec()
+    if name == "msgpack-zstd":
+        return MsgpackZstdCodec()
+    raise ValueError(f"Unknown token info codec: {name}")
+
+
+def _codec_for(value: str):
+    if value.startswith(ZLIB_TAG):
+        return get_codec("zlib")
+    if value.startswith(MSGPACK_ZSTD_TAG):
+        return get_codec("msgpack-zstd")
+    return None
+
+
+def encode_token_info(data: dict, codec: str = None):
+    """
+    Encodes a token info dictionary for `Token.token_info`.
+
+    Args:
+        data (dict): The dictionary built by `token_info_to_dict`.
+        codec (str, optional): The codec name. Defaults to the TOKEN_INFO_CODEC setting.
+
+    Returns:
+        str: The encoded value. Dictionaries that do not match SCHEMA are stored as JSON.
+    """
+    token_codec = get_codec(codec or django_settings.TOKEN_INFO_CODEC)
+    if token_codec is not None:
+        try:
+            return token_codec.encode(data)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+    return json.dumps(data)
+
+
+def decode_token_info(value: str):
+    """
+    Decodes a `Token.token_info` value written by any codec, including plain JSON.
+    """
+    token_codec = _codec_for(value)
+    if token_codec is None:
+        return json.loads(value)
+    return unpack(token_codec.decode_packed(value))
+
+
+def decode_token_info_field(value: str, *path):
+    """
+    Decodes a single field of a `Token.token_info` value.
+
+    The whole value is still decompressed and parsed, so this is no faster than
+    `decode_token_info`; it only skips rebuilding the dictionaries of the other fields.
+    Fields that are read often are kept in Token columns instead.
+
+    Args:
+        value (str): The encoded token info.
+        *path (str): The keys leading to the field, such as "style_info", "font_size".
+
+    Raises:
+        KeyError: If the field does not exist.
+    """
+    token_codec = _codec_for(value)
+    if token_codec is None:
+        field = json.loads(value)
+        for key in path:
+            field = field[key]
+        return field
+
+    field = token_codec.decode_packed(value)
+    indexes, entry = field_location(tuple(path))
+    for index in indexes:
+        field = field[index]
+    if isinstance(entry, str):
+        return field
+    if isinstance(entry[1], list):
+        return [unpack(item, entry[1][0]) for item in field]
+    return unpack(field, entry[1])
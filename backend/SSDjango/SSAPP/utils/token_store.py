@@ -0,0 +1,190 @@
+# token_store.py
+
+import json
+import mmap
+import struct
+import numpy as np
+from django.core.files.base import ContentFile
+from ..models import PDFPage
+import logging
+
+logger = logging.getLogger("django")
+
+# A columnar token blob holds every token of a page as packed NumPy arrays, so a page is one
+# file instead of thousands of Token rows. The layout is:
+#   MAGIC, a little-endian uint32 header length, a JSON header, then the arrays, each
+#   starting on an ALIGNMENT boundary.
+# The header maps every column name to its dtype, shape and byte offset.
+MAGIC = b"SSTOKENS1\n"
+ALIGNMENT = 64
+
+# The columns of a token blob and their dtypes; `text` is the UTF-8 text of all tokens and
+# `text_offsets` holds the start of every token's text in it, plus the end of the last one
+COLUMNS = {
+    "bbox": np.float64,          # (N, 4): x1, y1, x2, y2 in PDF coordinates
+    "confidence": np.float32,
+    "color": np.float32,         # (N, 3): red, green, blue
+    "font_size": np.float32,
+    "handwritten": np.bool_,
+    "filtered": np.bool_,
+    "text_offsets": np.int64,    # (N + 1)
+    "text": np.uint8,
+}
+
+
+class PageTokens:
+    """
+    The tokens of one page as columns, read from a token blob or built from Document AI tokens.
+
+    Columns read from a blob are memory-mapped, so only the parts that are used are read
+    from disk. Use `texts()` for the text of each token.
+
+    Args:
+        columns (dict): A NumPy array for every name in `COLUMNS`.
+    """
+    def __init__(self, columns: dict):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.confidence)
+
+    def texts(self):
+        """
+        Returns the text of every token as a list of strings.
+        """
+        data = self.text.tobytes()
+        offsets = self.text_offsets.tolist()
+        return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def non_ascii(self):
+        """
+        Returns a boolean array telling which tokens contain characters beyond ASCII.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=bool)
+        high = (self.text > 127).astype(np.int64)
+        # Counts of non-ASCII bytes between consecutive offsets; empty tokens have none
+        counts = np.add.reduceat(np.append(high, 0), self.text_offsets[:-1])
+        lengths = np.diff(self.text_offsets)
+        return (counts > 0) & (lengths > 0)
+
+    @classmethod
+    def from_token_infos(cls, bboxes, token_infos: list):
+        """
+        Builds the columns from token bounding boxes and the dictionaries made by `token_info_to_dict`.
+
+        Args:
+            bboxes (array-like): One row of (x1, y1, x2, y2) per token.
+            token_infos (list): One token info dictionary per token.
+        """
+        encoded = [info["text"].encode("utf-8") for info in token_infos]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=offsets[1:])
+        colors = [info["style_info"]["text_color"] for info in token_infos]
+        return cls({
+            "bbox": np.asarray(bboxes, dtype=np.float64).reshape(-1, 4),
+            "confidence": np.array([info["layout"]["confidence"] for info in token_infos], dtype=np.float32),
+            "color": np.array([[c["red"], c["green"], c["blue"]] for c in colors], dtype=np.float32).reshape(-1, 3),
+            "font_size": np.array([info["style_info"]["font_size"] for info in token_infos], dtype=np.float32),
+            "handwritten": np.array([info["style_info"]["handwritten"] for info in token_infos], dtype=np.bool_),
+            "filtered": np.zeros(len(token_infos), dtype=np.bool_),
+            "text_offsets": offsets,
+            "text": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        })
+
+    def to_bytes(self):
+        """
+        Serializes the columns into a token blob.
+        """
+        header = {}
+        chunks = []
+        offset = 0
+        for name, dtype in COLUMNS.items():
+            array = np.ascontiguousarray(getattr(self, name), dtype=dtype)
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            header[name] = {"dtype": np.dtype(dtype).str, "shape": list(array.shape), "offset": offset}
+            chunks.append((offset, array.tobytes()))
+            offset += array.nbytes
+
+        header_bytes = json.dumps(header).encode()
+        data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+        blob = bytearray(data_start + offset)
+        blob[:len(MAGIC)] = MAGIC
+        blob[len(MAGIC):len(MAGIC) + 4] = struct.pack("<I", len(header_bytes))
+        blob[len(MAGIC) + 4:len(MAGIC) + 4 + len(header_bytes)] = header_bytes
+        for chunk_offset, data in chunks:
+            blob[data_start + chunk_offset:data_start + chunk_offset + len(data)] = data
+        return bytes(blob)
+
+    @classmethod
+    def open(cls, path, writable: bool = False):
+        """
+        Memory-maps a token blob.
+
+        Args:
+            path (str): The path to the blob.
+            writable (bool, optional): Whether changes to the arrays are written back to the file.
+
+        Raises:
+            ValueError: If the file is not a token blob.
+        """
+        with open(path, "r+b" if writable else "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        if mapped[:len(MAGIC)] != MAGIC:
+            mapped.close()
+            raise ValueError(f"{path} is not a token blob.")
+        header_length = struct.unpack("<I", mapped[len(MAGIC):len(MAGIC) + 4])[0]
+        header = json.loads(mapped[len(MAGIC) + 4:len(MAGIC) + 4 + header_length])
+        data_start = -(-(len(MAGIC) + 4 + header_length) // ALIGNMENT) * ALIGNMENT
+
+        columns = {}
+        for name, column in header.items():
+            dtype = np.dtype(column["dtype"])
+            shape = tuple(column["shape"])
+            count = int(np.prod(shape)) if shape else 1
+            columns[name] = np.frombuffer(
+                mapped, dtype=dtype, count=count, offset=data_start + column["offset"]
+            ).reshape(shape)
+
+        page_tokens = cls(columns)
+        page_tokens._mmap = mapped
+        return page_tokens
+
+
+def save_page_tokens(pdf_page: PDFPage, page_tokens: PageTokens):
+    """
+    Saves the columns as the token blob of a page, replacing any previous blob.
+    """
+    delete_page_tokens(pdf_page, rows=False)
+    pdf_page.token_blob.save(f"page_{pdf_page.id}.tokens", ContentFile(page_tokens.to_bytes()), save=False)
+    PDFPage.objects.filter(id=pdf_page.id).update(token_blob=pdf_page.token_blob.name)
+
+
+def load_page_tokens(pdf_page: PDFPage, writable: bool = False):
+    """
+    Memory-maps the token blob of a page.
+
+    Returns:
+        PageTokens: The tokens, or None if the page has no token blob.
+    """
+    if not pdf_page.token_blob:
+        return None
+    return PageTokens.open(pdf_page.token_blob.path, writable=writable)
+
+
+def delete_page_tokens(pdf_page: PDFPage, rows: bool = True):
+    """
+    Deletes the tokens of a page in both representations.
+
+    Args:
+        pdf_page (PDFPage): The page.
+        rows (bool, optional): Whether to delete the Token rows as well as the token blob.
+    """
+    if rows:
+        pdf_page.tokens.all().delete()
+    if pdf_page.token_blob:
+        pdf_page.token_blob.delete(save=False)
+        PDFPage.objects.filter(id=pdf_page.id).update(token_blob=None)
@@ -1,21 +1,32 @@
 # utils.py
 
+import hashlib
 import io
 import os
-from PIL import Image
 import fitz  # PyMuPDF
-import pypdfium2 as pdfium
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from django.core.files.base import ContentFile
+from django.db import connections, transaction
 from ..models import PDFPage
-from .documentAI import process_page
+from .config import get_config
+from .content_hash import link_duplicate_pages
+from .documentAI import process_page_range, group_page_ranges, DOCUMENTAI_MAX_PAGES
 from .filter_tokens import token_filter
 from .gpt import gpt_token_processing
+from .pipeline import process_pages_pipeline
+from .async_pipeline import process_pages_util_async
+from .page_files import rendered_image_url
+from .pdf_split import shard_pages, split_page_range
 import logging
 from django.utils import timezone
 
 logger = logging.getLogger("django")
 
+# A PDF is only split in parallel when every worker gets at least this many pages
+SPLIT_MIN_PAGES_PER_WORKER = 8
+SPLIT_SHARDS_PER_WORKER = 4
+
 class NamedBytesIO(io.BytesIO):
     """
     A subclass of `io.BytesIO` that allows specifying a name for the stream.
@@ -50,12 +61,20 @@ class NamedBytesIO(io.BytesIO):
         return self._name
 
 
-def split_pdf(pdf_file):
+def split_pdf(pdf_file, workers: int = None, virtual: bool = None):
     """
     Splits a PDF file into individual pages and saves each page as a separate PDF file.
 
+    Page ranges are split in a process pool of `split_workers` processes, each opening the
+    source once; the page rows are created in bulk at the end. Virtual pages are not split at
+    all: they get no PDF file of their own, and theirs is extracted from `pdf_file`, and hashed,
+    when it is first needed. Thumbnails are rendered when they are first requested. Pages
+    identical to an already scanned page get a copy of its scan results.
+
     Args:
         pdf_file (File): The PDF file to be split.
+        workers (int, optional): The number of worker processes. Defaults to the `split_workers` setting.
+        virtual (bool, optional): Whether to create virtual pages. Defaults to the `virtual_pages` setting.
 
     Returns:
         list: A list of IDs of the saved PDF pages.
@@ -63,157 +82,256 @@ def split_pdf(pdf_file):
     Raises:
         FileNotFoundError: If the specified PDF file does not exist.
         ValueError: If the PDF file cannot be processed.
-        IOError: If there is an error saving files or thumbnails.
+        IOError: If there is an error saving files.
     """
     try:
         file_path = pdf_file.file.path
-        doc = fitz.open(file_path)  # Attempt to open the PDF file
+        with fitz.open(file_path) as doc:  # Attempt to open the PDF file
+            page_count = doc.page_count
     except Exception as e:
         logger.error(f"The specified PDF file could not be opened: {e}")
         raise FileNotFoundError(f"The specified PDF file could not be opened: {e}")
 
-    page_ids = []
+    settings_obj = get_config().settings
+    if workers is None:
+        workers = settings_obj.split_workers if settings_obj else 1
+    if virtual is None:
+        virtual = settings_obj.virtual_pages if settings_obj else False
 
-    for page_number, page in enumerate(doc):
-        logger.info(f"Processing page {page_number + 1} of {doc.page_count}...")
-        try:
-            output = io.BytesIO()
-            sub_doc = fitz.open()  # Create a new PDF document in memory
-            sub_doc.insert_pdf(doc, from_page=page_number, to_page=page_number)
-            sub_doc.save(output, garbage=4, deflate=True)  # Save single page to BytesIO
+    pdf_pages = []
+    try:
+        if virtual:
+            pdf_pages = [PDFPage(pdf_file=pdf_file, page_number=page_number) for page_number in range(1, page_count + 1)]
+        else:
+            # Starting a process costs more than splitting a few pages
+            workers = max(1, min(workers, page_count // SPLIT_MIN_PAGES_PER_WORKER))
+            # Several shards per worker keep the pool busy when some pages are slower than others
+            shards = shard_pages(page_count, workers * SPLIT_SHARDS_PER_WORKER if workers > 1 else 1)
+            logger.info(f"Splitting {page_count} pages of {pdf_file.name} with {workers} workers...")
+
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(split_page_range, file_path, start, stop) for start, stop in shards]
+                    for future in as_completed(futures):
+                        pdf_pages.extend(_save_split_pages(pdf_file, future.result()))
+            else:
+                for start, stop in shards:
+                    pdf_pages.extend(_save_split_pages(pdf_file, split_page_range(file_path, start, stop)))
+            pdf_pages.sort(key=lambda pdf_page: pdf_page.page_number)
+
+        with transaction.atomic():
+            PDFPage.objects.bulk_create(pdf_pages)
+        link_duplicate_pages(pdf_pages)
 
-            page_filename = f"{pdf_file.name}_page_{page_number + 1}.pdf"
-            pdf_page = PDFPage(pdf_file=pdf_file, page_number=page_number + 1)
-            output.seek(0)
-            pdf_page.file.save(page_filename, ContentFile(output.read()))  # Save the PDF page file
+    except Exception as e:
+        # Remove the files of the pages that were never created
+        for pdf_page in pdf_pages:
+            if pdf_page.id is None and pdf_page.file:
+                pdf_page.file.delete(save=False)
+        logger.error(f"Failed to split PDF file {pdf_file.name}: {e}")
+        raise IOError(f"Failed to split PDF file {pdf_file.name}: {e}")
+
+    return [pdf_page.id for pdf_page in pdf_pages]
 
-            # Creating a thumbnail
-            pix = page.get_pixmap(matrix=fitz.Matrix(0.5, 0.5))  # Generate a pixmap from the page
-            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
 
-            thumbnail_output = io.BytesIO()
-            img.save(thumbnail_output, format="PNG")  # Save to BytesIO in PNG format
-            thumbnail_output.seek(0)
+def _save_split_pages(pdf_file, split_pages: list):
+    """
+    Saves the files of split pages and returns their unsaved PDFPage instances, with the
+    content hashes of the split bytes.
+    """
+    pdf_pages = []
+    for page_index, pdf_bytes in split_pages:
+        page_number = page_index + 1
+        pdf_page = PDFPage(pdf_file=pdf_file, page_number=page_number, sha256=hashlib.sha256(pdf_bytes).hexdigest())
+        pdf_pages.append(pdf_page)
+        pdf_page.file.save(f"{pdf_file.name}_page_{page_number}.pdf", ContentFile(pdf_bytes), save=False)
+    return pdf_pages
 
-            thumbnail_filename = f"{pdf_file.name}_page_{page_number + 1}_thumbnail.png"
-            pdf_page.thumbnail.save(thumbnail_filename, ContentFile(thumbnail_output.getvalue()))
 
-            pdf_page.save()  # Save the page model instance
-            page_ids.append(pdf_page.id)
+def process_single_page(page_id: int):
+    """
+    Runs a single page through Document AI, token filtering and GPT processing.
 
-        except Exception as e:
-            logger.error(f"Failed to process or save PDF page {page_number + 1}: {e}")
-            raise IOError(f"Failed to process or save PDF page {page_number + 1}: {e}")
+    Args:
+        page_id (int): The ID of the page.
 
-    return page_ids
+    Returns:
+        str: "Success", or an error message describing why the page failed.
+    """
+    return process_page_group([page_id])[page_id]
 
 
-def process_pages_util(page_ids: list):
+def process_page_group(page_ids: list, config=None, on_stage_done=None):
     """
-    Processes a list of pages using specified parameters, handling errors individually.
+    Runs a run of consecutive pages through Document AI in one request, then filters
+    tokens and handles GPT processing for each page.
 
     Args:
-        page_ids (list): The list of page IDs.
+        page_ids (list): The IDs of consecutive pages of the same PDF file.
+        config (ConfigSnapshot, optional): The configuration to use. Defaults to the current one.
+        on_stage_done (callable, optional): Called with a list of page IDs and the stage they
+            have just completed: "ocr", "filter" or "gpt". Raising marks the pages as failed.
 
     Returns:
-        dict: A dictionary that contains processing results with keys as page IDs and values as status messages.
+        dict: A dictionary with keys as page IDs and values as status messages.
     """
     results = {}
+    config = config or get_config()
 
-    for page_id in page_ids:
-        try:
-            # Get the page
-            pdf_page = PDFPage.objects.get(id=page_id)
+    try:
+        # Record the start time
+        PDFPage.objects.filter(id__in=page_ids).update(scan_start_time=timezone.now())
 
-            # Record the start time
-            pdf_page.scan_start_time = timezone.now()
-            pdf_page.save()
+        logger.info(f"Document AI Processing for pages {page_ids}")
+        process_page_range(page_ids, config)
+        if on_stage_done is not None:
+            on_stage_done(page_ids, "ocr")
+    except Exception as e:
+        for page_id in page_ids:
+            logger.error(f"Failed to process page {page_id}: {str(e)}")
+            results[page_id] = f"Failed to process page {page_id}: {str(e)}"
+        return results
 
-            # Process each page, filter tokens, and handle GPT processing
-            logger.info(f"Document AI Processing for page {page_id}")
-            process_page(page_id)
+    for page_id in page_ids:
+        try:
+            # Filter tokens and handle GPT processing
             logger.info(f"Token Filtering for page {page_id}")
-            token_filter(page_id)
+            token_filter(page_id, config)
+            if on_stage_done is not None:
+                on_stage_done([page_id], "filter")
             logger.info(f"GPT Token Processing for page {page_id}")
-            gpt_token_processing(page_id)
+            gpt_token_processing(page_id, config)
+            if on_stage_done is not None:
+                on_stage_done([page_id], "gpt")
 
             # Record the end time
-            pdf_page.scan_end_time = timezone.now()
-            pdf_page.save()
-            
+            PDFPage.objects.filter(id=page_id).update(scan_end_time=timezone.now())
+
             results[page_id] = "Success"
         except Exception as e:
             # Record the error against the page ID in the results dictionary
-            results[page_id] = f"Failed to process page {page_id}: {str(e)}"
             logger.error(f"Failed to process page {page_id}: {str(e)}")
+            results[page_id] = f"Failed to process page {page_id}: {str(e)}"
 
     return results
 
 
-def render_pdf_to_images(page_ids: list):
+def _process_page_group_in_thread(page_ids: list, config, should_continue=None, on_stage_done=None):
     """
-    Renders PDF pages to images and saves them, handling errors along the way.
+    Worker wrapper around `process_page_group` for use in a thread pool.
+
+    Django opens one database connection per thread, so the connection is closed
+    once the pages are done to avoid leaking connections from pool threads.
+    """
+    try:
+        if should_continue is not None and not should_continue():
+            return {}
+        return process_page_group(page_ids, config, on_stage_done)
+    finally:
+        connections.close_all()
+
+
+def process_pages_util(page_ids: list, max_workers: int = None, should_continue=None, pipeline: bool = None, on_stage_done=None):
+    """
+    Processes a list of pages using specified parameters, handling errors individually.
+
+    Pages are processed concurrently on a bounded thread pool when more than one worker
+    is configured, since nearly all of the time per page is spent waiting on Document AI
+    and OpenAI. In pipeline mode each stage gets its own worker pool instead, so one page
+    can be in Document AI while another is in GPT.
 
     Args:
         page_ids (list): The list of page IDs.
+        max_workers (int, optional): The number of pages processed at once. Defaults to
+            `Settings.scan_workers`.
+        should_continue (callable, optional): Checked before each page is started; pages
+            are skipped (and left out of the results) once it returns False.
+        pipeline (bool, optional): Whether to use the staged pipeline. Defaults to
+            `Settings.scan_pipeline`.
+        on_stage_done (callable, optional): Called with a list of page IDs and the stage they
+            have just completed: "ocr", "filter" or "gpt". Raising marks the pages as failed.
+
+    Every page of the call uses the same configuration snapshot, so a settings change made
+    while the pages are running only applies to the next call.
 
     Returns:
-        list: A list of URLs to the rendered images.
-
-    Raises:
-        FileNotFoundError: If the PDF file does not exist.
-        IOError: If there is an error reading the PDF or saving the image.
-        Exception: For any other unexpected issues.
+        dict: A dictionary that contains processing results with keys as page IDs and values as status messages.
     """
-    logger.info(f"Rendering PDF pages to images: {page_ids}")
-    image_urls = []
+    results = {}
 
-    for page_id in page_ids:
-        try:
-            page = PDFPage.objects.get(id=page_id)
+    config = get_config()
+    settings_obj = config.settings
+    if pipeline is None:
+        pipeline = bool(settings_obj and settings_obj.scan_pipeline)
+    if max_workers is None:
+        max_workers = max(1, settings_obj.scan_workers) if settings_obj else 1
+
+    if settings_obj and settings_obj.scan_async and page_ids:
+        return process_pages_util_async(page_ids, settings_obj.async_concurrency, should_continue, config, on_stage_done)
+
+    # Send runs of consecutive pages to Document AI together when batching is enabled
+    batch_pages = min(settings_obj.documentai_batch_pages, DOCUMENTAI_MAX_PAGES) if settings_obj else 1
+    if batch_pages > 1:
+        groups = group_page_ranges(page_ids, batch_pages)
+    else:
+        groups = [[page_id] for page_id in page_ids]
+
+    if pipeline and settings_obj and len(page_ids) > 1:
+        return process_pages_pipeline(groups, config, should_continue, on_stage_done)
+
+    if max_workers <= 1 or len(groups) <= 1:
+        for group in groups:
+            if should_continue is not None and not should_continue():
+                break
+            results.update(process_page_group(group, config, on_stage_done))
+        return {page_id: results[page_id] for page_id in page_ids if page_id in results}
+
+    logger.info(f"Processing {len(page_ids)} pages with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_process_page_group_in_thread, group, config, should_continue, on_stage_done): group
+            for group in groups
+        }
+        for future in as_completed(futures):
             try:
-                pdf = pdfium.PdfDocument(page.file.path)
+                results.update(future.result())
             except Exception as e:
-                logger.error(f"Failed to open PDF file at {page.file.path}: {e}")
-                raise FileNotFoundError(f"Failed to open PDF file at {page.file.path}: {e}")
+                for page_id in futures[future]:
+                    logger.error(f"Failed to process page {page_id}: {str(e)}")
+                    results[page_id] = f"Failed to process page {page_id}: {str(e)}"
 
-            try:
-                # Render the page to a bitmap
-                bitmap = pdfium.PdfPage.render(pdf.get_page(0), scale=4)
-
-                # Convert the bitmap to a PIL image
-                pil_image = Image.frombytes("RGB", (bitmap.width, bitmap.height), bitmap.buffer)
+    # Keep the results in the order the pages were requested
+    return {page_id: results[page_id] for page_id in page_ids if page_id in results}
 
-                # Save the PIL image to a BytesIO object
-                image_io = io.BytesIO()
-                pil_image.save(image_io, format='JPEG')
 
-                # Create a Django ContentFile from the BytesIO object
-                image_content_file = ContentFile(image_io.getvalue())
-
-                # Generate a filename
-                filename = f'{page.pdf_file.name}_page_{page.page_number}.jpg'
+def render_pdf_to_images(page_ids: list, scale: float = 4, image_format: str = "JPEG"):
+    """
+    Returns the URLs of high-resolution images of PDF pages, rendering only the pages whose
+    image is not in the render cache yet.
 
-                # Save the image to the high_res_image field
-                page.high_res_image.save(filename, image_content_file)
+    Args:
+        page_ids (list): The list of page IDs.
+        scale (float, optional): The number of pixels per PDF point.
+        image_format (str, optional): A Pillow image format.
 
-                # Save the changes to the page object
-                page.save()
+    Returns:
+        list: The media URLs of the images, in the order of `page_ids`.
 
-                # Append the URL to the list
-                image_url = 'http://localhost:8000' + page.high_res_image.url
-                image_urls.append(image_url)
-                
-            except Exception as e:
-                logger.error(f"Error processing or saving image for page {page_id}: {e}")
-                raise IOError(f"Error processing or saving image for page {page_id}: {e}")
-            finally:
-                # Ensure the PDF document is closed whether or not there was an error
-                pdf.close()
+    Raises:
+        PDFPage.DoesNotExist: If one of the pages does not exist.
+        Exception: If a page could not be rendered.
+    """
+    logger.info(f"Getting images of PDF pages: {page_ids}")
+    pages = PDFPage.objects.select_related("pdf_file").in_bulk(page_ids)
 
-        except PDFPage.DoesNotExist:
+    image_urls = []
+    for page_id in page_ids:
+        page = pages.get(page_id)
+        if page is None:
             logger.error(f"No PDFPage found with ID {page_id}")
             raise PDFPage.DoesNotExist(f"No PDFPage found with ID {page_id}")
+        try:
+            image_urls.append(rendered_image_url(page, scale, image_format))
         except Exception as e:
             logger.error(f"Failed to render image for page {page_id}: {e}")
             raise Exception(f"Failed to render image for page {page_id}: {e}")
@@ -4,13 +4,20 @@ from rest_framework import viewsets, status, serializers
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.decorators import action, api_view
-from django.core.files.storage import default_storage
-from .models import PDFFile, PDFPage, GPTResponse, AppKeys, Settings
-from .serializers import PDFFileSerializer, PDFPageSerializer, AppKeysSerializer, SettingsSerializer
+from django.core.exceptions import ValidationError
+from django.http import FileResponse
+from .models import PDFFile, PDFPage, GPTResponse, AppKeys, Settings, ChunkedUpload
+from .serializers import PDFFileSerializer, PDFPageSerializer, AppKeysSerializer, SettingsSerializer, page_file_url, page_thumbnail_url, with_gpt_responses, first_gpt_response
 from .utils.utils import split_pdf, process_pages_util, render_pdf_to_images
-import os
+from .utils.documentAI import DOCUMENTAI_PAGE_COST
+from .utils.scan_queue import enqueue_pages, cancel_pending_jobs, queue_status
+from .utils.token_store import load_page_tokens
+from .utils.http_session import retry_stats
+from .utils.content_hash import Sha256UploadHandler, uploaded_file_sha256
+from .utils.chunked_upload import UploadError, start_upload, write_chunk, complete_upload
+from .utils.page_files import page_file_path, render_cache, thumbnail_path, thumbnail_size, page_size_points, tile_pyramid, tile_path
 import logging
-from django.db.models import Count, F
+from django.db.models import Count, F, Prefetch
 from django.db.models import Q
 import random
 from django.conf import settings
@@ -60,7 +67,7 @@ class CustomPagination(PageNumberPagination):
 class PDFFileViewSet(viewsets.ModelViewSet):
     allowed_methods = ['GET', 'POST','DELETE']
 
-    queryset = PDFFile.objects.all()
+    queryset = PDFFile.objects.order_by("id")
     serializer_class = PDFFileSerializer
     pagination_class = CustomPagination
 
@@ -77,6 +84,10 @@ class PDFFileViewSet(viewsets.ModelViewSet):
             else:
                 queryset = queryset.exclude(num_pages=F('num_scanned_pages'))
 
+        if self.action == 'list':
+            # The nested pages and their GPT responses take two queries for the whole list
+            pages = with_gpt_responses(PDFPage.objects.order_by('page_number'))
+            queryset = queryset.prefetch_related(Prefetch('pages', queryset=pages))
         return queryset
 
     # Exclude 'put' and 'patch' methods from the schema
@@ -120,7 +131,7 @@ class PDFFileViewSet(viewsets.ModelViewSet):
     @extend_schema(
         methods=['POST'],
         summary="Upload PDF file(s)",
-        description="Uploads one or more PDF files and processes them to extract individual pages.",
+        description="Uploads one or more PDF files and processes them to extract individual pages. A file with the same content as a stored PDF file is not stored again; its entry describes the stored file and has `duplicate_of` set. A file named like a stored PDF file but with different content is not stored; its entry has an `error`, and the response is 409 if every file was rejected this way. Pages identical to already scanned pages get a copy of their scan results.",
         request={
             'multipart/form-data': {
                 'type': 'object',
@@ -142,16 +153,33 @@ class PDFFileViewSet(viewsets.ModelViewSet):
         tags=['PDFFiles']
     )
     def create(self, request, *args, **kwargs):
+        # Hash the files while they stream in, before they are read below
+        hash_handler = Sha256UploadHandler(request)
+        request.upload_handlers.insert(0, hash_handler)
         files = request.FILES.getlist('file')
         if not files:
             logger.error("No files provided.")
             return Response({"error": "No files provided."}, status=status.HTTP_400_BAD_REQUEST)
-        
+
+        digests = hash_handler.digests['file']
+        if len(digests) != len(files):
+            # The body was parsed before the handler was added, so hash the received files
+            digests = [uploaded_file_sha256(file) for file in files]
+
         responses = []
-        for file in files:
+        conflicts = 0
+        for file, digest in zip(files, digests):
             name = file.name
+            # Content decides: the same bytes under any name are a duplicate, while the same name
+            # with other bytes conflicts with the stored file
+            duplicate = PDFFile.objects.filter(sha256=digest).first()
+            if duplicate is not None:
+                responses.append(self.duplicate_pdf_response(duplicate, request))
+                continue
             if PDFFile.objects.filter(name=name).exists():
-                responses.append({"error": f"PDF file {name} already exists."})
+                logger.error(f"Upload of {name} differs from the stored PDF file of that name")
+                responses.append({"error": f"A PDF file named {name} already exists with different content."})
+                conflicts += 1
                 continue
 
             data = {
@@ -160,33 +188,182 @@ class PDFFileViewSet(viewsets.ModelViewSet):
             }
             serializer = self.get_serializer(data=data)
             serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
+            serializer.save(sha256=digest)
 
             try:
                 pdf_file = PDFFile.objects.get(id=serializer.data["id"])
-                split_pdf(pdf_file)  # Assuming this can raise exceptions
-                
-                pages = PDFPage.objects.filter(pdf_file=pdf_file)
-                page_ids = [page.id for page in pages]
-                thumbnail_paths = [
-                    request.build_absolute_uri(page.thumbnail.url) if page.thumbnail else None 
-                    for page in pages
-                ]
-
-                response_data = serializer.data
-                response_data["pages"] = page_ids
-                response_data["thumbnails"] = thumbnail_paths
-                responses.append(response_data)
+                responses.append(self.split_uploaded_pdf(pdf_file, request))
             except Exception as e:
                 logger.error(f"Failed processing PDF file {pdf_file.name}: {str(e)}")
                 responses.append({"error": f"Failed processing PDF file {pdf_file.name}: {str(e)}"})
 
+        if conflicts == len(files):
+            return Response(responses, status=status.HTTP_409_CONFLICT)
         return Response(responses, status=status.HTTP_201_CREATED)
 
+    def split_uploaded_pdf(self, pdf_file, request):
+        """
+        Splits a new PDF file into pages and returns its ID, name, page IDs and thumbnail URLs.
+        """
+        split_pdf(pdf_file)  # Assuming this can raise exceptions
+        return self.pdf_file_summary(pdf_file, request)
+
+    def pdf_file_summary(self, pdf_file, request):
+        pages = PDFPage.objects.filter(pdf_file=pdf_file).order_by("page_number")
+        return {
+            "id": pdf_file.id,
+            "name": pdf_file.name,
+            "pages": [page.id for page in pages],
+            "thumbnails": [page_thumbnail_url(page, request) for page in pages],
+        }
+
+    def duplicate_pdf_response(self, pdf_file, request):
+        """
+        Describes an existing PDF file with the same content as an upload, which is not stored again.
+        """
+        logger.info(f"Upload is identical to PDF file {pdf_file.name}")
+        return {**self.pdf_file_summary(pdf_file, request), "duplicate_of": pdf_file.id}
+
+    @extend_schema(
+        methods=['POST'],
+        summary="Start a chunked upload",
+        description="Starts a resumable upload of one PDF file, for files too large for a single request. Send the file in chunks to `pdfs/uploads/{upload_id}/`, then complete the upload with `pdfs/uploads/{upload_id}/complete/`. If a PDF file with the same SHA-256 digest is stored already, no upload is started and the response (200) describes that file, with `duplicate_of` set.",
+        request=inline_serializer(
+            name="UploadStartRequest",
+            fields={
+                "name": serializers.CharField(),
+                "size": serializers.IntegerField(help_text="File size in bytes"),
+                "sha256": serializers.CharField(help_text="Hex SHA-256 digest of the whole file"),
+            }
+        ),
+        responses={201: inline_serializer(
+            name="UploadStatusResponse",
+            fields={
+                "id": serializers.UUIDField(),
+                "name": serializers.CharField(),
+                "size": serializers.IntegerField(),
+                "offset": serializers.IntegerField(help_text="Number of bytes received, where the next chunk starts"),
+                "chunk_size": serializers.IntegerField(help_text="Suggested chunk size in bytes"),
+            }
+        )},
+        tags=['PDFFiles']
+    )
+    @action(detail=False, methods=["post"])
+    def uploads(self, request):
+        name = request.data.get("name")
+        try:
+            size = int(request.data.get("size"))
+        except (TypeError, ValueError):
+            return Response({"error": "size must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        if not name or not request.data.get("sha256"):
+            return Response({"error": "name and sha256 are required."}, status=status.HTTP_400_BAD_REQUEST)
+        # A file that is stored already does not need to be sent at all
+        duplicate = PDFFile.objects.filter(sha256=str(request.data["sha256"]).lower()).first()
+        if duplicate is not None:
+            return Response(self.duplicate_pdf_response(duplicate, request), status=status.HTTP_200_OK)
+        if PDFFile.objects.filter(name=name).exists():
+            return Response({"error": f"A PDF file named {name} already exists with different content."}, status=status.HTTP_409_CONFLICT)
+
+        try:
+            upload = start_upload(name, size, request.data["sha256"])
+        except UploadError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.upload_status(upload), status=status.HTTP_201_CREATED)
+
+    def upload_status(self, upload):
+        return {
+            "id": upload.id,
+            "name": upload.name,
+            "size": upload.size,
+            "offset": upload.received,
+            "chunk_size": settings.UPLOAD_CHUNK_MB * 1024 * 1024,
+        }
+
+    @extend_schema(
+        methods=['GET'],
+        summary="Chunked upload status",
+        description="Returns the number of bytes received so far, where an interrupted upload resumes.",
+        responses={200: OpenApiTypes.OBJECT},
+        tags=['PDFFiles']
+    )
+    @extend_schema(
+        methods=['PUT'],
+        summary="Upload a chunk",
+        description="Writes the raw request body into the file at `offset`. A chunk may start anywhere up to the number of bytes received so far, so a chunk whose response was lost can be sent again. The body is streamed to disk, so chunks of any size use little memory.",
+        parameters=[
+            OpenApiParameter(name='offset', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, description='Position of the chunk in the file', required=True),
+        ],
+        request={'application/octet-stream': OpenApiTypes.BINARY},
+        responses={200: OpenApiTypes.OBJECT},
+        tags=['PDFFiles']
+    )
+    @extend_schema(
+        methods=['DELETE'],
+        summary="Cancel a chunked upload",
+        description="Deletes an upload and the bytes received so far.",
+        responses={204: None},
+        tags=['PDFFiles']
+    )
+    @action(detail=False, methods=["get", "put", "delete"], url_path=r"uploads/(?P<upload_id>[0-9a-f-]+)")
+    def upload_chunk(self, request, upload_id):
+        try:
+            upload = ChunkedUpload.objects.get(id=upload_id)
+        except (ChunkedUpload.DoesNotExist, ValidationError):
+            return Response({"error": f"No upload found with ID {upload_id}."}, status=status.HTTP_404_NOT_FOUND)
+
+        if request.method == "GET":
+            return Response(self.upload_status(upload), status=status.HTTP_200_OK)
+        if request.method == "DELETE":
+            upload.delete()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        try:
+            offset = int(request.query_params.get("offset"))
+        except (TypeError, ValueError):
+            return Response({"error": "offset must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+        try:
+            # The body is never parsed, so it is read from the request stream as it arrives
+            write_chunk(upload, offset, request.stream, length)
+        except UploadError as e:
+            return Response({"error": str(e), "offset": e.offset}, status=status.HTTP_409_CONFLICT)
+        except Exception as e:
+            logger.error(f"Failed to write a chunk of upload {upload.id}: {e}")
+            return Response({"error": f"Failed to write a chunk of upload {upload.id}: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(self.upload_status(upload), status=status.HTTP_200_OK)
+
+    @extend_schema(
+        methods=['POST'],
+        summary="Complete a chunked upload",
+        description="Checks the received file against the SHA-256 digest given when the upload started, then creates the PDF file and splits it into pages. A file failing the check is deleted and has to be uploaded again. A file identical to a stored PDF file is not stored again; the response (200) describes the stored file, with `duplicate_of` set. Only one request completes an upload: a concurrent request gets 409 while it is being completed, and the new PDF file (200, with `duplicate_of` set) once it is done.",
+        request=None,
+        responses={201: OpenApiTypes.OBJECT},
+        tags=['PDFFiles']
+    )
+    @action(detail=False, methods=["post"], url_path=r"uploads/(?P<upload_id>[0-9a-f-]+)/complete")
+    def complete(self, request, upload_id):
+        try:
+            upload = ChunkedUpload.objects.get(id=upload_id)
+        except (ChunkedUpload.DoesNotExist, ValidationError):
+            return Response({"error": f"No upload found with ID {upload_id}."}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            pdf_file, created = complete_upload(upload)
+        except UploadError as e:
+            return Response({"error": str(e), "offset": e.offset}, status=status.HTTP_409_CONFLICT)
+        if not created:
+            return Response(self.duplicate_pdf_response(pdf_file, request), status=status.HTTP_200_OK)
+
+        try:
+            return Response(self.split_uploaded_pdf(pdf_file, request), status=status.HTTP_201_CREATED)
+        except Exception as e:
+            logger.error(f"Failed processing PDF file {pdf_file.name}: {str(e)}")
+            return Response({"error": f"Failed processing PDF file {pdf_file.name}: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
     @extend_schema(
         methods=['GET'],
         summary="Retrieve PDF file",
-        description="Retrieves a PDF file along with its pages and their respective metadata.",
+        description="Retrieves a PDF file along with its pages and their respective metadata. High-resolution page images are rendered on first request and served from the render cache afterwards.",
         parameters=[
             OpenApiParameter(name='only_scanned', type=OpenApiTypes.BOOL, location=OpenApiParameter.QUERY, description='Only return scanned pages'),
         ],
@@ -196,13 +373,9 @@ class PDFFileViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
-            serializer = self.get_serializer(instance)
-
-            # Delete high-resolution images before creating new ones
-            self.delete_high_res_images(request)
 
             try:
-                pages = PDFPage.objects.filter(pdf_file=instance)
+                pages = with_gpt_responses(PDFPage.objects.filter(pdf_file=instance))
                 only_scanned = self.request.query_params.get('only_scanned', 'false').lower() in ['true', '1']
                 if only_scanned:
                     pages = pages.filter(scanned=True)
@@ -210,19 +383,18 @@ class PDFFileViewSet(viewsets.ModelViewSet):
                 page_ids = [page.id for page in pages]
                 image_urls = render_pdf_to_images(page_ids)  # This might raise exceptions
 
-                response_data = serializer.data
-                response_data["pages"] = []
+                response_data = {"id": instance.id, "name": instance.name, "pages": []}
                 for page, image_url in zip(pages, image_urls):
                     page_data = {
                         "id": page.id,
                         "page_number": page.page_number,
-                        "file": request.build_absolute_uri(page.file.url),
-                        "thumbnail": request.build_absolute_uri(page.thumbnail.url) if page.thumbnail else None,
-                        "high_res_image": image_url,
+                        "file": page_file_url(page, request),
+                        "thumbnail": page_thumbnail_url(page, request),
+                        "high_res_image": request.build_absolute_uri(image_url),
                         "scanned": page.scanned,
                     }
                     if page.scanned:
-                        gpt_response = GPTResponse.objects.filter(page_id=page.id).first()
+                        gpt_response = first_gpt_response(page)
                         page_data["json_output"] = gpt_response.json_response if gpt_response else None
                         page_data["gpt_cost"] = gpt_response.cost if gpt_response else None
                         page_data["documentAI_cost"] = page.cost
@@ -239,21 +411,15 @@ class PDFFileViewSet(viewsets.ModelViewSet):
     @extend_schema(
         methods=['DELETE'],
         summary="Delete high-resolution images",
-        description="Deletes all high-resolution images associated with the PDF file.",
+        description="Empties the render cache holding the high-resolution page images of every PDF file. The images are rendered again when the PDF files are next retrieved.",
         responses={204: None},
         tags=['PDFFiles']
     )
     @action(detail=False, methods=['delete'])
     def delete_high_res_images(self, request):
         try:
-            # Get all PDFPage objects
-            pages = PDFPage.objects.all()
-
-            for page in pages:
-                image_path = os.path.join('high_res_images', f'{page.pdf_file.name}_page_{page.page_number}.jpg')
-                if default_storage.exists(image_path):
-                    default_storage.delete(image_path)
-
+            deleted = render_cache.clear()
+            logger.info(f"Deleted {deleted} high-resolution images from the render cache")
             return Response({"message": "High-resolution images deleted successfully."}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
             logger.error(f"An error occurred while deleting high-resolution images: {str(e)}")
@@ -263,19 +429,18 @@ class PDFFileViewSet(viewsets.ModelViewSet):
 class PDFPageViewSet(viewsets.ModelViewSet):
     allowed_methods = ['GET', 'POST', 'DELETE']
 
-    queryset = PDFPage.objects.all()
+    queryset = PDFPage.objects.order_by("id")
     serializer_class = PDFPageSerializer
     pagination_class = CustomPagination
 
-    # Global flag to control the scanning process
-    should_continue_scanning = True
-
     def get_queryset(self):
         queryset = super().get_queryset()
         scanned = self.request.query_params.get('scanned', None)
         if scanned is not None:
             scanned = scanned.lower() in ['true', '1']  # Convert to boolean
             queryset = queryset.filter(scanned=scanned)
+        if self.action in ('list', 'retrieve'):
+            queryset = with_gpt_responses(queryset)
         return queryset
     
     # Exclude 'put' and 'patch' methods from the schema
@@ -340,13 +505,14 @@ class PDFPageViewSet(viewsets.ModelViewSet):
     @extend_schema(
         methods=['POST'],
         summary="Start automatic scanning",
-        description="Initiates a process that automatically scans all unscanned PDF pages.",
+        description="Queues all unscanned PDF pages for the scan workers and returns immediately. Run `manage.py scan_worker` to process the queue.",
         request={},
         responses={
-            200: inline_serializer(
+            202: inline_serializer(
                 name='AutoScanResponse',
                 fields={
                     'status': serializers.CharField(),
+                    'queued_pages': serializers.ListField(child=serializers.IntegerField()),
                 }
             )
         },
@@ -355,35 +521,27 @@ class PDFPageViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=["post"])
     def auto_scan(self, request, *args, **kwargs):
         """
-        Automatically scans all unscanned pages.
+        Queues all unscanned pages for the scan workers.
         """
-        global should_continue_scanning
-        should_continue_scanning = True
-
-        unscanned_pages = PDFPage.objects.filter(scanned=False)
-
-        for page in unscanned_pages:
-            if not should_continue_scanning:
-                break
-
-            # Process the page
-            self.process_page(page)
+        unscanned_page_ids = list(PDFPage.objects.filter(scanned=False).values_list("id", flat=True))
+        queued_page_ids = enqueue_pages(unscanned_page_ids)
 
         return Response(
-            {"status": "Scanning complete"},
-            status=status.HTTP_200_OK,
+            {"status": "Scanning queued", "queued_pages": queued_page_ids},
+            status=status.HTTP_202_ACCEPTED,
         )
     
     @extend_schema(
         methods=['POST'],
         summary="Stop scanning process",
-        description="Stops the ongoing scanning process immediately.",
+        description="Cancels all queued scan jobs. Pages already being processed by a worker are finished.",
         request={},
         responses={
             200: inline_serializer(
                 name='StopScanningResponse',
                 fields={
                     'status': serializers.CharField(),
+                    'cancelled_jobs': serializers.IntegerField(),
                 }
             )
         },
@@ -394,51 +552,211 @@ class PDFPageViewSet(viewsets.ModelViewSet):
         """
         Stops the scanning process.
         """
-        global should_continue_scanning
-        should_continue_scanning = False
+        cancelled_jobs = cancel_pending_jobs()
 
         return Response(
-            {"status": "Scanning stopped"},
+            {"status": "Scanning stopped", "cancelled_jobs": cancelled_jobs},
             status=status.HTTP_200_OK,
         )
+
+    @extend_schema(
+        methods=['GET'],
+        summary="Scan queue status",
+        description="Returns the number of scan jobs in each state, and the OpenAI retry counters of the server process. Scan workers print their own retry counters.",
+        responses={
+            200: inline_serializer(
+                name='ScanStatusResponse',
+                fields={
+                    'pending': serializers.IntegerField(),
+                    'running': serializers.IntegerField(),
+                    'done': serializers.IntegerField(),
+                    'failed': serializers.IntegerField(),
+                    'cancelled': serializers.IntegerField(),
+                    'openai_retries': inline_serializer(
+                        name='RetryStats',
+                        fields={
+                            'requests': serializers.IntegerField(),
+                            'retries': serializers.IntegerField(),
+                            'failures': serializers.IntegerField(),
+                            'backoff_seconds': serializers.FloatField(),
+                            'retries_by_reason': serializers.DictField(child=serializers.IntegerField()),
+                        }
+                    ),
+                }
+            )
+        },
+        tags=['PDFPages']
+    )
+    @action(detail=False, methods=["get"])
+    def scan_status(self, request, *args, **kwargs):
+        """
+        Returns the state of the scan queue and the OpenAI retry counters.
+        """
+        return Response({**queue_status(), "openai_retries": retry_stats.as_dict()}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        methods=['GET'],
+        summary="Page tokens",
+        description="Returns the OCR tokens of a page, read from its token blob or its Token rows.",
+        responses={
+            200: inline_serializer(
+                name='PageTokensResponse',
+                fields={
+                    'tokens': serializers.ListField(child=inline_serializer(
+                        name='PageToken',
+                        fields={
+                            'text': serializers.CharField(),
+                            'bbox': serializers.ListField(child=serializers.FloatField()),
+                            'confidence': serializers.FloatField(),
+                            'filtered': serializers.BooleanField(),
+                        }
+                    )),
+                }
+            )
+        },
+        tags=['PDFPages']
+    )
+    @action(detail=True, methods=["get"])
+    def tokens(self, request, *args, **kwargs):
+        """
+        Returns the tokens of a page in either storage format.
+        """
+        page = self.get_object()
+        page_tokens = load_page_tokens(page)
+        if page_tokens is not None:
+            tokens = [
+                {"text": text, "bbox": bbox, "confidence": confidence, "filtered": filtered}
+                for text, bbox, confidence, filtered in zip(
+                    page_tokens.texts(),
+                    page_tokens.bbox.tolist(),
+                    page_tokens.confidence.tolist(),
+                    page_tokens.filtered.tolist(),
+                )
+            ]
+        else:
+            tokens = [
+                {"text": text, "bbox": [x1, y1, x2, y2], "confidence": confidence, "filtered": filtered}
+                for text, x1, y1, x2, y2, confidence, filtered in page.tokens.order_by("id").values_list(
+                    "text", "x1", "y1", "x2", "y2", "token_confidence", "filtered"
+                )
+            ]
+        return Response({"tokens": tokens}, status=status.HTTP_200_OK)
     
-    def process_page(self, page):
+    @extend_schema(
+        methods=['GET'],
+        summary="Download PDF page",
+        description="Returns the single-page PDF of a page. For a virtual page it is cut from the uploaded PDF and cached on first use.",
+        responses={(200, 'application/pdf'): OpenApiTypes.BINARY},
+        tags=['PDFPages']
+    )
+    @action(detail=True, methods=["get"])
+    def download(self, request, *args, **kwargs):
         """
-        Processes a single PDF page, updates its status, and gathers GPT responses.
+        Returns the PDF of a page.
         """
+        page = self.get_object()
         try:
+            path = page_file_path(page)
+        except Exception as e:
+            logger.error(f"Failed to extract page {page.id}: {e}")
+            return Response({"error": f"Failed to extract page {page.id}: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return FileResponse(
+            open(path, "rb"),
+            content_type="application/pdf",
+            filename=f"{page.pdf_file.name}_page_{page.page_number}.pdf",
+        )
+    
+    @extend_schema(
+        methods=['GET'],
+        summary="Page thumbnail",
+        description="Returns a PNG thumbnail of a page, rendered on first request and served from a size-bounded cache afterwards.",
+        parameters=[
+            OpenApiParameter(name='size', type=OpenApiTypes.INT, location=OpenApiParameter.QUERY, description='Longest side in pixels, rounded up to a multiple of 32 (default 400, at most 1024)'),
+        ],
+        responses={(200, 'image/png'): OpenApiTypes.BINARY},
+        tags=['PDFPages']
+    )
+    @action(detail=True, methods=["get"])
+    def thumbnail(self, request, *args, **kwargs):
+        """
+        Returns the thumbnail of a page at the requested size.
+        """
+        page = self.get_object()
+        try:
+            size = thumbnail_size(request.query_params.get('size'))
+        except ValueError:
+            return Response({"error": "size must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Process the page
-            result = process_pages_util([page.id])
-
-            # Update the page status
-            page.scanned = True
-            page.cost = 0.006
-            page.save()
+        try:
+            path = thumbnail_path(page, size)
+        except Exception as e:
+            logger.error(f"Failed to render the thumbnail of page {page.id}: {e}")
+            return Response({"error": f"Failed to render the thumbnail of page {page.id}: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # Get the GPT response
-            gpt_response = GPTResponse.objects.get(page_id=page.id)
+        response = FileResponse(open(path, "rb"), content_type="image/png")
+        # A page's content never changes, so browsers may keep the thumbnail
+        response["Cache-Control"] = "public, max-age=86400"
+        return response
 
-            response = {
-                'page_id': page.id,
-                'json_output': gpt_response.json_response,
-                'gpt_cost': gpt_response.cost,
-                'documentAI_cost': page.cost,
-                'processing_time': page.processing_time,
-                'scanned': page.scanned
+    @extend_schema(
+        methods=['GET'],
+        summary="Page tile pyramid",
+        description="Describes the deep-zoom tile pyramid of a page's high-resolution image: the full-resolution size in pixels, the tile size, overlap and format, the highest level, and the URL template of the tiles. Level `max_level` is the full resolution and each level below halves it, as in Deep Zoom (DZI).",
+        responses={200: inline_serializer(
+            name="TilePyramidResponse",
+            fields={
+                "width": serializers.IntegerField(),
+                "height": serializers.IntegerField(),
+                "tile_size": serializers.IntegerField(),
+                "overlap": serializers.IntegerField(),
+                "format": serializers.CharField(),
+                "max_level": serializers.IntegerField(),
+                "tile_url": serializers.CharField(),
             }
-        except PDFPage.DoesNotExist:
-            logger.error(f"PDFPage with id {page.id} does not exist.")
-            return {"error": f"PDFPage with id {page.id} does not exist."}
-        except GPTResponse.DoesNotExist:
-            logger.error(f"GPTResponse for PDFPage with id {page.id} does not exist.")
-            return {"error": f"GPTResponse for PDFPage with id {page.id} does not exist."}
+        )},
+        tags=['PDFPages']
+    )
+    @action(detail=True, methods=["get"])
+    def tiles(self, request, *args, **kwargs):
+        """
+        Returns the description of a page's tile pyramid.
+        """
+        page = self.get_object()
+        try:
+            pyramid = tile_pyramid(*page_size_points(page))
         except Exception as e:
-            logger.error(f"An error occurred while processing page {page.id}: {str(e)}")
-            return {"error": f"An error occurred while processing page {page.id}: {str(e)}"}
+            logger.error(f"Failed to read the size of page {page.id}: {e}")
+            return Response({"error": f"Failed to read the size of page {page.id}: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return response
+        tile_url = request.build_absolute_uri(request.path) + "{level}/{col}_{row}/"
+        return Response({**pyramid, "tile_url": tile_url}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        methods=['GET'],
+        summary="Page tile",
+        description="Returns one JPEG tile of a page's tile pyramid, rendered from just its region of the page on first request and served from a size-bounded cache afterwards.",
+        responses={(200, 'image/jpeg'): OpenApiTypes.BINARY},
+        tags=['PDFPages']
+    )
+    @action(detail=True, methods=["get"], url_path=r"tiles/(?P<level>\d+)/(?P<col>\d+)_(?P<row>\d+)")
+    def tile(self, request, level, col, row, *args, **kwargs):
+        """
+        Returns one tile of a page's tile pyramid.
+        """
+        page = self.get_object()
+        try:
+            path = tile_path(page, int(level), int(col), int(row))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"Failed to render tile {level}/{col}_{row} of page {page.id}: {e}")
+            return Response({"error": f"Failed to render tile {level}/{col}_{row} of page {page.id}: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        response = FileResponse(open(path, "rb"), content_type="image/jpeg")
+        # A tile only depends on the page's content, which never changes
+        response["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+    
     @extend_schema(
         methods=['POST'],
         summary="Process specified pages",
@@ -497,7 +815,7 @@ class PDFPageViewSet(viewsets.ModelViewSet):
 
                 if page_id in unscanned_page_ids:
                     pdf_page.scanned = True
-                    pdf_page.cost = 0.006
+                    pdf_page.cost = DOCUMENTAI_PAGE_COST
                     pdf_page.save()
 
                 gpt_response = GPTResponse.objects.get(page_id=page_id)
@@ -677,6 +995,12 @@ class AppKeysViewSet(AllowedMethodsMixin, viewsets.ModelViewSet):
                         'format': 'binary',  # Important for files
                         'description': 'Credential file',
                         'required': True
+                    },
+                    'extra_openai_api_keys': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'description': 'Further OpenAI API keys to spread GPT calls over',
+                        'required': False
                     }
                 }
             }
@@ -705,6 +1029,12 @@ class AppKeysViewSet(AllowedMethodsMixin, viewsets.ModelViewSet):
                         'format': 'binary',  # Important for files
                         'description': 'Credential file',
                         'required': False
+                    },
+                    'extra_openai_api_keys': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'description': 'Further OpenAI API keys to spread GPT calls over',
+                        'required': False
                     }
                 }
             }
@@ -733,6 +1063,12 @@ class AppKeysViewSet(AllowedMethodsMixin, viewsets.ModelViewSet):
                         'format': 'binary',  # Important for files
                         'description': 'Credential file',
                         'required': False
+                    },
+                    'extra_openai_api_keys': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'description': 'Further OpenAI API keys to spread GPT calls over',
+                        'required': False
                     }
                 }
             }
@@ -25,6 +25,50 @@ DEBUG = True
 # Flag to enable dummy endpoints for testing
 DUMMY_MODE = False
 
+# External API endpoints, overridable to point the scanner at local fake servers
+# (see `manage.py fake_api_servers`)
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+DOCUMENTAI_API_ENDPOINT = os.getenv("DOCUMENTAI_API_ENDPOINT", "")
+DOCUMENTAI_INSECURE_CHANNEL = os.getenv("DOCUMENTAI_INSECURE_CHANNEL", "false").lower() in ["true", "1"]
+
+# Timeouts (seconds) and retry policy for OpenAI API calls
+OPENAI_CONNECT_TIMEOUT = 10
+OPENAI_READ_TIMEOUT = 120
+OPENAI_MAX_RETRIES = 5
+OPENAI_BACKOFF_BASE = 1.0
+OPENAI_BACKOFF_MAX = 60.0
+
+# How often a process checks whether Settings or AppKeys were changed by another process
+CONFIG_VERSION_CHECK_SECONDS = 2
+
+# Directory tiktoken loads its BPE files from; fill it with `manage.py download_tiktoken_encodings`
+# so workers can count tokens without network access
+TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", str(BASE_DIR / "tiktoken_cache"))
+
+# Encoding of new Token.token_info values: "json", "zlib", "msgpack-zstd", or "compact" for
+# msgpack-zstd when msgpack and zstandard are installed and zlib otherwise. Every encoding can be
+# read. The compressed encodings store a fraction of the bytes but decode slower than JSON, so
+# they are opt-in; `manage.py measure_token_info` compares them on the stored tokens.
+TOKEN_INFO_CODEC = os.getenv("TOKEN_INFO_CODEC", "json")
+
+# Size limit of the cache of single-page PDFs extracted for virtual pages
+PAGE_CACHE_MAX_MB = int(os.getenv("PAGE_CACHE_MAX_MB", "1024"))
+
+# Size limit of the cache of thumbnails, which are rendered when first requested
+THUMBNAIL_CACHE_MAX_MB = int(os.getenv("THUMBNAIL_CACHE_MAX_MB", "256"))
+
+# Size limit of the cache of high-resolution page images
+RENDER_CACHE_MAX_MB = int(os.getenv("RENDER_CACHE_MAX_MB", "2048"))
+
+# Size limit of the cache of deep-zoom tiles of page images
+TILE_CACHE_MAX_MB = int(os.getenv("TILE_CACHE_MAX_MB", "2048"))
+
+# Chunked uploads: the largest accepted file, the chunk size suggested to clients, and how long
+# an upload may go without a chunk before it is deleted
+UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "4096"))
+UPLOAD_CHUNK_MB = int(os.getenv("UPLOAD_CHUNK_MB", "8"))
+UPLOAD_EXPIRY_HOURS = int(os.getenv("UPLOAD_EXPIRY_HOURS", "24"))
+
 ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
 
 
@@ -78,6 +122,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Seconds a write waits for another thread or process to release the database lock
+            # before failing with "database is locked". Journaling is switched to WAL in
+            # SSAPP/signals.py so reads do not wait for writes.
+            'timeout': int(os.getenv('SQLITE_TIMEOUT', '30')),
+        },
     }
 }
 